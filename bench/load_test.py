@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Load-test the hot paths of mediabrowser.py and report latency percentiles as JSON.
+
+Generates a synthetic tree (see synthetic_tree.py), starts the server on it and
+runs one scenario after the other with concurrent keep-alive clients:
+
+    listing_html   HTML listing of the 1k folder
+    listing_json   JSON listing pages of the biggest folder, following next_cursor
+    thumbnails     thumbnails of the images, each rendered once and then cached
+    ranges         1 MB byte ranges at random offsets of the sparse media files
+    m3u            recursive playlist of the music library
+    static         support files, gzip accepted
+
+For each scenario it reports requests, errors, throughput and the p50/p95/p99
+latency in milliseconds. Server options after -- are passed on, which makes it
+easy to compare engines and cache settings run to run:
+
+    python3 bench/load_test.py --clients 32 --duration 10 -o threaded.json
+    python3 bench/load_test.py --clients 32 --duration 10 -o asyncio.json -- --engine asyncio
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+from sendfile_throughput import SCRIPT, wait_for_port
+from synthetic_tree import DEFAULT_SIZES, build_tree
+
+SCENARIOS = ('listing_html', 'listing_json', 'thumbnails', 'ranges', 'm3u', 'static')
+STATIC_PATHS = ('/js/main.js', '/js/jquery-3.6.3.min.js', '/css/split-pane.min.css', '/ico/favicon-32x32.png')
+RANGE_SIZE = 1 << 20
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+
+class Scenario:
+    """Runs requests from make_request(n) on concurrent keep-alive connections for a while."""
+
+    def __init__(self, port, make_request, clients, duration):
+        self.port = port
+        self.make_request = make_request
+        self.clients = clients
+        self.duration = duration
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+
+    def client(self, deadline):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        latencies, statuses, errors, received = [], {}, 0, 0
+        while time.perf_counter() < deadline:
+            path, headers = self.make_request(next(self.counter))
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+                continue
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+            received += len(body)
+            if response.will_close:
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        conn.close()
+
+        with self.lock:
+            self.latencies.extend(latencies)
+            for status, count in statuses.items():
+                self.statuses[status] = self.statuses.get(status, 0) + count
+            self.errors += errors
+            self.bytes += received
+
+    def run(self):
+        started = time.perf_counter()
+        deadline = started + self.duration
+        threads = [threading.Thread(target=self.client, args=(deadline,)) for _ in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+
+        latencies = sorted(self.latencies)
+        failed = sum(count for status, count in self.statuses.items() if status >= 400)
+        return {
+            'requests': len(latencies),
+            'errors': self.errors + failed,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'seconds': round(seconds, 2),
+            'requests_per_second': round(len(latencies) / seconds, 1),
+            'mb_per_second': round(self.bytes / seconds / (1 << 20), 2),
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+                **{name: round(percentile(latencies, fraction) * 1000, 2) if latencies else None
+                   for name, fraction in (('p50', .5), ('p95', .95), ('p99', .99))},
+                'max': round(latencies[-1] * 1000, 2) if latencies else None,
+            },
+        }
+
+
+def json_listing_pages(port, folder, limit):
+    """URLs of all pages of a JSON listing, collected by following next_cursor once."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    pages = []
+    cursor = None
+    while True:
+        path = f'/{quote(folder)}/?mediabro-list.json&limit={limit}' + (f'&cursor={cursor}' if cursor else '')
+        pages.append(path)
+        conn.request('GET', path)
+        cursor = json.loads(conn.getresponse().read()).get('next_cursor')
+        if not cursor:
+            break
+    conn.close()
+    return pages
+
+
+def make_scenarios(tree, port, limit):
+    """{name: make_request} for the scenarios the tree has data for."""
+    gzip = {'Accept-Encoding': 'gzip'}
+    biggest = tree['folders'][max(tree['folders'])]
+    smallest = tree['folders'][min(tree['folders'])]
+    scenarios = {
+        'listing_html': lambda n: (f'/{smallest}/', gzip),
+        'm3u': lambda n: (f'/{tree["library"]}/medialist.m3u8?recursive=1', gzip),
+        'static': lambda n: (STATIC_PATHS[n % len(STATIC_PATHS)], gzip),
+    }
+
+    pages = json_listing_pages(port, biggest, limit)
+    scenarios['listing_json'] = lambda n: (pages[n % len(pages)], gzip)
+
+    if tree['images']:
+        images = tree['images']
+        scenarios['thumbnails'] = lambda n: (f'/{images[n % len(images)]}?mediabro-thumb.jpg', {})
+
+    if tree['media']:
+        rng = random.Random(1)
+        media = tree['media']
+
+        def ranged(n):
+            path, size = media[n % len(media)]
+            offset = rng.randrange(0, size - RANGE_SIZE)
+            return f'/{path}', {'Range': f'bytes={offset}-{offset + RANGE_SIZE - 1}'}
+
+        scenarios['ranges'] = ranged
+    return scenarios
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     usage='%(prog)s [options] [-- server options]')
+    parser.add_argument('--root', help='tree to use or complete; a temporary one is created and removed otherwise')
+    parser.add_argument('--sizes', help='file counts of the flat folders (default: %(default)s)',
+                        default=','.join(map(str, DEFAULT_SIZES)))
+    parser.add_argument('--images', help='number of images for thumbnails (default: %(default)s)', type=int,
+                        default=200)
+    parser.add_argument('--media_size', help='size of each sparse media file in GB (default: %(default)s)',
+                        type=float, default=4.0)
+    parser.add_argument('--scenarios', help='comma separated subset of %s' % ','.join(SCENARIOS),
+                        default=','.join(SCENARIOS))
+    parser.add_argument('--clients', help='concurrent connections (default: %(default)s)', type=int, default=16)
+    parser.add_argument('--duration', help='seconds per scenario (default: %(default)s)', type=float, default=10)
+    parser.add_argument('--page_size', help='entries per JSON listing page (default: %(default)s)', type=int,
+                        default=500)
+    parser.add_argument('--port', help='port to run the server on (default: %(default)s)', type=int, default=18766)
+    parser.add_argument('--output', '-o', help='write the JSON report to this file as well')
+    argv = sys.argv[1:]
+    server_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+    selected = [name for name in args.scenarios.split(',') if name]
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(sorted(unknown)))
+
+    with tempfile.TemporaryDirectory(prefix='mediabro-bench-') as scratch:
+        root = args.root or os.path.join(scratch, 'root')
+        started = time.perf_counter()
+        tree = build_tree(root, [int(size) for size in args.sizes.split(',') if size], args.images,
+                          media_gb=args.media_size)
+        tree_seconds = time.perf_counter() - started
+
+        # a fresh thumbnail cache, so that every image is rendered once
+        server = subprocess.Popen([sys.executable, SCRIPT, root, '-p', str(args.port), '-d', '127.0.0.1',
+                                   '--thumb_cache_dir', os.path.join(scratch, 'thumbnails')] + server_args,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(args.port, timeout=60)
+            scenarios = make_scenarios(tree, args.port, args.page_size)
+            results = {}
+            for name in selected:
+                if name not in scenarios:
+                    results[name] = {'skipped': 'no data (thumbnails need Pillow)'}
+                    continue
+                results[name] = Scenario(args.port, scenarios[name], args.clients, args.duration).run()
+                print(f'{name}: {results[name]["requests_per_second"]} req/s, '
+                      f'p99 {results[name]["latency_ms"]["p99"]} ms', file=sys.stderr)
+        finally:
+            server.terminate()
+            _, _, usage = os.wait4(server.pid, 0)
+
+    report = {
+        'config': {
+            'server_args': server_args,
+            'clients': args.clients,
+            'duration': args.duration,
+            'sizes': sorted(tree['folders']),
+            'images': len(tree['images']),
+            'media_size_gb': args.media_size,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'tree_seconds': round(tree_seconds, 1),
+        },
+        'server_cpu_seconds': round(usage.ru_utime + usage.ru_stime, 2),
+        'scenarios': results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Compare full-file and ranged download throughput with and without sendfile(2).
+
+Starts mediabrowser.py twice on a scratch folder holding one large file, once with
+the default zero-copy path and once with --no_sendfile, downloads the file a few
+times and reports the throughput together with the CPU time the server used.
+
+    python3 bench/sendfile_throughput.py --size 4 --runs 3
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'mediabrowser.py')
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'server did not start on port {port}')
+
+
+def download(port, path, byte_range=None):
+    """GET path and discard the body; returns the number of body bytes received."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    request = f'GET {path} HTTP/1.0\r\nHost: 127.0.0.1\r\n'
+    if byte_range:
+        request += f'Range: bytes={byte_range[0]}-{byte_range[1]}\r\n'
+    sock.sendall((request + '\r\n').encode())
+
+    buf = bytearray(1 << 20)
+    view = memoryview(buf)
+    received = 0
+    header_end = -1
+    head = b''
+    while True:
+        n = sock.recv_into(view)
+        if not n:
+            break
+        if header_end < 0:
+            head += bytes(view[:n])
+            header_end = head.find(b'\r\n\r\n')
+            if header_end >= 0:
+                received += len(head) - header_end - 4
+        else:
+            received += n
+    sock.close()
+    return received
+
+
+def run_mode(webroot, file_name, file_size, port, runs, extra_args):
+    server = subprocess.Popen([sys.executable, SCRIPT, webroot, '-p', str(port), '-d', '127.0.0.1',
+                               '--thumb_workers', '0', '--thumb_cache_size', '0'] + extra_args,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+
+        started = time.perf_counter()
+        total = 0
+        for _ in range(runs):
+            total += download(port, '/' + file_name)
+        full_seconds = time.perf_counter() - started
+
+        # the second half of the file in 8 MB ranges, like a player seeking and buffering
+        chunk = 8 << 20
+        started = time.perf_counter()
+        ranged = 0
+        for offset in range(file_size // 2, file_size, chunk):
+            ranged += download(port, '/' + file_name, (offset, min(offset + chunk, file_size) - 1))
+        range_seconds = time.perf_counter() - started
+    finally:
+        server.terminate()
+        _, _, usage = os.wait4(server.pid, 0)
+
+    return {
+        'full_file_mb_s': round(total / full_seconds / (1 << 20), 1),
+        'ranged_mb_s': round(ranged / range_seconds / (1 << 20), 1),
+        'server_cpu_s': round(usage.ru_utime + usage.ru_stime, 2),
+        'bytes_sent': total + ranged,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', help='file size in GB (default: %(default)s)', type=float, default=2)
+    parser.add_argument('--runs', help='full downloads per mode (default: %(default)s)', type=int, default=3)
+    parser.add_argument('--port', help='port to run the server on (default: %(default)s)', type=int, default=18765)
+    parser.add_argument('--dense', help='write real data instead of creating a sparse file', action='store_true')
+    args = parser.parse_args()
+
+    file_size = int(args.size * (1 << 30))
+
+    with tempfile.TemporaryDirectory(prefix='mediabro-bench-') as webroot:
+        file_name = 'big.mp4'
+        with open(os.path.join(webroot, file_name), 'wb') as f:
+            if args.dense:
+                block = os.urandom(1 << 20)
+                for _ in range(file_size >> 20):
+                    f.write(block)
+                file_size = f.tell()
+            else:
+                f.truncate(file_size)
+
+        results = {
+            'file_size': file_size,
+            'sendfile': run_mode(webroot, file_name, file_size, args.port, args.runs, []),
+            'buffered': run_mode(webroot, file_name, file_size, args.port, args.runs, ['--no_sendfile']),
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Generate a synthetic web root for the benchmarks.
+
+The tree holds folders with many small media files, a set of JPEG images, sparse
+media files of several GB (which take no disk space) and a small music library
+for playlists:
+
+    files_1000/  files_10000/  files_100000/   empty track_NNNNNN.mp3 files
+    images/                                     img_NNNN.jpg, needs Pillow
+    media/                                      movie_N.mp4, sparse
+    library/artist_N/album_N/                   track_NN.mp3
+
+    python3 bench/synthetic_tree.py /tmp/mediabro-tree --sizes 1000,10000 --images 100
+"""
+
+import argparse
+import json
+import os
+import random
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+def make_file_folder(root, count):
+    """A folder with count empty .mp3 files; returns its name."""
+    name = f'files_{count}'
+    folder = os.path.join(root, name)
+    os.makedirs(folder, exist_ok=True)
+    existing = set(os.listdir(folder))
+    for i in range(count):
+        file_name = f'track_{i:06}.mp3'
+        if file_name not in existing:
+            open(os.path.join(folder, file_name), 'wb').close()
+    return name
+
+
+def make_images(root, count, size=(1600, 1200)):
+    """count JPEG images of size with random noise, so that they don't compress to nothing.
+
+    Returns the image paths relative to root, or [] without Pillow.
+    """
+    if Image is None or not count:
+        return []
+    folder = os.path.join(root, 'images')
+    os.makedirs(folder, exist_ok=True)
+    # one noise tile, shifted per image so that no two images are the same
+    tile = Image.frombytes('RGB', (256, 256), os.urandom(256 * 256 * 3))
+    names = []
+    for i in range(count):
+        name = f'img_{i:04}.jpg'
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            image = Image.new('RGB', size, (i * 37 % 256, i * 91 % 256, i * 53 % 256))
+            for x in range(0, size[0], 512):
+                for y in range(0, size[1], 512):
+                    image.paste(tile, (x + i % 256, y))
+            image.save(path, quality=85)
+        names.append(f'images/{name}')
+    return names
+
+
+def make_sparse_media(root, count, size_gb):
+    """count sparse .mp4 files of size_gb each; returns [(relative path, size)]."""
+    folder = os.path.join(root, 'media')
+    os.makedirs(folder, exist_ok=True)
+    size = int(size_gb * (1 << 30))
+    files = []
+    for i in range(count):
+        path = os.path.join(folder, f'movie_{i}.mp4')
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        files.append((f'media/movie_{i}.mp4', size))
+    return files
+
+
+def make_library(root, artists=20, albums=5, tracks=12):
+    """A music library of artists/albums/tracks with small files, for recursive playlists."""
+    for artist in range(artists):
+        for album in range(albums):
+            folder = os.path.join(root, 'library', f'artist_{artist:02}', f'album_{album}')
+            os.makedirs(folder, exist_ok=True)
+            for track in range(tracks):
+                path = os.path.join(folder, f'track_{track:02}.mp3')
+                if not os.path.exists(path):
+                    with open(path, 'wb') as f:
+                        f.write(random.randbytes(4096))
+    return 'library'
+
+
+def build_tree(root, sizes=DEFAULT_SIZES, images=200, media=2, media_gb=4.0):
+    """Create (or complete) the benchmark tree below root; returns a description of what is where."""
+    os.makedirs(root, exist_ok=True)
+    return {
+        'root': root,
+        'folders': {count: make_file_folder(root, count) for count in sizes},
+        'images': make_images(root, images),
+        'media': make_sparse_media(root, media, media_gb),
+        'library': make_library(root),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help='folder to create the tree in')
+    parser.add_argument('--sizes', help='file counts of the flat folders (default: %(default)s)',
+                        default=','.join(map(str, DEFAULT_SIZES)))
+    parser.add_argument('--images', help='number of JPEG images (default: %(default)s)', type=int, default=200)
+    parser.add_argument('--media', help='number of sparse media files (default: %(default)s)', type=int, default=2)
+    parser.add_argument('--media_size', help='size of each media file in GB (default: %(default)s)',
+                        type=float, default=4.0)
+    args = parser.parse_args()
+
+    tree = build_tree(args.root, [int(size) for size in args.sizes.split(',') if size],
+                      args.images, args.media, args.media_size)
+    print(json.dumps({key: value if key != 'images' else len(value) for key, value in tree.items()}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
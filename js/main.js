@@ -12,8 +12,8 @@ const _MB_FILTER = 'mb_filter';
 const REGEX_TYPE_AUDIO = /\.(mp3|m4a|aac|flac|ape|wav|ogg|oga)$/i;
 const REGEX_TYPE_VIDEO = /\.(mp4|m4v|avi|mov|mpg|mpeg|webm|ogv|ogm|opus|mkv)/i;
 const REGEX_TYPE_AUDIO_VIDEO = /(mp3|m4a|aac|flac|ape|wav|ogg|oga|ogv|mp4|m4v|avi|mov|mpg|mpeg|webm|mkv)$/i;
-const REGEX_TYPE_IMAGE = /\.(gif|jpe?g|a?png|tiff?|bmp|eps|pcx|webp|ico|psd|xpm|wmf|svg|heic)$/i;
-const REGEX_TYPE_CONTENT = /\.(pdf|html?|md|php|asp|js|py|sh|xml|txt|bat|docx?|xlsx?|s?css|java|c|log|rc|cpp|h|hpp|srt|vtt|cfg|conf|ini|gif|jpe?g|a?png|tiff?|bmp|eps|pcx|webp|ico|psd|xpm|wmf|svg|cs|pl)$/i;
+const REGEX_TYPE_IMAGE = /\.(gif|jpe?g|a?png|tiff?|bmp|eps|pcx|webp|avif|ico|psd|xpm|wmf|svg|heic|heif)$/i;
+const REGEX_TYPE_CONTENT = /\.(pdf|html?|md|php|asp|js|py|sh|xml|txt|bat|docx?|xlsx?|s?css|java|c|log|rc|cpp|h|hpp|srt|vtt|cfg|conf|ini|gif|jpe?g|a?png|tiff?|bmp|eps|pcx|webp|avif|ico|psd|xpm|wmf|svg|cs|pl)$/i;
 const REGEX_TYPE_CODE = /\.(kt|go|ics|rst?|rb|dart|php|js|tsx?|py|cue|ipynb|z?sh|xml|plist|bat|css|json|java|c|cpp|h|m|hpp|conf|ini|pl|yaml|yml|groovy|swift|properties|gradle|srt|sql|lua|m3u8?)$/i;
 const REGEX_TYPE_MARKDOWN = /\.(md)$/i;
 
@@ -28,6 +28,7 @@ const ICON_BACK = "&#x21B0;" // ↰
 const ICON_TEXT = "&#x1F4C3;" // 📃
 const ICON_MISC = "&#x1F9E9;" // 🧩
 const ICON_MARKDOWN = "&#x1F17C;" // 🅼
+const ICON_ARCHIVE = "&#x1F4DA;" // 📚
 
 const ICONS_BY_TYPE = {
     'pdf': ICON_PDF,
@@ -59,15 +60,20 @@ const ICONS_BY_TYPE = {
     'mhtm': ICON_HTML,
     'php': ICON_HTML,
 
+    'avif': ICON_IMAGE,
     'bmp': ICON_IMAGE,
     'gif': ICON_IMAGE,
     'heic': ICON_IMAGE,
+    'heif': ICON_IMAGE,
     'jpeg': ICON_IMAGE,
     'jpg': ICON_IMAGE,
     'png': ICON_IMAGE,
     'svg': ICON_IMAGE,
     'webp': ICON_IMAGE,
 
+    'cbz': ICON_ARCHIVE,
+    'zip': ICON_ARCHIVE,
+
     'md': ICON_MARKDOWN,
 
     'cfg': ICON_TEXT,
@@ -121,21 +127,7 @@ const ICONS_BY_TYPE = {
 
 AUTO_PLAY_NEXT = true;
 
-const URL_TRANSFORMATIONS = [
-    // LINK REGEX                                        MATCHING LINK REPLACEMENT
-    [/clo_(\d{3}).*\.mp3/i, "../PDF/CLO_$1_Vocab.pdf"],
-    // chinesepod content links (pdf, html)
-    [/(.*chinesepod.*?)(?:_ex)?\.(pdf|html?)/i, "../$1pr.aac"],
-    // chinesepod media links (aac, mp3..)
-    [/(.*chinesepod.*?)(?:(dg|pr|rv))?\.(aac|mp3|m4a)/i, "pdf/$1\.pdf"],
-
-    // chinese pod collection
-    [/(.*?)pr+([^.]+)\.mp3/i, "$1$2.pdf"],
-    [/([^\s,-]+)\b([^.]+)\.(pdf)/i, "$1pr$2.mp3"]
-    // [/(.*).pdf/i,                     function (match, capture) {
-    //     return match.replace(/-/g, ' ') + ' ';
-    // }]
-];
+// URL_TRANSFORMATIONS of config.js are applied by the server, see fetchCompanions()
 
 const SKIP_INTROS = [
     [/rv\./i, 5],
@@ -183,10 +175,30 @@ if (isChrome) {
 }
 const HEIGHT_VIDEO = 500;
 
+// virtualized listing of big folders (see VirtualList)
+const VIRTUAL_PAGE_SIZE = 1000;
+const VIRTUAL_ROW_HEIGHT = 26;
+const VIRTUAL_IMAGE_ROW_HEIGHT = VIRTUAL_ROW_HEIGHT + 204;
+const VIRTUAL_OVERSCAN_PX = 600;
+
+// thumbnails refused while the server is busy (503) are requested again later
+const THUMBNAIL_RETRIES = 3;
+const THUMBNAIL_RETRY_DELAY_MS = 2000;
+
+// widths of the thumbnail size classes (&size=) and of the thumbnails on the page, as in mediabrowser.py
+const THUMBNAIL_WIDTHS = {s: 150, m: 300, l: 600};
+const THUMBNAIL_SIZES_ATTR = '(max-width: 767px) 400px, 300px';
+
 function playNext(e) {
     var href = window.lastClicked.attr('href');
 
     if (AUTO_PLAY_NEXT && href && isPlayableLink(href)) {
+        var virtualList = window.lastClicked.closest('ul.virtual-list').data('virtualList');
+        if (virtualList) {
+            virtualList.playNext(window.lastClicked);
+            return;
+        }
+
         var nextLink = window.lastClicked;
         do {
             nextLink = nextLink.closest('li').next('li').find('a');
@@ -202,72 +214,28 @@ function isPlayableLink(href) {
     return REGEX_TYPE_AUDIO.test(href) || REGEX_TYPE_VIDEO.test(href);
 }
 
-function findMatchingFileByExtension(path, extension_regex, isReturnMultiple) {
-
-    var pathUnescaped = decodeURIComponent(path),
-        baseName, parentDir;
+const COMPANIONS_JSON_SELECTOR = 'mediabro-companions.json';
+const SRT_AS_VTT_SELECTOR = 'mediabro-subtitles.vtt';
+const NO_COMPANIONS = {media: [], content: [], vtt: [], srt: []};
 
-    if (pathUnescaped.indexOf('/') !== -1) {
+// media, documents and subtitles that belong to a file (same base name or
+// a URL_TRANSFORMATIONS rule), as lists of {name, href} relative to its folder
+function fetchCompanions(path) {
+    var url = `${path.split('#')[0].split('?')[0]}?${COMPANIONS_JSON_SELECTOR}`;
 
-        baseName = pathUnescaped.split('/').pop();
-        parentDir = pathUnescaped.replace(baseName, '');
-    } else {
-        baseName = pathUnescaped;
-        parentDir = '';
-    }
-
-    // handle special cases
-    for (var i = 0, len = URL_TRANSFORMATIONS.length; i < len; i++) {
-        var item = URL_TRANSFORMATIONS[i];
-
-        var matcher = item[0].exec(path);
-
-        if (matcher) {
-            var matchedName = baseName.replace(item[0], item[1]);
-            if (matchedName !== baseName) {
-                return parentDir + matchedName;
-            }
-        }
-    }
-
-    // remove extension
-    var base_path = path.substring(0, path.lastIndexOf('.'));
-
-    // search for links fuzzy matching given URL
-    var matched = $("[href*='" + base_path + "' i]");
-
-    var media_entries = matched.filter(
-        function () {
-            return extension_regex.test(this);
-        }
-    );
-
-    if (media_entries.length) {
-        if (isReturnMultiple) {
-            return media_entries.filter(function () {
-                return this.href;
-            });
-        } else {
-            return media_entries[0].href || media_entries[0];
-        }
-    }
+    return fetch(url)
+        .then(resp => resp.ok ? resp.json() : NO_COMPANIONS)
+        .catch(function (err) {
+            console.log(`ERROR:COMPANIONS: ${url}`, err);
+            return NO_COMPANIONS;
+        });
 }
 
-function isValidUrl(url) {
-    var isOk = false;
-    $.ajax({
-        type: "HEAD",
-        async: false,
-        cache: false,
-        url: url
-    }).done(function (message, text, jqXHR) {
-        isOk = true;
-    }).fail(function () {
-        console.log(`ERROR:HEAD: ${url}`);
-    });
-
-    return isOk;
+function getCompanionHref(path, companion) {
+    // companion hrefs are relative to the folder of path
+    return path.substring(0, path.lastIndexOf('/') + 1) + companion.href;
 }
+
 function fullscreenOn(p) {
     var fs = p.requestFullscreen || p.webkitRequestFullscreen || p.mozRequestFullScreen || p.oRequestFullscreen || p.msRequestFullscreen;
     fs.call(p);
@@ -353,8 +321,8 @@ function attachEventListeners() {
         }
     };
 
-    // href clicks
-    $('a.fileinfo, a.imglnk, a.imglnk .preview img').click(function (e) {
+    // href clicks; delegated so that rows rendered later by VirtualList are covered too
+    $(document).on('click', 'a.fileinfo, a.imglnk', async function (e) {
         var $link;
 
         if (e.target.tagName !== 'A') {
@@ -386,6 +354,7 @@ function attachEventListeners() {
 
         // store the link for playNext()
         window.lastClicked = $link;
+        window.lastClickedIndex = $link.closest('li').data('index');
 
         $link.css({
             'color': '',
@@ -407,6 +376,12 @@ function attachEventListeners() {
             document.title = decodeURIComponent(goToDir);
             return false;
         }
+        var companions = await fetchCompanions(path);
+        if (window.lastClicked !== $link) {
+            // another link was clicked in the meantime
+            return;
+        }
+
         var mediaLink;
         var contentLink; // PDF or any other text file to be loaded into the frame
         var isMediaLinkClick;
@@ -419,10 +394,8 @@ function attachEventListeners() {
         if (path.match(REGEX_TYPE_CONTENT)) {
             contentLink = path;
 
-            var matched_file = findMatchingFileByExtension(path, REGEX_TYPE_AUDIO_VIDEO);
-
-            if (matched_file) {
-                inferredMediaLink = matched_file;
+            if (companions.media.length) {
+                inferredMediaLink = getCompanionHref(path, companions.media[0]);
 
                 if (inferredMediaLink.match(REGEX_TYPE_AUDIO)) {
                     isAudioDefined = true;
@@ -440,25 +413,16 @@ function attachEventListeners() {
             isVideoDefined = true;
         }
 
-        if (!mediaLink && inferredMediaLink && isValidUrl(inferredMediaLink)) {
+        if (!mediaLink && inferredMediaLink) {
             mediaLink = inferredMediaLink;
         }
 
         // when audio or Video file is clicked then try to find the corresponding content file
-        if (isMediaLinkClick) {
-            var partial_path = path
-                .replace('_video', '')
-                .replace('_review', '')
-                .replace('_dialog', '');
-
-            matched_file = findMatchingFileByExtension(partial_path, REGEX_TYPE_CONTENT);
-
-            if (matched_file) {
-                inferredContentLink = matched_file;
-            }
+        if (isMediaLinkClick && companions.content.length) {
+            inferredContentLink = getCompanionHref(path, companions.content[0]);
         }
 
-        if (!contentLink && inferredContentLink && isValidUrl(inferredContentLink)) {
+        if (!contentLink && inferredContentLink) {
             contentLink = inferredContentLink;
         }
 
@@ -490,16 +454,12 @@ function attachEventListeners() {
                     .show();
 
                 // ADD VTT SUBS
-                var vttLinks = findMatchingFileByExtension(mediaLink, /.*\.vtt/, true);
-
-                if (vttLinks) {
-                    addVttSubtitleTracks(vttLinks, $link);
+                if (companions.vtt.length) {
+                    addVttSubtitleTracks(companions.vtt, $link);
                 } else {
-                    var srtLinks = findMatchingFileByExtension(mediaLink, /.*\.srt/, true);
-
                     // ADD SRT SUBS if no VTT
-                    if (srtLinks) {
-                        addSRTSubtitleTracks(srtLinks, $link);
+                    if (companions.srt.length) {
+                        addSRTSubtitleTracks(companions.srt, $link);
                     }
 
                     videoplayer.empty();
@@ -696,117 +656,26 @@ function getTrackLabel(commonPrefix, mediaName) {
     return mediaName.replace(commonPrefix, '').replace('\.(mp4|m4v|ape|flac|wav|acc|mp3)', '').replace(/^[-._/=,]/, '');
 }
 
-function srtToVtt(srtRawData) {
-    // Replace line breaks with \n
-    srt = srtRawData.replace(/\r\n|\r|\n/g, '\n');
-    // Add WEBVTT header
-    srt = `WEBVTT
-
-STYLE
-::cue {
-color: #ffc800;
-border: 2px solid black;
-}
-::cue(b) {
-color: rgb(51, 216, 18);
-border: 2px solid black;
-}
-::cue(i) {
-color: #00bafd;
-}
-::cue(u) {
-text-decoration: none;
-color: #ff00ee;
-font-style: normal;
-}
-::cue(.w) {
-color: white;
-}
-::cue(.b) {
-color: aqua;
-}
-::cue(.p) {
-color: rgb(255, 0, 255);
-}
-
-` + srt;
-    // Replace commas with dots in timestamps
-    srt = srt.replace(/(\d\d:\d\d:\d\d),(\d\d\d)/g, '$1.$2');
-    // map of SRT font colors to VTT cue span classes
-    var colorMap = {
-        "ffffff": "w",
-        "00ffff": "b",
-        "d663fd": "p"
-    };
-    // Replace font tags with cue span tags using the map
-    srt = srt.replace(/<font color="#([0-9a-fA-F]{6})">([\s\S]*?)<\/font>/g, function (match, color, text) {
-        return `<c.${colorMap[color.toLowerCase()]}>${text.replace('\n','').trim()}</c>`;
-    });
-
-    srt = srt.replace(/<br\s*\/?>/g, '\n')
-
-    return new Blob([srt], { type: 'text/vtt' });
-}    
-
 function addVttSubtitleTracks(vttLinks, mediaLink) {
     videoplayer.empty();
     // strip extension
     var commonPrefix = getCommonPrefix(mediaLink);
     var meta = [];
 
-    vttLinks.each(function () {
-        var trackLabel = getTrackLabel(commonPrefix, this.dataset.name);
-        meta.push({ label: trackLabel, src: this.href });
+    vttLinks.forEach(function (vttLink) {
+        var trackLabel = getTrackLabel(commonPrefix, vttLink.name);
+        meta.push({ label: trackLabel, src: getCompanionHref(mediaLink.attr('href'), vttLink) });
     });
     // VTT_META is postprocessed on 'loadedmetadata'
     videoplayer.get(0).VTT_META = meta;
 }
 
 function addSRTSubtitleTracks(srtLinks, mediaLink) {
-    videoplayer.empty();
-    var commonPrefix = getCommonPrefix(mediaLink);
-    srtLinks.each(function () {
-        fetchConvertAttachSrt2Vtt(mediaLink, this, commonPrefix);
-    });
-}
-
-function fetchConvertAttachSrt2Vtt(mediaLink, srtEl, commonPrefix) {
-    var srtUrl = srtEl.href;
-    var srtName = srtEl.dataset.name;
-    fetch(srtUrl)
-        .then(function (response) {
-            if (response.ok) {
-                return response.text();
-            } else {
-                throw new Error(`Failed to fetch file: ${response.statusText}`);
-            }
-        })
-        .then(function (srt) {
-            var vtt = srtToVtt(srt);
-            // Create a URL for the VTT Blob object
-            var vttUrl = URL.createObjectURL(vtt);
-            // Create a new track element
-            var track = document.createElement('track');
-            // Set the attributes of the track element
-            track.kind = 'subtitles';
-            var trackLabel = getTrackLabel(commonPrefix, srtName);
-            track.label = trackLabel || ':Default:';
-            track.srclang = 'en';
-            track.src = vttUrl;
-            
-            if (!window.haveDefaultSubtitleTrack) {
-                track.default = true;
-                window.haveDefaultSubtitleTrack = true;
-            }
-
-            // Append the track element to the video element
-            videoplayer.append(track);
-        })
-        .catch(function (error) {
-            // Log the error
-            console.error(error);
-        });
-
+    // the server converts SRT to WebVTT, so the tracks load like VTT files
+    addVttSubtitleTracks(srtLinks.map(srtLink => ({
+        name: srtLink.name,
+        href: `${srtLink.href}?${SRT_AS_VTT_SELECTOR}`
+    })), mediaLink);
 }
 
 function getPath() {
@@ -850,6 +719,227 @@ function getUrlMetadata() {
     };
 }
 
+function escapeHtml(text) {
+    return String(text)
+        .replace(/&/g, '&amp;')
+        .replace(/</g, '&lt;')
+        .replace(/>/g, '&gt;')
+        .replace(/"/g, '&quot;');
+}
+
+// same output as pretty_size() in mediabrowser.py
+function prettySize(octets) {
+    var units = [[Math.pow(2, 40), ' TB'], [Math.pow(2, 30), ' GB'], [Math.pow(2, 20), ' MB'], [1024, ' KB'], [1, ' b']];
+    for (var i = 0; i < units.length - 1; i++) {
+        if (octets >= units[i][0]) {
+            break;
+        }
+    }
+    return Math.floor(octets / units[i][0]) + units[i][1];
+}
+
+// same as format_duration() in mediabrowser.py
+function prettyDuration(seconds) {
+    seconds = Math.round(seconds);
+    var hours = Math.floor(seconds / 3600), minutes = Math.floor(seconds / 60) % 60;
+    var pad = n => String(n).padStart(2, '0');
+    return hours ? `${hours}:${pad(minutes)}:${pad(seconds % 60)}` : `${minutes}:${pad(seconds % 60)}`;
+}
+
+function getExtension(name) {
+    var pos = name.lastIndexOf('.');
+    return pos > 0 ? name.slice(pos + 1).toLowerCase() : name;
+}
+
+function getScrollParent(el) {
+    for (var p = el.parentElement; p; p = p.parentElement) {
+        var overflowY = getComputedStyle(p).overflowY;
+        if (overflowY === 'auto' || overflowY === 'scroll') {
+            return p;
+        }
+    }
+    return document.scrollingElement;
+}
+
+/*
+ * Renders the listing of a big folder from the paginated JSON listing API.
+ * Pages are fetched one after the other in the background, and only the rows
+ * around the visible part of the list exist in the DOM.
+ */
+function VirtualList(ul) {
+    this.ul = ul;
+    this.src = ul.dataset.src;
+    this.dir = ul.dataset.dir;
+    this.total = parseInt(ul.dataset.total, 10) || 0;
+    this.suppressSize = ul.dataset.suppressSize === '1';
+    this.entries = [];
+    this.offsets = [0]; // offsets[i] is the top of row i, offsets[entries.length] the height of the loaded rows
+    this.renderedRange = null;
+    this.scroller = getScrollParent(ul);
+
+    var self = this;
+    var scheduled = false;
+    $(this.scroller).on('scroll', function () {
+        if (!scheduled) {
+            scheduled = true;
+            window.requestAnimationFrame(function () {
+                scheduled = false;
+                self.render();
+            });
+        }
+    });
+    $(window).on('resize', function () {
+        self.render(true);
+    });
+    $(ul).data('virtualList', this);
+}
+
+VirtualList.prototype.load = function (cursor) {
+    var self = this;
+    var url = `${this.src}&limit=${VIRTUAL_PAGE_SIZE}` + (cursor ? `&cursor=${encodeURIComponent(cursor)}` : '');
+
+    return fetch(url)
+        .then(resp => resp.json())
+        .then(function (page) {
+            self.total = page.total;
+            page.entries.forEach(function (entry) {
+                self.entries.push(entry);
+                self.offsets.push(self.offsets[self.offsets.length - 1] + self.rowHeight(entry));
+            });
+            self.render(true);
+
+            if (page.next_cursor) {
+                return self.load(page.next_cursor);
+            }
+        })
+        .catch(function (error) {
+            console.error(error);
+        });
+};
+
+VirtualList.prototype.rowHeight = function (entry) {
+    return entry.image ? VIRTUAL_IMAGE_ROW_HEIGHT : VIRTUAL_ROW_HEIGHT;
+};
+
+// index of the row containing pixel offset y
+VirtualList.prototype.indexAt = function (y) {
+    var lo = 0, hi = this.entries.length - 1;
+    while (lo < hi) {
+        var mid = (lo + hi + 1) >> 1;
+        if (this.offsets[mid] <= y) {
+            lo = mid;
+        } else {
+            hi = mid - 1;
+        }
+    }
+    return Math.max(0, lo);
+};
+
+// top of the list relative to the scrolled content
+VirtualList.prototype.listTop = function () {
+    return this.ul.getBoundingClientRect().top - this.scroller.getBoundingClientRect().top + this.scroller.scrollTop;
+};
+
+VirtualList.prototype.render = function (force) {
+    var loadedHeight = this.offsets[this.entries.length];
+    var pendingRows = Math.max(0, this.total - this.entries.length);
+    this.ul.style.height = `${loadedHeight + pendingRows * VIRTUAL_ROW_HEIGHT}px`;
+
+    if (!this.entries.length) {
+        return;
+    }
+
+    var scrolled = this.scroller.scrollTop - this.listTop();
+    var top = scrolled - VIRTUAL_OVERSCAN_PX;
+    var bottom = scrolled + this.scroller.clientHeight + VIRTUAL_OVERSCAN_PX;
+    var first = this.indexAt(top);
+    var last = this.indexAt(bottom);
+
+    if (!force && this.renderedRange && this.renderedRange[0] === first && this.renderedRange[1] === last) {
+        return;
+    }
+    this.renderedRange = [first, last];
+
+    var rows = [];
+    for (var i = first; i <= last; i++) {
+        rows.push(this.renderRow(i));
+    }
+    this.ul.innerHTML = rows.join('');
+
+    if (window.lastClickedIndex !== undefined) {
+        $(this.ul).find(`li[data-index="${window.lastClickedIndex}"] a.fileinfo`).css({
+            'color': '#ff7d12',
+            'font-weight': 'bold'
+        });
+    }
+};
+
+VirtualList.prototype.renderRow = function (i) {
+    var entry = this.entries[i];
+    var isDir = entry.type === 'dir';
+    // archives open like folders
+    var linkType = isDir || entry.archive ? 'dir' : entry.type;
+    var linkName = linkType === 'dir' ? `${entry.name}/` : entry.name;
+    var displayName = entry.symlink ? `${entry.name}@` : linkName;
+    var icon = isDir ? ICON_DIR : (ICONS_BY_TYPE[getExtension(entry.name)] || ICON_UNKNOWN);
+    displayName = `${icon}&nbsp;${escapeHtml(displayName)}`;
+    var quotedLink = encodeURIComponent(linkName).replace(/%2F/g, '/');
+    var fullName = escapeHtml(`${this.dir.replace(/\/$/, '')}/${entry.name}`);
+    var title = displayName, sizeInfo = '';
+
+    if (!isDir) {
+        var size = prettySize(entry.size);
+        title = `${displayName} [${size}]`;
+        sizeInfo = this.suppressSize ? '' : size;
+
+        if (entry.meta && entry.meta.duration) {
+            var duration = prettyDuration(entry.meta.duration);
+            title = `${displayName} [${size}, ${duration}]`;
+            sizeInfo = sizeInfo ? `${duration} &middot; ${sizeInfo}` : duration;
+        }
+    }
+
+    var preview = '';
+    if (entry.image) {
+        var srcset = Object.entries(THUMBNAIL_WIDTHS)
+            .map(([size, width]) => `${quotedLink}?${entry.thumb}&size=${size} ${width}w`).join(', ');
+        preview = `
+        <a class="imglnk" data-name="${fullName}" data-type="${linkType}" title="${title}" href="${quotedLink}">
+            <div class="preview">
+                <img loading="lazy" src="${quotedLink}?${entry.thumb}" srcset="${srcset}" sizes="${THUMBNAIL_SIZES_ATTR}">
+            </div>
+        </a>`;
+    }
+
+    return `<li data-index="${i}" style="top:${this.offsets[i]}px;height:${this.rowHeight(entry)}px">${preview}
+        <a class="fileinfo" data-name="${fullName}" data-type="${linkType}" title="${title}" href="${quotedLink}">
+            <span class="fname">${displayName}</span>
+            <span class="size">${sizeInfo}</span>
+        </a>
+    </li>`;
+};
+
+VirtualList.prototype.scrollToIndex = function (i) {
+    var top = this.listTop() + this.offsets[i];
+    if (top < this.scroller.scrollTop || top + VIRTUAL_ROW_HEIGHT > this.scroller.scrollTop + this.scroller.clientHeight) {
+        this.scroller.scrollTop = top;
+    }
+    this.render(true);
+};
+
+VirtualList.prototype.playNext = function ($link) {
+    var index = parseInt($link.closest('li').data('index'), 10);
+
+    for (var i = index + 1; i < this.entries.length; i++) {
+        var entry = this.entries[i];
+        if (entry.type === 'file' && isPlayableLink(entry.name)) {
+            this.scrollToIndex(i);
+            $(this.ul).find(`li[data-index="${i}"] a.fileinfo`).click();
+            return;
+        }
+    }
+};
+
 function isTrue(val) {
     return ["true", "1", "yes", "on"].indexOf(val) !== -1;
 }
@@ -917,6 +1007,25 @@ $(document).ready(function () {
     });
 
     attachEventListeners();
+
+    // error events don't bubble, so listen in the capture phase
+    document.addEventListener('error', function (e) {
+        var img = e.target;
+        if (img.tagName !== 'IMG' || img.src.indexOf('?mediabro-thumb.jpg') === -1) {
+            return;
+        }
+        var retries = Number(img.dataset.retries || 0);
+        if (retries < THUMBNAIL_RETRIES) {
+            img.dataset.retries = retries + 1;
+            setTimeout(function () {
+                img.src = img.src;
+            }, THUMBNAIL_RETRY_DELAY_MS * (retries + 1));
+        }
+    }, true);
+
+    $('ul.virtual-list').each(function () {
+        new VirtualList(this).load();
+    });
 });
 
 function makeFile(bytesOrString, fileName) {
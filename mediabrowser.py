@@ -56,26 +56,58 @@
 # added Range support:
 # https://github.com/danvk/RangeHTTPServer
 import argparse
+import codecs
+import gzip
+import hashlib
+import itertools
+import heapq
 import html
+import mimetypes
 import os
 import platform
 import posixpath
+import queue
+import random
 import re
+import signal
 import socket
 import socketserver
+import stat
+import struct
 import sys
-import webbrowser
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+import zlib
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from http.server import HTTPServer
 from http.server import SimpleHTTPRequestHandler
-from io import BytesIO
+from importlib.util import find_spec
+from io import BufferedIOBase, BytesIO, UnsupportedOperation
+from json import dumps as json_dumps, loads as json_loads
 from pathlib import Path
 from string import Template
-from urllib.parse import unquote, quote
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_left, bisect_right
+from urllib.parse import unquote, quote, parse_qs, urlsplit, urlunsplit
 
 try:
-    from PIL import Image, ExifTags
+    import brotli
 except ImportError:
-    Image = None
+    brotli = None
+
+# Pillow and charset_normalizer are slow to import and only some requests need them,
+# so they are only looked up here and imported on first use; so are asyncio (--engine asyncio),
+# concurrent.futures and multiprocessing (thumbnail rendering), sqlite3 (--index, --metadata) and zipfile
+HAVE_PIL = find_spec('PIL') is not None
+HAVE_CHARSET_NORMALIZER = find_spec('charset_normalizer') is not None
+# opens HEIC/HEIF images for Pillow
+HAVE_PILLOW_HEIF = find_spec('pillow_heif') is not None
 
 # https://emojipedia.org/
 
@@ -103,6 +135,7 @@ ICON_UNKNOWN = "&#x2753;"  # ❓
 ICON_BACK = "&#x21B0;"  # ↰
 ICON_TEXT = "&#x1F4C3;"  # 📃
 ICON_MISC = "&#x1F9E9;"  # 🧩
+ICON_ARCHIVE = "&#x1F4DA;"  # 📚
 ICON_MARKDOWN = "&#x1F17C;"  # 🅼
 
 ICONS_BY_TYPE = {
@@ -135,15 +168,20 @@ ICONS_BY_TYPE = {
     'mhtm': ICON_HTML,
     'php': ICON_HTML,
 
+    'avif': ICON_IMAGE,
     'bmp': ICON_IMAGE,
     'gif': ICON_IMAGE,
     'heic': ICON_IMAGE,
+    'heif': ICON_IMAGE,
     'jpeg': ICON_IMAGE,
     'jpg': ICON_IMAGE,
     'png': ICON_IMAGE,
     'svg': ICON_IMAGE,
     'webp': ICON_IMAGE,
 
+    'cbz': ICON_ARCHIVE,
+    'zip': ICON_ARCHIVE,
+
     'md': ICON_MARKDOWN,
 
     'cfg': ICON_TEXT,
@@ -203,12 +241,154 @@ MIME_TYPES_FORCE_TEXT_PLAIN = ('pl', 'php', 'Makefile', 'Caddyfile', 'LICENSE')
 MBFACTOR = float(1 << 20)
 
 MEDIALIST_M3U = 'medialist.m3u'
+MEDIALIST_M3U8 = 'medialist.m3u8'
+# both names serve the same UTF-8 playlist
+MEDIALIST_NAMES = (MEDIALIST_M3U, MEDIALIST_M3U8)
+# playlist entries looked up in the metadata cache at a time
+PLAYLIST_BATCH = 256
 IMG_THUMBNAIL_SELECTOR = '?mediabro-thumb.jpg'
+# bounding boxes of the thumbnail size classes, picked with &size=; listings offer them all
+# in a srcset, so that high-DPI screens get sharp thumbnails and small ones get small files
+THUMBNAIL_SIZES = {'s': (150, 100), 'm': (300, 200), 'l': (600, 400)}
+# the size class without &size=
+THUMBNAIL_SIZE = THUMBNAIL_SIZES['m']
+# the width of the thumbnails on the page, for the browser to choose from the srcset
+THUMBNAIL_SIZES_ATTR = '(max-width: 767px) 400px, 300px'
+# thumbnail formats: content type and Pillow save options; see --thumb_formats
+THUMBNAIL_FORMATS = {
+    'avif': ('image/avif', {'format': 'AVIF', 'quality': 50, 'speed': 8}),
+    'webp': ('image/webp', {'format': 'WEBP', 'quality': 50, 'method': 4}),
+    'jpeg': ('image/jpeg', {'format': 'JPEG', 'quality': 50}),
+}
+# PNGs and GIFs up to this size that fit into the size class are served as they are
+THUMBNAIL_PASSTHROUGH_SIZE = 32 * 1024
+# JSON snapshot of the caches and worker pools, for tuning
+STATS_PATH = '/__stats'
+# request latencies, bytes sent and cache hit ratios in the Prometheus text format
+METRICS_PATH = '/__metrics'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# access log records waiting for the writer thread; more are dropped
+ACCESS_LOG_QUEUE = 10000
+ACCESS_LOG_LEVELS = ('debug', 'info', 'warning', 'error', 'off')
+
+# paginated JSON folder listing, e.g. /music/?mediabro-list.json&limit=500&sort=mtime&order=desc
+LIST_JSON_SELECTOR = 'mediabro-list.json'
+LIST_JSON_DEFAULT_LIMIT = 500
+LIST_JSON_MAX_LIMIT = 5000
+# folders with more entries than this are loaded by the browser page by page
+DEFAULT_VIRTUAL_LIST_THRESHOLD = 1000
+
+# recursive index of all files below the web root (see MediaIndex)
+USER_INDEX_JSON = '/index.json'
+DEFAULT_INDEX_INTERVAL = 600
+# file name search over the index, e.g. /search?q=lecture+04&type=media&offset=0&limit=50
+SEARCH_PATH = '/search'
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 1000
+# endpoints of the server itself, by their route name in the metrics and the access log
+SERVER_ROUTES = {STATS_PATH: 'stats', METRICS_PATH: 'metrics', USER_INDEX_JSON: 'index', SEARCH_PATH: 'search'}
+
+# media, documents and subtitles belonging to a file, e.g. /lessons/01.mp3?mediabro-companions.json
+COMPANIONS_JSON_SELECTOR = 'mediabro-companions.json'
+# suffixes of media names that the matching document name lacks, e.g. lesson_video.mp4 -> lesson.pdf
+COMPANION_CONTENT_STRIP = ('_video', '_review', '_dialog')
+
+# an SRT file converted to WebVTT for the <track> element, e.g. /movies/film.en.srt?mediabro-subtitles.vtt
+SRT_AS_VTT_SELECTOR = 'mediabro-subtitles.vtt'
+VTT_HEADER = b"""WEBVTT
+
+STYLE
+::cue {
+color: #ffc800;
+border: 2px solid black;
+}
+::cue(b) {
+color: rgb(51, 216, 18);
+border: 2px solid black;
+}
+::cue(i) {
+color: #00bafd;
+}
+::cue(u) {
+text-decoration: none;
+color: #ff00ee;
+font-style: normal;
+}
+::cue(.w) {
+color: white;
+}
+::cue(.b) {
+color: aqua;
+}
+::cue(.p) {
+color: rgb(255, 0, 255);
+}
 
-REGEX_BYTE_RANGE = re.compile(r'bytes=(\d+)-(\d+)?$')
+"""
+# cue classes of the VTT_HEADER styles for SRT font colors
+SRT_COLOR_CLASSES = {'ffffff': 'w', '00ffff': 'b', 'd663fd': 'p'}
+REGEX_SRT_TIMESTAMP = re.compile(r'(\d+:\d\d:\d\d)[,.](\d{1,3})')
+REGEX_SRT_FONT_COLOR = re.compile(r'<font color="#([0-9a-fA-F]{6})">([\s\S]*?)</font>')
+REGEX_SRT_LINE_BREAK = re.compile(r'<br\s*/?>')
+# bytes of a subtitle file looked at to guess its encoding
+SUBTITLE_SNIFF_SIZE = 64 * 1024
+# memory for converted subtitles, and the largest one kept
+SUBTITLE_CACHE_SIZE = 16 << 20
+SUBTITLE_CACHE_MAX_ENTRY = 2 << 20
+
+# default byte budget of the on-disk thumbnail cache, in megabytes
+DEFAULT_THUMB_CACHE_SIZE = 512
+
+REGEX_CONTENT_LENGTH = re.compile(rb'^content-length:[ \t]*(\d+)[ \t]*\r?$', re.IGNORECASE | re.MULTILINE)
+REGEX_CHUNKED_REQUEST = re.compile(rb'^transfer-encoding:.*chunked', re.IGNORECASE | re.MULTILINE)
+REGEX_BYTE_RANGE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+# more ranges than this (after merging overlaps) are answered with the full file
+MAX_BYTE_RANGES = 32
 REGEX_INTERNAL_FILE = re.compile("^/(css|js|ico)/.*\.(css|js|png|ico|xml|json)$", re.IGNORECASE)
+# support files worth compressing; images are compressed already
+REGEX_COMPRESSIBLE_ASSET = re.compile(r"\.(css|js|json|xml|html?|svg)$", re.IGNORECASE)
+# links to support files in mediabro.html, which get a ?v= version parameter
+REGEX_ASSET_LINK = re.compile(r'((?:src|href)=")(/(?:css|js|ico)/[^"?#]+)(")')
+# support file URLs with the current ?v= are cached by browsers for good
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# content codings for generated responses (listings, playlists, JSON), in order of preference
+COMPRESSED_ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+COMPRESS_SLICE_SIZE = 64 * 1024
 REGEX_MEDIA_FILE = re.compile("\.(3gp|3gpp|aac|aiff|avi|mov|mp1|mp2|mp3|mp4|m4a|vob|mkv|flac|m4v|mpeg|mpg|oga|ogg|ogv|ogm|wav|webm|wma|wmv)$", re.IGNORECASE)
-REGEX_IMAGE_FILE = re.compile("\.(gif|jpg|jpeg|apng|png|tif|tiff|bmp|eps|pcx|webp|ico|icns|psd|xpm|wmf)$", re.IGNORECASE)
+REGEX_IMAGE_FILE = re.compile("\.(gif|jpg|jpeg|apng|png|tif|tiff|bmp|eps|pcx|webp|avif|ico|icns|psd|xpm|wmf%s)$"
+                              % ('|heic|heif' if HAVE_PILLOW_HEIF else ''), re.IGNORECASE)
+# ZIP archives (comic books included) are browsed like folders, e.g. /comics/issue1.cbz/page01.jpg
+REGEX_ARCHIVE_FILE = re.compile(r"\.(zip|cbz)$", re.IGNORECASE)
+REGEX_ARCHIVE_PATH = re.compile(r"\.(zip|cbz)(?=[/\\])", re.IGNORECASE)
+# archives whose central directory is kept in memory
+ARCHIVE_INDEX_CACHE_SIZE = 64
+ARCHIVE_READ_SIZE = 256 * 1024
+# /folder/?download=zip streams the folder as a ZIP archive; a POST of name=... fields picks some of its entries
+DOWNLOAD_ZIP_QUERY = 'download=zip'
+# largest form of a POSTed selection, in bytes
+DOWNLOAD_ZIP_MAX_FORM = 1 << 20
+# larger folders are refused, so that a download of the web root can't stream a whole disk
+DEFAULT_ZIP_MAX_FILES = 10000
+DEFAULT_ZIP_MAX_SIZE = 16384
+# compressed already, stored in ZIP downloads as they are (like media, images and archives)
+REGEX_COMPRESSED_FILE = re.compile(r"\.(pdf|gz|tgz|bz2|xz|zst|7z|rar|cbr|epub|docx|xlsx|pptx|odt|ods|jar|apk|iso|dmg|"
+                                   r"heic|avif|jxl|opus|m4b)$", re.IGNORECASE)
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_FLAG_UTF8 = 0x800
+# compression methods, as in zipfile
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+# DOS timestamps start in 1980
+ZIP_EPOCH = 315532800 + 86400
+# same as REGEX_TYPE_AUDIO_VIDEO and REGEX_TYPE_CONTENT in main.js
+REGEX_COMPANION_MEDIA = re.compile(r"\.(mp3|m4a|aac|flac|ape|wav|ogg|oga|ogv|mp4|m4v|avi|mov|mpg|mpeg|webm|mkv)$", re.IGNORECASE)
+REGEX_COMPANION_CONTENT = re.compile(r"\.(pdf|html?|md|php|asp|js|py|sh|xml|txt|bat|docx?|xlsx?|s?css|java|c|log|rc|cpp|h|hpp|cfg|conf|ini|gif|jpe?g|a?png|tiff?|bmp|eps|pcx|webp|ico|psd|xpm|wmf|svg|cs|pl)$", re.IGNORECASE)
+# [/regex/flags, "replacement"] entries of URL_TRANSFORMATIONS in config.js
+REGEX_JS_URL_TRANSFORMATION = re.compile(r"""^\s*\[\s*/((?:\\.|\[(?:\\.|[^\]\\])*\]|[^/\\\[])+)/([a-z]*)\s*,\s*(["'])((?:\\.|(?!\3).)*)\3\s*\]""")
+REGEX_JS_REPLACEMENT_TOKEN = re.compile(r'\$(\$|&|\d{1,2}|<\w+>)')
 
 
 def get_script_dir():
@@ -221,22 +401,936 @@ def get_script_dir():
     return dir_
 
 
-def make_thumbnail(image_path, size):
-    img = Image.open(image_path)
-    img = fix_image_orientation(img)
+def get_cache_dir():
+    """Per-user cache folder following the platform conventions."""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'mediabrowser')
+
+
+class ThumbnailCache:
+    """Persistent on-disk store of rendered thumbnails bounded by a byte budget.
+
+    Entries are keyed by source path, thumbnail size, source mtime and source size,
+    so an edited image simply misses and its stale entry ages out. Recency is kept
+    in memory and mirrored into the file mtimes, which lets a restarted server
+    rebuild the LRU order with a single directory scan.
+
+    With shared=True several server processes use the folder at once: entries
+    written by the others are picked up on a miss, and the in-memory view is
+    rebuilt from the folder every SHARED_RESCAN_INTERVAL seconds so that the
+    budget holds for all of them together.
+    """
+
+    SHARED_RESCAN_INTERVAL = 300
+    # younger temp files may still be written by another process
+    STALE_TMP_SECONDS = 60
+
+    def __init__(self, cache_dir, max_bytes, shared=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> size in bytes; least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.last_scan = time.monotonic()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def make_key(image_path, size, st, fmt='jpeg'):
+        raw = f'{image_path}\0{size[0]}x{size[1]}\0{st.st_mtime_ns}\0{st.st_size}'
+        if fmt != 'jpeg':
+            # JPEG thumbnails keep the keys they had before there were other formats
+            raw += f'\0{fmt}'
+        return hashlib.sha1(raw.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def _entry_path(self, key):
+        # fan out into 256 sub folders to keep directories small; the .jpg is historic,
+        # entries of all formats are named so
+        return os.path.join(self.cache_dir, key[:2], key + '.jpg')
+
+    def _load(self):
+        found = []
+        now = time.time()
+        for bucket in os.scandir(self.cache_dir):
+            if not bucket.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(bucket.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    # leftover of an interrupted write
+                    if now - st.st_mtime > self.STALE_TMP_SECONDS:
+                        try:
+                            os.unlink(entry.path)
+                        except OSError:
+                            pass
+                elif entry.name.endswith('.jpg'):
+                    found.append((st.st_mtime, entry.name[:-4], st.st_size))
+
+        entries = OrderedDict((key, size) for _, key, size in sorted(found))
+        with self.lock:
+            self.entries = entries
+            self.total_bytes = sum(entries.values())
+            self._evict()
+
+    def get(self, key):
+        """Return the path of a cached thumbnail or None on a miss."""
+        path = self._entry_path(key)
+        with self.lock:
+            known = key in self.entries
+            if known:
+                self.entries.move_to_end(key)
+                self.hits += 1
+
+        if not known:
+            try:
+                # written by another server process?
+                size = os.stat(path).st_size if self.shared else None
+            except OSError:
+                size = None
+            with self.lock:
+                if size is None:
+                    self.misses += 1
+                    return None
+                self.total_bytes += size - self.entries.pop(key, 0)
+                self.entries[key] = size
+                self.hits += 1
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # removed behind our back (manual cleanup or another process)
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            return None
+        return path
+
+    def contains(self, key):
+        """Membership test that neither counts as a hit nor refreshes recency."""
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, data):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temp file in the same folder, then rename: readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self._evict()
+            rescan = self.shared and time.monotonic() - self.last_scan > self.SHARED_RESCAN_INTERVAL
+            if rescan:
+                self.last_scan = time.monotonic()
+        if rescan:
+            self._load()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.unlink(self._entry_path(key))
+            except OSError:
+                pass
+
+
+def _thumbnail_worker_init():
+    # Ctrl-C is handled by the server process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _render_thumbnail_job(image_path, size, fmt):
+    """Runs in a pool worker; returns the thumbnail bytes, the time spent rendering and the part spent decoding."""
+    started = time.perf_counter()
+    thumbnail_binary, decode_seconds = make_thumbnail(image_path, size, fmt)
+    return thumbnail_binary, time.perf_counter() - started, decode_seconds
+
+
+class ThumbnailRenderer:
+    """Renders thumbnails on a bounded process pool, outside of the GIL of the server.
+
+    Concurrent requests for the same thumbnail share one job. With max_workers=0
+    thumbnails are rendered inline on the requesting thread. Images that fail to
+    render (corrupt, unsupported, too big) are remembered by path, mtime and size,
+    so that they are not decoded again until they change.
+    """
+
+    LATENCY_SAMPLES = 1000
+    MAX_FAILED_IMAGES = 4096
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.executor = None  # started with the first job
+        self.in_flight = {}  # key -> Future of (bytes, render seconds, decode seconds)
+        self.submitted = 0
+        self.shared = 0
+        self.failed = 0
+        self.failed_images = OrderedDict()  # (path, mtime, size) of images that failed; oldest first
+        # (total seconds from submit to result, seconds spent rendering) of recent jobs
+        self.latencies = deque(maxlen=self.LATENCY_SAMPLES)
+
+    def _new_executor(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # plain forked workers would inherit the listening socket and keep the port bound
+        # after the server exits
+        mp_context = None
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('forkserver')
+        return ProcessPoolExecutor(self.max_workers, mp_context=mp_context, initializer=_thumbnail_worker_init)
+
+    def render(self, key, image_path, size, fmt='jpeg'):
+        """Thumbnail bytes for image_path; blocks until rendered.
+
+        Returns (thumbnail bytes, True if this call started the job). Only the
+        caller that started the job should store the result.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future, submitted_at = self._submit(key, image_path, size, fmt)
+            else:
+                self.shared += 1
+
+        if is_owner:
+            # outside of self.lock: a job that is done already runs _job_done right here
+            future.add_done_callback(lambda f: self._job_done(key, submitted_at, f))
+            if not self.executor:
+                self._run_inline(future, image_path, size, fmt)
+
+        return future.result()[0], is_owner
+
+    def _submit(self, key, image_path, size, fmt):
+        self.submitted += 1
+        submitted_at = time.perf_counter()
+
+        if self.max_workers > 0:
+            from concurrent.futures.process import BrokenProcessPool
+
+            if self.executor is None:
+                self.executor = self._new_executor()
+            try:
+                future = self.executor.submit(_render_thumbnail_job, image_path, size, fmt)
+            except BrokenProcessPool:
+                # a worker died (e.g. killed by the OOM killer); start over with a fresh pool
+                self.executor = self._new_executor()
+                future = self.executor.submit(_render_thumbnail_job, image_path, size, fmt)
+        else:
+            from concurrent.futures import Future
+
+            future = Future()
+
+        self.in_flight[key] = future
+        return future, submitted_at
+
+    @staticmethod
+    def _run_inline(future, image_path, size, fmt):
+        try:
+            future.set_result(_render_thumbnail_job(image_path, size, fmt))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _job_done(self, key, submitted_at, future):
+        with self.lock:
+            self.in_flight.pop(key, None)
+            if future.exception():
+                self.failed += 1
+            else:
+                _, render_seconds, decode_seconds = future.result()
+                self.latencies.append((time.perf_counter() - submitted_at, render_seconds))
+                server_metrics.thumbnail_rendered(render_seconds, decode_seconds)
+
+    @staticmethod
+    def _image_key(image_path, st):
+        return str(image_path), st.st_mtime_ns, st.st_size
+
+    def has_failed(self, image_path, st):
+        """True if image_path failed to render as it is now."""
+        with self.lock:
+            return self._image_key(image_path, st) in self.failed_images
+
+    def add_failed(self, image_path, st):
+        with self.lock:
+            self.failed_images[self._image_key(image_path, st)] = True
+            if len(self.failed_images) > self.MAX_FAILED_IMAGES:
+                self.failed_images.popitem(last=False)
+
+    def has_idle_worker(self):
+        with self.lock:
+            return len(self.in_flight) < max(1, self.max_workers)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    @property
+    def queue_depth(self):
+        """Jobs waiting for a free worker."""
+        with self.lock:
+            return max(0, len(self.in_flight) - max(1, self.max_workers))
+
+    def stats(self):
+        with self.lock:
+            in_flight = len(self.in_flight)
+            latencies = sorted(total for total, _ in self.latencies)
+            render_times = [render for _, render in self.latencies]
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 4) if latencies else None
+
+        return {
+            'workers': self.max_workers,
+            'in_flight': in_flight,
+            'queue_depth': max(0, in_flight - max(1, self.max_workers)),
+            'submitted': self.submitted,
+            'shared': self.shared,
+            'failed': self.failed,
+            'failed_images': len(self.failed_images),
+            'latency_p50': percentile(0.50),
+            'latency_p95': percentile(0.95),
+            'latency_max': round(latencies[-1], 4) if latencies else None,
+            'render_avg': round(sum(render_times) / len(render_times), 4) if render_times else None,
+        }
+
+
+thumbnail_cache = None
+thumbnail_renderer = None
+
+
+def get_file_etag(st, suffix=''):
+    """Strong ETag from inode, size and mtime; suffix tells apart representations derived from the file."""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}{suffix}"'
+
+
+def get_encoded_etag(etag, encoding):
+    """ETag of the representation of etag compressed with encoding (None for identity)."""
+    return f'{etag[:-1]}-{encoding}"' if encoding else etag
+
+
+def get_encoded_etags(etag):
+    """All ETags a generated response may have been sent with, depending on the content coding."""
+    return [etag] + [get_encoded_etag(etag, encoding) for encoding in COMPRESSED_ENCODINGS]
+
+
+def parse_qualities(header):
+    """{token: q} of an Accept or Accept-Encoding header, tokens in lower case."""
+    qualities = {}
+    for part in header.lower().split(','):
+        token, *params = part.split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[token.strip()] = q
+    return qualities
+
+
+def thumbnail_version(mtime, size):
+    """The v= parameter of thumbnail URLs; changes with the image, which lets browsers cache them for good."""
+    return f'{int(mtime * 1000):x}-{size:x}'
+
+
+def get_thumbnail(image_path, size, st=None, fmt='jpeg'):
+    """Thumbnail bytes for image_path in fmt, served from the disk cache whenever possible.
+
+    image_path may be an ArchiveMember instead, which is its own st. Returns None
+    when the thumbnail can be neither found in the cache nor rendered.
+    """
+    if st is None:
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            return None
+
+    key = ThumbnailCache.make_key(image_path, size, st, fmt)
+
+    if thumbnail_cache:
+        cached_path = thumbnail_cache.get(key)
+        if cached_path:
+            try:
+                with open(cached_path, 'rb') as f:
+                    return f.read()
+            except OSError:
+                pass
+
+    if not HAVE_PIL or thumbnail_renderer.has_failed(image_path, st):
+        return None
+
+    return render_thumbnail(key, image_path, size, st, fmt)
+
+
+def render_thumbnail(key, image_path, size, st, fmt='jpeg'):
+    """Thumbnail bytes rendered and stored in the cache; None if the image can't be rendered, which is remembered."""
+    from concurrent.futures import BrokenExecutor, CancelledError
+
+    try:
+        thumbnail_binary, is_owner = thumbnail_renderer.render(key, image_path, size, fmt)
+    except (BrokenExecutor, CancelledError):
+        # the pool, not the image, failed
+        return None
+    except Exception as e:
+        # not an image Pillow can read, truncated, a decompression bomb...
+        log_event('warning', 'No thumbnail', path=str(image_path), error=repr(e))
+        thumbnail_renderer.add_failed(image_path, st)
+        return None
+
+    if thumbnail_cache and is_owner:
+        try:
+            thumbnail_cache.put(key, thumbnail_binary)
+        except OSError as e:
+            log_event('warning', 'Thumbnail not cached', path=str(image_path), error=str(e))
+
+    return thumbnail_binary
+
+
+@lru_cache(maxsize=None)
+def get_thumbnail_formats():
+    """The formats of --thumb_formats Pillow can write, in order of preference, ending with JPEG."""
+    if not HAVE_PIL:
+        return ('jpeg',)
+
+    from PIL import features
+
+    formats = [fmt for fmt in args.thumb_formats.split(',') if fmt != 'jpeg' and features.check(fmt)]
+    return tuple(formats) + ('jpeg',)
+
+
+def get_thumbnail_format(data):
+    """Format of thumbnail bytes (its content type is image/<format>), told by their magic number.
+
+    Small PNGs and GIFs are passed through as they are, whatever format was asked for.
+    """
+    if data.startswith(b'\x89PNG'):
+        return 'png'
+    if data.startswith(b'GIF8'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[4:12] in (b'ftypavif', b'ftypavis'):
+        return 'avif'
+    return 'jpeg'
+
+
+def thumbnail_srcset(quoted_link, version):
+    """srcset attribute of the thumbnail size classes of an image."""
+    return ', '.join(f'{quoted_link}{IMG_THUMBNAIL_SELECTOR}&size={name}&v={version} {width}w'
+                     for name, (width, _) in THUMBNAIL_SIZES.items())
+
+
+def iter_image_files(root):
+    """Yield the paths of all images below root, skipping dot files and folders."""
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(d for d in dir_names if not d.startswith('.'))
+        for name in sorted(file_names):
+            if not name.startswith('.') and REGEX_IMAGE_FILE.search(name):
+                yield os.path.join(dir_path, name)
+
+
+class ThumbnailPrewarmer:
+    """Renders thumbnails into the cache ahead of the browser's requests.
+
+    Images of freshly listed folders are warmed first, then whole trees queued
+    with warm_tree(). Jobs are only started while the renderer has an idle worker,
+    so requests from browsers always take precedence over warming.
+    """
+
+    MAX_QUEUED = 20000
+    IDLE_POLL_INTERVAL = 0.05
+
+    def __init__(self, size, fmt='jpeg', num_threads=1):
+        self.size = size
+        self.fmt = fmt
+        self.cond = threading.Condition()
+        self.queue = deque(maxlen=self.MAX_QUEUED)  # image paths from folder listings
+        self.queued = set()
+        self.trees = deque()  # iterators over image paths of whole trees
+        self.tree_lock = threading.Lock()
+        self.warmed = 0
+        self.skipped = 0
+        self.failed = 0
+
+        for i in range(num_threads):
+            threading.Thread(target=self._run, name=f'thumbnail-prewarmer-{i}', daemon=True).start()
+
+    def warm_images(self, image_paths):
+        with self.cond:
+            for image_path in image_paths:
+                if image_path not in self.queued:
+                    if len(self.queue) == self.queue.maxlen:
+                        self.queued.discard(self.queue[0])
+                    self.queue.append(image_path)
+                    self.queued.add(image_path)
+            self.cond.notify_all()
+
+    def warm_tree(self, root):
+        with self.cond:
+            self.trees.append(iter_image_files(root))
+            self.cond.notify_all()
+
+    def _next_image(self):
+        while True:
+            with self.cond:
+                if self.queue:
+                    image_path = self.queue.popleft()
+                    self.queued.discard(image_path)
+                    return image_path
+                if not self.trees:
+                    self.cond.wait()
+                    continue
+                tree = self.trees[0]
+
+            # walk outside of self.cond so that listings can queue their images meanwhile
+            with self.tree_lock:
+                image_path = next(tree, None)
+            if image_path is not None:
+                return image_path
+
+            with self.cond:
+                if self.trees and self.trees[0] is tree:
+                    self.trees.popleft()
+
+    def _run(self):
+        while True:
+            image_path = self._next_image()
+
+            while not thumbnail_renderer.has_idle_worker():
+                time.sleep(self.IDLE_POLL_INTERVAL)
+
+            try:
+                self._warm(image_path)
+            except Exception:
+                self.failed += 1
+
+    def _warm(self, image_path):
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            self.skipped += 1
+            return
+
+        key = ThumbnailCache.make_key(image_path, self.size, st, self.fmt)
+        if thumbnail_cache.contains(key) or thumbnail_renderer.has_failed(image_path, st):
+            self.skipped += 1
+            return
+
+        if render_thumbnail(key, image_path, self.size, st, self.fmt) is None:
+            self.failed += 1
+        else:
+            self.warmed += 1
+
+    def stats(self):
+        with self.cond:
+            queued = len(self.queue)
+            trees = len(self.trees)
+        return {
+            'queued': queued,
+            'trees_pending': trees,
+            'warmed': self.warmed,
+            'skipped': self.skipped,
+            'failed': self.failed,
+        }
+
+
+thumbnail_prewarmer = None
+
+
+def get_server_stats(server):
+    """The JSON of /__stats for the server the request came to."""
+    stats = {'worker': server.worker_id, 'pid': os.getpid(), 'thumbnail_renderer': thumbnail_renderer.stats()}
+    if isinstance(server, AsyncHTTPServer):
+        stats['async_server'] = server.stats()
+    if server.admission_classes:
+        stats['admission'] = {name: admission.stats() for name, admission in server.admission_classes.items()}
+    if thumbnail_prewarmer:
+        stats['thumbnail_prewarmer'] = thumbnail_prewarmer.stats()
+    if directory_listing_cache:
+        stats['directory_listing_cache'] = {
+            'listings': len(directory_listing_cache.listings),
+            'bytes': directory_listing_cache.total_bytes,
+            'max_bytes': directory_listing_cache.max_bytes,
+            'hits': directory_listing_cache.hits,
+            'misses': directory_listing_cache.misses,
+        }
+    if server.archive_index_cache:
+        stats['archive_index_cache'] = {
+            'archives': len(server.archive_index_cache.indexes),
+            'hits': server.archive_index_cache.hits,
+            'misses': server.archive_index_cache.misses,
+        }
+    if media_index:
+        stats['media_index'] = media_index.stats()
+    if metadata_cache:
+        stats['metadata_cache'] = metadata_cache.stats()
+    if search_index:
+        stats['search_index'] = {
+            'ready': search_index.ready,
+            'files': len(search_index.data),
+            'dead': search_index.data.dead,
+            'trigrams': len(search_index.data.trigrams),
+        }
+    if open_file_cache:
+        stats['open_file_cache'] = {
+            'entries': len(open_file_cache.entries),
+            'hits': open_file_cache.hits,
+            'misses': open_file_cache.misses,
+        }
+    if subtitle_cache:
+        stats['subtitle_cache'] = {
+            'entries': len(subtitle_cache.entries),
+            'bytes': subtitle_cache.total_bytes,
+            'hits': subtitle_cache.hits,
+            'misses': subtitle_cache.misses,
+        }
+    if thumbnail_cache:
+        stats['thumbnail_cache'] = {
+            'entries': len(thumbnail_cache.entries),
+            'bytes': thumbnail_cache.total_bytes,
+            'max_bytes': thumbnail_cache.max_bytes,
+            'hits': thumbnail_cache.hits,
+            'misses': thumbnail_cache.misses,
+        }
+    return stats
+
+
+class Histogram:
+    """Prometheus histogram of durations in seconds; callers hold the lock of its owner."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+class ServerMetrics:
+    """Request latencies per route, bytes sent and thumbnail timings of this process, for /__metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # route -> Histogram
+        self.responses = {}  # (route, status) -> count
+        self.bytes_sent = {}  # route -> bytes, headers included
+        self.connections = 0
+        self.active_requests = 0
+        self.thumbnail_render = Histogram()
+        self.thumbnail_decode = Histogram()
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def request_started(self):
+        with self.lock:
+            self.active_requests += 1
+
+    def request_done(self, route, status, seconds, sent, started=True):
+        with self.lock:
+            if started:
+                self.active_requests -= 1
+            histogram = self.latencies.get(route)
+            if histogram is None:
+                histogram = self.latencies[route] = Histogram()
+            histogram.observe(seconds)
+            self.responses[route, status] = self.responses.get((route, status), 0) + 1
+            self.bytes_sent[route] = self.bytes_sent.get(route, 0) + sent
+
+    def thumbnail_rendered(self, render_seconds, decode_seconds):
+        with self.lock:
+            self.thumbnail_render.observe(render_seconds)
+            self.thumbnail_decode.observe(decode_seconds)
+
+    def render(self, worker, connections=None):
+        """The metrics of the requests in the Prometheus text format, without the trailing newline.
+
+        connections is the number of open connections if the server counts them
+        itself, like AsyncHTTPServer; else those counted here are reported.
+        """
+        base = f'worker="{worker}"'
+        lines = []
+
+        def family(name, kind, description):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self.lock:
+            family('mediabro_request_duration_seconds', 'histogram',
+                   'Time from reading a request to the end of its response.')
+            for route, histogram in sorted(self.latencies.items()):
+                lines.extend(histogram.render('mediabro_request_duration_seconds', f'{base},route="{route}"'))
+            family('mediabro_responses_total', 'counter', 'Responses by route and status code.')
+            for (route, status), count in sorted(self.responses.items()):
+                lines.append(f'mediabro_responses_total{{{base},route="{route}",status="{status}"}} {count}')
+            family('mediabro_sent_bytes_total', 'counter', 'Bytes sent by route, headers included.')
+            for route, sent in sorted(self.bytes_sent.items()):
+                lines.append(f'mediabro_sent_bytes_total{{{base},route="{route}"}} {sent}')
+            family('mediabro_active_requests', 'gauge', 'Requests being served.')
+            lines.append(f'mediabro_active_requests{{{base}}} {self.active_requests}')
+            family('mediabro_active_connections', 'gauge', 'Open client connections.')
+            lines.append(f'mediabro_active_connections{{{base}}} '
+                         f'{self.connections if connections is None else connections}')
+            family('mediabro_thumbnail_render_seconds', 'histogram', 'Time spent rendering a thumbnail.')
+            lines.extend(self.thumbnail_render.render('mediabro_thumbnail_render_seconds', base))
+            family('mediabro_thumbnail_decode_seconds', 'histogram',
+                   'Part of the thumbnail rendering spent decoding the image with PIL.')
+            lines.extend(self.thumbnail_decode.render('mediabro_thumbnail_decode_seconds', base))
+        return '\n'.join(lines)
+
+
+server_metrics = ServerMetrics()
+
+
+def get_server_metrics(server):
+    """The Prometheus text exposition of /__metrics: request metrics, caches, worker pools and the access log."""
+    base = f'worker="{server.worker_id}"'
+    lines = [server_metrics.render(server.worker_id, server.connections if isinstance(server, AsyncHTTPServer) else None)]
+
+    caches = {}
+    if thumbnail_cache:
+        caches['thumbnail'] = thumbnail_cache.hits, thumbnail_cache.misses
+    if directory_listing_cache:
+        caches['listing'] = directory_listing_cache.hits, directory_listing_cache.misses
+    if server.archive_index_cache:
+        caches['archive_index'] = server.archive_index_cache.hits, server.archive_index_cache.misses
+    if open_file_cache:
+        caches['open_file'] = open_file_cache.hits, open_file_cache.misses
+    if subtitle_cache:
+        caches['subtitle'] = subtitle_cache.hits, subtitle_cache.misses
+    if metadata_cache:
+        caches['metadata'] = metadata_cache.hits, metadata_cache.probes
+    for name, kind, description, value in (
+            ('mediabro_cache_hits_total', 'counter', 'Lookups answered by a cache.', lambda hits, misses: hits),
+            ('mediabro_cache_misses_total', 'counter', 'Lookups a cache could not answer.',
+             lambda hits, misses: misses),
+            ('mediabro_cache_hit_ratio', 'gauge', 'Share of the lookups answered by a cache.',
+             lambda hits, misses: f'{hits / (hits + misses):.4f}' if hits + misses else 'NaN')):
+        lines.append(f'# HELP {name} {description}\n# TYPE {name} {kind}')
+        lines.extend(f'{name}{{{base},cache="{cache}"}} {value(*counts)}' for cache, counts in caches.items())
+
+    renderer = thumbnail_renderer.stats()
+    lines.append('# HELP mediabro_thumbnail_queue_depth Thumbnail jobs waiting for a free worker.\n'
+                 '# TYPE mediabro_thumbnail_queue_depth gauge\n'
+                 f'mediabro_thumbnail_queue_depth{{{base}}} {renderer["queue_depth"]}')
+
+    if server.admission_classes:
+        lines.append('# HELP mediabro_admission_waiting Requests waiting for a slot.\n'
+                     '# TYPE mediabro_admission_waiting gauge')
+        stats = {name: admission.stats() for name, admission in server.admission_classes.items()}
+        lines.extend(f'mediabro_admission_waiting{{{base},class="{name}"}} {s["waiting"]}' for name, s in stats.items())
+        lines.append('# HELP mediabro_admission_rejected_total Requests answered with 503.\n'
+                     '# TYPE mediabro_admission_rejected_total counter')
+        lines.extend(f'mediabro_admission_rejected_total{{{base},class="{name}"}} {s["rejected"] + s["timed_out"]}'
+                     for name, s in stats.items())
+
+    if access_log:
+        lines.append('# HELP mediabro_access_log_dropped_total Access log records dropped because the queue was full.\n'
+                     '# TYPE mediabro_access_log_dropped_total counter\n'
+                     f'mediabro_access_log_dropped_total{{{base}}} {access_log.dropped}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_request_route(path, ranged=False):
+    """Route of a request path for the metrics and the access log, e.g. 'thumbnail' or 'listing'."""
+    url_path, query = get_url_path(path), path.partition('?')[2]
+    if url_path in SERVER_ROUTES:
+        return SERVER_ROUTES[url_path]
+    if REGEX_INTERNAL_FILE.match(url_path):
+        return 'static'
+    if url_path.endswith(MEDIALIST_NAMES):
+        return 'playlist'
+    selectors = {parameter.partition('=')[0] for parameter in query.split('&')} if query else ()
+    if LIST_JSON_SELECTOR in selectors:
+        return 'listing_json'
+    if COMPANIONS_JSON_SELECTOR in selectors:
+        return 'companions'
+    if SRT_AS_VTT_SELECTOR in selectors:
+        return 'subtitles'
+    if IMG_THUMBNAIL_SELECTOR[1:] in selectors:
+        return 'thumbnail'
+    if DOWNLOAD_ZIP_QUERY in query.split('&'):
+        return 'download'
+    if url_path.endswith('/'):
+        return 'listing'
+    return 'range' if ranged else 'file'
+
+
+def get_url_path(path):
+    """The path of a request path without the query, unquoted."""
+    return unquote(path.partition('?')[0])
+
+
+class AccessLog:
+    """Structured access log: one JSON object per line, written by a background thread.
+
+    Requests only put their record on a bounded queue; the thread writes what has
+    piled up in one go, so a slow terminal or disk never holds up a request.
+    Records that don't fit in the queue are dropped and counted. Successful
+    requests are logged at level info and may be sampled, 4xx responses are
+    warnings and 5xx responses errors.
+    """
+
+    LEVELS = {name: number for number, name in enumerate(ACCESS_LOG_LEVELS)}
+
+    def __init__(self, stream, level='info', sample=1.0, max_queue=ACCESS_LOG_QUEUE):
+        self.stream = stream
+        self.level = self.LEVELS[level]
+        self.sample = sample
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+        self.thread.start()
+
+    def enabled(self, level):
+        return self.LEVELS[level] >= self.level
+
+    def log(self, level, record, sample=True):
+        """Queue record (a dict) for writing if level is enabled; info records are sampled if sample is set."""
+        if self.LEVELS[level] < self.level or \
+                sample and level == 'info' and self.sample < 1 and random.random() >= self.sample:
+            return
+        try:
+            self.queue.put_nowait((time.time(), level, record))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while records[-1] is not None:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            lines = []
+            for seconds, level, record in filter(None, records):
+                timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + '.%03dZ' % (seconds % 1 * 1000)
+                lines.append(json_dumps({'time': timestamp, 'level': level, **record}))
+            try:
+                self.stream.write('\n'.join(lines) + '\n' if lines else '')
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+            if records[-1] is None:
+                return
+
+    def close(self):
+        """Write the queued records and stop the writer thread."""
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+
+access_log = None
+
+
+def log_event(level, message, **fields):
+    """A message of the server itself, not of a request, in the access log; never sampled.
+
+    With the log turned off, errors still go to stderr.
+    """
+    if access_log:
+        access_log.log(level, {'message': message, **fields}, sample=False)
+    elif level == 'error':
+        print(message, *(f'{key}={value}' for key, value in fields.items()), file=sys.stderr, flush=True)
+
+
+@lru_cache(maxsize=None)
+def get_image_module():
+    """PIL.Image, imported on first use; opens HEIC/HEIF images too if pillow_heif is installed."""
+    from PIL import Image
+
+    if HAVE_PILLOW_HEIF:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+    return Image
+
+
+def make_thumbnail(image_path, size, fmt='jpeg'):
+    """Thumbnail of image_path (or an ArchiveMember) in fmt and the seconds spent decoding the image.
+
+    Small PNGs and GIFs that fit into size are returned as they are, which keeps animations.
+    """
+    data = read_archive_member(image_path) if isinstance(image_path, ArchiveMember) else None
+    img = get_image_module().open(image_path if data is None else BytesIO(data))
     ''':type : PIL.Image'''
 
+    if img.format in ('PNG', 'GIF') and img.width <= size[0] and img.height <= size[1]:
+        if data is None and os.path.getsize(image_path) <= THUMBNAIL_PASSTHROUGH_SIZE:
+            with open(image_path, 'rb') as f:
+                data = f.read()
+        if data is not None and len(data) <= THUMBNAIL_PASSTHROUGH_SIZE:
+            return data, 0.0
+
+    if img.format == 'JPEG':
+        # let the JPEG decoder scale down by 1/2..1/8 while decoding instead of decoding at full
+        # resolution; the longest side is requested for both axes since EXIF may rotate the image
+        longest = max(size)
+        img.draft('RGB', (longest, longest))
+
+    started = time.perf_counter()
+    img.load()
+    decode_seconds = time.perf_counter() - started
+
+    img = fix_image_orientation(img)
+
     if img.mode != 'RGB':
         img = img.convert('RGB')
 
     img.thumbnail(size)
     img_io = BytesIO()
-    img.save(img_io, 'JPEG', quality=50)
+    img.save(img_io, **THUMBNAIL_FORMATS[fmt][1])
     img_io.seek(0)
-    return img_io.getvalue()
+    return img_io.getvalue(), decode_seconds
 
 
 def fix_image_orientation(image):
+    from PIL import Image
+
     if hasattr(image, '_getexif'):  # only present in JPEGs
 
         try:
@@ -263,275 +1357,3656 @@ def fix_image_orientation(image):
 
     return image
 
-def get_extension(entry):
-    return entry.suffix.lower()[1:] if entry.suffix else entry.name
-
+def get_extension(name):
+    suffix = os.path.splitext(name)[1]
+    return suffix.lower()[1:] if suffix else name
 
 
-class MyRequestHandler(SimpleHTTPRequestHandler):
-    #
-    # def end_headers(self):
-    #     # Disable output buffering
-    #     self.server.wsgi_output = False
-    #     super().end_headers()
-
-    def handle(self):
-        try:
-            SimpleHTTPRequestHandler.handle(self)
-        except Exception as e:
-            pass
+ListingEntry = namedtuple('ListingEntry', 'name is_dir is_symlink size mtime')
 
-    def __init__(self, request, client_address, server):
-        self.media_root_dir = args.webroot
-        template_path = Path(get_script_dir(), "mediabro.html")
 
-        html_content = template_path.read_text(encoding='utf-8')
+def scan_directory(dir_path, show_hidden=False):
+    """List dir_path with a single os.scandir() pass, folders first.
 
-        self.page_template = Template(html_content)
+    The file type comes for free with each DirEntry; one stat() per entry
+    provides size and mtime.
+    """
+    entries = []
+    with os.scandir(dir_path) as it:
+        for dir_entry in it:
+            name = dir_entry.name
+            if not show_hidden and name.startswith('.'):
+                continue
+            try:
+                is_dir = dir_entry.is_dir()
+                st = dir_entry.stat()
+                size, mtime = (0 if is_dir else st.st_size), st.st_mtime
+            except OSError:
+                # dangling symlink or entry removed while scanning
+                is_dir, size, mtime = False, 0, 0
+            entries.append(ListingEntry(name, is_dir, dir_entry.is_symlink(), size, mtime))
+
+    entries.sort(key=lambda e: (not e.is_dir, e.name.lower()))
+    return entries
+
+
+LISTING_SORT_KEYS = {
+    'name': lambda e: (not e.is_dir, e.name.lower(), e.name),
+    'size': lambda e: (not e.is_dir, e.size, e.name.lower(), e.name),
+    'mtime': lambda e: (not e.is_dir, e.mtime, e.name.lower(), e.name),
+    'type': lambda e: (not e.is_dir, '' if e.is_dir else get_extension(e.name).lower(), e.name.lower(), e.name),
+}
 
-        SimpleHTTPRequestHandler.__init__(self, request, client_address, server)
+LISTING_TYPE_FILTERS = {
+    'dir': lambda e: e.is_dir,
+    'file': lambda e: not e.is_dir,
+    'image': lambda e: not e.is_dir and REGEX_IMAGE_FILE.search(e.name) is not None,
+    'media': lambda e: not e.is_dir and REGEX_MEDIA_FILE.search(e.name) is not None,
+}
 
-    """Adds support for HTTP 'Range' requests to SimpleHTTPRequestHandler
 
-    The approach is to:
-    - Override send_head to look for 'Range' and respond appropriately.
-    - Override copyfile to only transmit a range when requested.
-    """
-    def send_head(self):
-        if 'Range' not in self.headers:
-            self.range = None
-            return SimpleHTTPRequestHandler.send_head(self)
-        try:
-            self.range = self.parse_byte_range(self.headers['Range'])
-        except ValueError as e:
-            self.send_error(400, 'Invalid byte range')
-            return None
-        first, last = self.range
+# codec names for the sample entry types of MP4 and the codec ids of Matroska
+MP4_CODECS = {b'avc1': 'h264', b'avc3': 'h264', b'hvc1': 'hevc', b'hev1': 'hevc', b'av01': 'av1', b'vp09': 'vp9',
+              b'vp08': 'vp8', b'mp4v': 'mpeg4', b'mp4a': 'aac', b'.mp3': 'mp3', b'ac-3': 'ac3', b'ec-3': 'eac3',
+              b'Opus': 'opus', b'fLaC': 'flac', b'alac': 'alac', b'samr': 'amr', b'sawb': 'amr-wb', b's263': 'h263'}
+MATROSKA_CODECS = {'V_MPEG4/ISO/AVC': 'h264', 'V_MPEGH/ISO/HEVC': 'hevc', 'V_MPEG4/ISO/ASP': 'mpeg4',
+                   'V_MPEG2': 'mpeg2', 'A_MPEG/L3': 'mp3', 'A_MPEG/L2': 'mp2', 'A_PCM/INT/LIT': 'pcm'}
+WAVE_FORMATS = {0x1: 'pcm', 0x3: 'pcm', 0x6: 'alaw', 0x7: 'ulaw', 0x50: 'mp2', 0x55: 'mp3', 0xff: 'aac',
+                0x160: 'wmav1', 0x161: 'wmav2', 0x162: 'wmapro', 0x163: 'wmalossless', 0x2000: 'ac3', 0x2001: 'dts'}
+# kbps by (MPEG-1, layer); MPEG-2 and 2.5 share their tables
+MPEG_AUDIO_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MPEG_AUDIO_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+ASF_HEADER = bytes.fromhex('3026b2758e66cf11a6d900aa0062ce6c')
+ASF_FILE_PROPERTIES = bytes.fromhex('a1dcab8c47a9cf118ee400c00c205365')
+ASF_STREAM_PROPERTIES = bytes.fromhex('9107dcb7b7a9cf118ee600c00c205365')
+ASF_AUDIO_MEDIA = bytes.fromhex('409e69f84d5bcf11a8fd00805f5c442b')
+ASF_VIDEO_MEDIA = bytes.fromhex('c0ef19bc4d5bcf11a8fd00805f5c442b')
+# the largest header structure (moov box, Matroska Tracks, ...) read into memory
+MAX_MEDIA_HEADER_SIZE = 16 << 20
+# bytes searched for the first MPEG audio frame, and for the last Ogg page
+MEDIA_SCAN_SIZE = 64 * 1024
+
+
+def _read_at(f, offset, length):
+    f.seek(offset)
+    return f.read(length)
+
+
+def _iter_mp4_boxes(data, start=0, end=None):
+    """(type, payload start, payload end) of the boxes in data[start:end]."""
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, start)
+        header = 8
+        if size == 1:
+            if start + 16 > end:
+                return
+            size, header = struct.unpack_from('>Q', data, start + 8)[0], 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield kind, start + header, min(start + size, end)
+        start += size
 
-        # Mirroring SimpleHTTPServer.py here
-        path = self.translate_path(self.path)
-        f = None
-        ctype = self.guess_type(path)
 
-        ## override for php
-        if 'php' in path.lower():
-            ctype = 'text/plain'
+def _probe_mp4(f, size):
+    """MP4, M4A, MOV and 3GP: mvhd for the duration, the sample descriptions of the tracks for the codecs."""
+    offset = 0
+    while offset + 8 <= size:
+        header = _read_at(f, offset, 16)
+        if len(header) < 8:
+            break
+        box_size, kind = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if box_size == 1 and len(header) == 16:
+            box_size, header_size = struct.unpack_from('>Q', header, 8)[0], 16
+        elif box_size == 0:
+            box_size = size - offset
+        if box_size < header_size:
+            break
+        if kind == b'moov':
+            if box_size > MAX_MEDIA_HEADER_SIZE:
+                break
+            return _parse_mp4_moov(_read_at(f, offset + header_size, box_size - header_size))
+        offset += box_size
+    return {}
 
-        try:
-            f = open(path, 'rb')
-        except IOError:
-            self.send_error(404, 'File not found')
-            return None
 
-        fs = os.fstat(f.fileno())
-        file_len = fs[6]
-        if first >= file_len:
-            self.send_error(416, 'Requested Range Not Satisfiable')
+def _parse_mp4_moov(moov):
+    info = {}
+    for kind, start, end in _iter_mp4_boxes(moov):
+        if kind == b'mvhd':
+            if moov[start] == 1:
+                timescale, duration = struct.unpack_from('>IQ', moov, start + 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', moov, start + 12)
+            if timescale and duration not in (0, 0xffffffff, 0xffffffffffffffff):
+                info['duration'] = duration / timescale
+        elif kind == b'trak':
+            _parse_mp4_trak(moov, start, end, info)
+    return info
+
+
+def _find_mp4_box(data, start, end, *path):
+    """Payload range of the box at path below data[start:end], None if there is none."""
+    for name in path:
+        for kind, box_start, box_end in _iter_mp4_boxes(data, start, end):
+            if kind == name:
+                start, end = box_start, box_end
+                break
+        else:
             return None
+    return start, end
+
+
+def _parse_mp4_trak(moov, start, end, info):
+    hdlr = _find_mp4_box(moov, start, end, b'mdia', b'hdlr')
+    stsd = _find_mp4_box(moov, start, end, b'mdia', b'minf', b'stbl', b'stsd')
+    if not hdlr or not stsd or stsd[1] - stsd[0] < 16:
+        return
+    handler = moov[hdlr[0] + 8:hdlr[0] + 12]
+    # the first sample entry, after version, flags and entry count
+    entry = stsd[0] + 8
+    fourcc = moov[entry + 4:entry + 8]
+    codec = MP4_CODECS.get(fourcc, fourcc.decode('latin-1').strip().lower())
+    if handler == b'vide' and 'video' not in info and entry + 36 <= stsd[1]:
+        info['video'] = codec
+        info['width'], info['height'] = struct.unpack_from('>HH', moov, entry + 32)
+    elif handler == b'soun' and 'audio' not in info and entry + 36 <= stsd[1]:
+        info['audio'] = codec
+        info['channels'] = struct.unpack_from('>H', moov, entry + 24)[0]
+        info['sample_rate'] = struct.unpack_from('>I', moov, entry + 32)[0] >> 16
+
+
+def _parse_mpeg_audio_header(header):
+    """(MPEG-1, layer, bitrate, sample rate, frame length, mono) of a frame header, None if it isn't one."""
+    if len(header) < 4:
+        return None
+    word = int.from_bytes(header[:4], 'big')
+    if word >> 21 != 0x7ff:
+        return None
+    version, layer_bits = (word >> 19) & 3, (word >> 17) & 3
+    bitrate_index, rate_index = (word >> 12) & 15, (word >> 10) & 3
+    if version == 1 or layer_bits == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1, layer = version == 3, 4 - layer_bits
+    bitrate = MPEG_AUDIO_BITRATES[mpeg1, layer][bitrate_index] * 1000
+    sample_rate = MPEG_AUDIO_SAMPLE_RATES[version][rate_index]
+    padding = (word >> 9) & 1
+    if layer == 1:
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        frame_length = (144 if mpeg1 or layer == 2 else 72) * bitrate // sample_rate + padding
+    return mpeg1, layer, bitrate, sample_rate, frame_length, (word >> 6) & 3 == 3
+
+
+def _probe_mpeg_audio(f, size):
+    """MP3 (and MP1/MP2): the first frame, with the frame count of a Xing/Info or VBRI header if present."""
+    audio_start = 0
+    head = _read_at(f, 0, 10)
+    if head[:3] == b'ID3' and len(head) == 10:
+        tag_size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        audio_start = 10 + tag_size + (10 if head[5] & 0x10 else 0)
+
+    data = _read_at(f, audio_start, MEDIA_SCAN_SIZE)
+    position = data.find(b'\xff')
+    while 0 <= position < len(data) - 4:
+        frame = _parse_mpeg_audio_header(data[position:position + 4])
+        # a second frame right behind the first rules out a stray sync word
+        if frame and _parse_mpeg_audio_header(data[position + frame[4]:position + frame[4] + 4]):
+            break
+        position = data.find(b'\xff', position + 1)
+    else:
+        return {}
+
+    mpeg1, layer, bitrate, sample_rate, frame_length, mono = frame
+    samples_per_frame = 384 if layer == 1 else (1152 if mpeg1 or layer == 2 else 576)
+    info = {'audio': 'mp%d' % layer, 'sample_rate': sample_rate, 'channels': 1 if mono else 2}
+
+    audio_start += position
+    audio_size = size - audio_start
+    if audio_size >= 128 and _read_at(f, size - 128, 3) == b'TAG':
+        audio_size -= 128
+
+    frames = None
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    xing = data[position + 4 + side_info:position + 4 + side_info + 16]
+    vbri = data[position + 36:position + 36 + 18]
+    if xing[:4] in (b'Xing', b'Info') and len(xing) == 16:
+        flags = struct.unpack_from('>I', xing, 4)[0]
+        if flags & 1:
+            frames = struct.unpack_from('>I', xing, 8)[0]
+        if flags & 2:
+            audio_size = struct.unpack_from('>I', xing, 12 if flags & 1 else 8)[0] or audio_size
+    elif vbri[:4] == b'VBRI' and len(vbri) == 18:
+        frames = struct.unpack_from('>I', vbri, 14)[0]
+
+    if frames:
+        info['duration'] = frames * samples_per_frame / sample_rate
+    elif bitrate:
+        # constant bitrate
+        info['duration'] = audio_size * 8 / bitrate
+    return info
+
+
+def _parse_flac_streaminfo(data, info):
+    packed = int.from_bytes(data[10:18], 'big')
+    sample_rate = packed >> 44
+    info['audio'] = 'flac'
+    info['sample_rate'] = sample_rate
+    info['channels'] = ((packed >> 41) & 7) + 1
+    total_samples = packed & 0xfffffffff
+    if sample_rate and total_samples:
+        info['duration'] = total_samples / sample_rate
+
+
+def _probe_flac(f, size):
+    """FLAC: the STREAMINFO block that follows the signature."""
+    data = _read_at(f, 0, 42)
+    if len(data) < 42 or data[4] & 0x7f != 0:
+        return {}
+    info = {}
+    _parse_flac_streaminfo(data[8:42], info)
+    return info
+
+
+def _probe_ogg(f, size):
+    """Ogg: the identification headers on the first pages, the granule position of the last page for the duration."""
+    data = _read_at(f, 0, MEDIA_SCAN_SIZE)
+    info = {}
+    # serial of the audio stream: (samples per second of its granule positions, samples to skip)
+    audio_clock = None
+    offset = 0
+    while data[offset:offset + 4] == b'OggS' and offset + 27 <= len(data):
+        header_type, serial, segments = data[offset + 5], struct.unpack_from('<I', data, offset + 14)[0], data[offset + 26]
+        body = offset + 27 + segments
+        if not header_type & 2:
+            # past the beginning-of-stream pages
+            break
+        packet = data[body:body + sum(data[offset + 27:body])]
+        if packet[:7] == b'\x01vorbis' and len(packet) >= 16 and 'audio' not in info:
+            info['audio'], info['channels'] = 'vorbis', packet[11]
+            info['sample_rate'] = struct.unpack_from('<I', packet, 12)[0]
+            audio_clock = serial, info['sample_rate'], 0
+        elif packet[:8] == b'OpusHead' and len(packet) >= 16 and 'audio' not in info:
+            info['audio'], info['channels'], info['sample_rate'] = 'opus', packet[9], 48000
+            audio_clock = serial, 48000, struct.unpack_from('<H', packet, 10)[0]
+        elif packet[:5] == b'\x7fFLAC' and len(packet) >= 51 and 'audio' not in info:
+            _parse_flac_streaminfo(packet[17:51], info)
+            info.pop('duration', None)
+            audio_clock = serial, info['sample_rate'], 0
+        elif packet[:7] == b'\x80theora' and len(packet) >= 20 and 'video' not in info:
+            info['video'] = 'theora'
+            info['width'] = int.from_bytes(packet[14:17], 'big')
+            info['height'] = int.from_bytes(packet[17:20], 'big')
+        offset = body + sum(data[offset + 27:body])
+
+    if audio_clock and audio_clock[1]:
+        serial, rate, skip = audio_clock
+        tail = _read_at(f, max(0, size - MEDIA_SCAN_SIZE), MEDIA_SCAN_SIZE)
+        position = tail.rfind(b'OggS')
+        while position >= 0:
+            if position + 18 <= len(tail) and struct.unpack_from('<I', tail, position + 14)[0] == serial:
+                granule = struct.unpack_from('<q', tail, position + 6)[0]
+                if granule > skip:
+                    info['duration'] = (granule - skip) / rate
+                break
+            position = tail.rfind(b'OggS', 0, position)
+    return info
+
+
+def _iter_riff_chunks(data, start, end, byteorder='<'):
+    """(id, data start, data size) of the chunks in data[start:end]; sizes may exceed the data read."""
+    while start + 8 <= end:
+        chunk_id, chunk_size = struct.unpack_from(byteorder + '4sI', data, start)
+        yield chunk_id, start + 8, chunk_size
+        start += 8 + chunk_size + (chunk_size & 1)
+
+
+def _probe_riff(f, size):
+    """WAV (fmt and data chunks) and AVI (the avih and stream headers)."""
+    data = _read_at(f, 0, MEDIA_SCAN_SIZE)
+    info = {}
+    if data[8:12] == b'WAVE':
+        byte_rate = 0
+        for chunk_id, start, chunk_size in _iter_riff_chunks(data, 12, len(data)):
+            if chunk_id == b'fmt ' and start + 16 <= len(data):
+                format_tag, channels, sample_rate, byte_rate = struct.unpack_from('<HHII', data, start)
+                if format_tag == 0xfffe and start + 26 <= len(data):
+                    # WAVE_FORMAT_EXTENSIBLE: the format is the start of the sub format GUID
+                    format_tag = struct.unpack_from('<H', data, start + 24)[0]
+                info.update(audio=WAVE_FORMATS.get(format_tag, 'wav'), channels=channels, sample_rate=sample_rate)
+            elif chunk_id == b'data':
+                # the size of a file written as a stream may be missing or wrong
+                if byte_rate:
+                    info['duration'] = min(chunk_size, size - start) / byte_rate
+                break
+    elif data[8:12] == b'AVI ':
+        for chunk_id, start, chunk_size in _iter_riff_chunks(data, 12, len(data)):
+            if chunk_id == b'LIST' and data[start:start + 4] == b'hdrl':
+                _parse_avi_header(data, start + 4, min(start + chunk_size, len(data)), info)
+                break
+    return info
+
+
+def _parse_avi_header(data, start, end, info):
+    for chunk_id, chunk_start, chunk_size in _iter_riff_chunks(data, start, end):
+        if chunk_id == b'avih' and chunk_start + 40 <= end:
+            usec_per_frame, = struct.unpack_from('<I', data, chunk_start)
+            frames, = struct.unpack_from('<I', data, chunk_start + 16)
+            info['width'], info['height'] = struct.unpack_from('<II', data, chunk_start + 32)
+            if usec_per_frame and frames:
+                info['duration'] = frames * usec_per_frame / 1e6
+        elif chunk_id == b'LIST' and data[chunk_start:chunk_start + 4] == b'strl':
+            strl_end = min(chunk_start + chunk_size, end)
+            stream_type = None
+            for sub_id, sub_start, sub_size in _iter_riff_chunks(data, chunk_start + 4, strl_end):
+                if sub_id == b'strh' and sub_start + 8 <= strl_end:
+                    stream_type, handler = data[sub_start:sub_start + 4], data[sub_start + 4:sub_start + 8]
+                    if stream_type == b'vids' and 'video' not in info:
+                        info['video'] = handler.decode('latin-1').strip('\0 ').lower() or 'avi'
+                elif sub_id == b'strf' and stream_type == b'auds' and 'audio' not in info \
+                        and sub_start + 8 <= strl_end:
+                    format_tag, channels, sample_rate = struct.unpack_from('<HHI', data, sub_start)
+                    info.update(audio=WAVE_FORMATS.get(format_tag, 'unknown'), channels=channels,
+                                sample_rate=sample_rate)
+
+
+def _probe_aiff(f, size):
+    """AIFF and AIFF-C: the COMM chunk."""
+    data = _read_at(f, 0, MEDIA_SCAN_SIZE)
+    for chunk_id, start, chunk_size in _iter_riff_chunks(data, 12, len(data), '>'):
+        if chunk_id == b'COMM' and start + 18 <= len(data):
+            channels, frames, _, exponent, mantissa = struct.unpack_from('>hIhHQ', data, start)
+            # 80 bit extended precision float
+            sample_rate = mantissa * 2.0 ** ((exponent & 0x7fff) - 16383 - 63)
+            info = {'audio': 'pcm', 'channels': channels, 'sample_rate': round(sample_rate)}
+            if data[8:12] == b'AIFC' and start + 22 <= len(data):
+                compression = data[start + 18:start + 22]
+                if compression not in (b'NONE', b'sowt', b'twos'):
+                    info['audio'] = compression.decode('latin-1').strip().lower()
+            if sample_rate:
+                info['duration'] = frames / sample_rate
+            return info
+    return {}
+
+
+def _read_ebml_vint(data, position, keep_marker=False):
+    """(value, position after it) of an EBML variable size integer; value None for an unknown size."""
+    first = data[position]
+    length = 9 - first.bit_length()
+    if length > 8 or position + length > len(data):
+        raise ValueError('invalid EBML integer')
+    value = first if keep_marker else first & (0xff >> length)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, position + length
+
+
+def _iter_ebml(data, start, end):
+    """(id, data start, data end) of the EBML elements in data[start:end]."""
+    while start < end:
+        element_id, start = _read_ebml_vint(data, start, keep_marker=True)
+        element_size, start = _read_ebml_vint(data, start)
+        element_end = end if element_size is None else min(start + element_size, end)
+        yield element_id, start, element_end
+        start = element_end
+
+
+def _ebml_uint(data, start, end):
+    return int.from_bytes(data[start:end], 'big')
+
+
+def _ebml_float(data, start, end):
+    return struct.unpack('>f' if end - start == 4 else '>d', data[start:end])[0]
+
+
+def _probe_matroska(f, size):
+    """Matroska and WebM: the Info and Tracks elements of the segment, found directly or through its SeekHead."""
+    head = _read_at(f, 0, 64)
+    # skip the EBML header element
+    _, position = _read_ebml_vint(head, 0, keep_marker=True)
+    header_size, position = _read_ebml_vint(head, position)
+    if header_size is None:
+        return {}
+    offset = position + header_size
+    head = _read_at(f, offset, 16)
+    segment_id, position = _read_ebml_vint(head, 0, keep_marker=True)
+    if segment_id != 0x18538067:
+        return {}
+    segment_size, position = _read_ebml_vint(head, position)
+    segment_start = offset + position
+    segment_end = size if segment_size is None else min(size, segment_start + segment_size)
+
+    wanted = {0x1549a966: None, 0x1654ae6b: None}  # Info, Tracks
+    seeks = {}
+    offset = segment_start
+    while offset < segment_end and None in wanted.values():
+        head = _read_at(f, offset, 16)
+        if len(head) < 2:
+            break
+        element_id, position = _read_ebml_vint(head, 0, keep_marker=True)
+        element_size, position = _read_ebml_vint(head, position)
+        if element_size is None:
+            break
+        if element_id in wanted or element_id == 0x114d9b74:
+            if element_size > MAX_MEDIA_HEADER_SIZE:
+                break
+            element = _read_at(f, offset + position, element_size)
+            if element_id == 0x114d9b74:
+                seeks.update(_parse_matroska_seek_head(element))
+            else:
+                wanted[element_id] = element
+        elif element_id == 0x1f43b675:
+            # clusters of media data follow; jump to the rest through the SeekHead
+            break
+        offset += position + element_size
+
+    for element_id, element in wanted.items():
+        if element is None and element_id in seeks:
+            offset = segment_start + seeks[element_id]
+            head = _read_at(f, offset, 16)
+            if len(head) >= 2 and _read_ebml_vint(head, 0, keep_marker=True)[0] == element_id:
+                position = _read_ebml_vint(head, 0, keep_marker=True)[1]
+                element_size, position = _read_ebml_vint(head, position)
+                if element_size is not None and element_size <= MAX_MEDIA_HEADER_SIZE:
+                    wanted[element_id] = _read_at(f, offset + position, element_size)
+
+    info = {}
+    if wanted[0x1549a966]:
+        _parse_matroska_info(wanted[0x1549a966], info)
+    if wanted[0x1654ae6b]:
+        _parse_matroska_tracks(wanted[0x1654ae6b], info)
+    return info
+
+
+def _parse_matroska_seek_head(data):
+    seeks = {}
+    for element_id, start, end in _iter_ebml(data, 0, len(data)):
+        if element_id == 0x4dbb:
+            target = position = None
+            for child_id, child_start, child_end in _iter_ebml(data, start, end):
+                if child_id == 0x53ab:
+                    target = _ebml_uint(data, child_start, child_end)
+                elif child_id == 0x53ac:
+                    position = _ebml_uint(data, child_start, child_end)
+            if target is not None and position is not None:
+                seeks.setdefault(target, position)
+    return seeks
+
+
+def _parse_matroska_info(data, info):
+    timecode_scale, duration = 1000000, None
+    for element_id, start, end in _iter_ebml(data, 0, len(data)):
+        if element_id == 0x2ad7b1:
+            timecode_scale = _ebml_uint(data, start, end)
+        elif element_id == 0x4489:
+            duration = _ebml_float(data, start, end)
+    if duration:
+        info['duration'] = duration * timecode_scale / 1e9
+
+
+def _parse_matroska_tracks(data, info):
+    for element_id, start, end in _iter_ebml(data, 0, len(data)):
+        if element_id != 0xae:
+            continue
+        track_type, codec_id, track = None, '', {}
+        for child_id, child_start, child_end in _iter_ebml(data, start, end):
+            if child_id == 0x83:
+                track_type = _ebml_uint(data, child_start, child_end)
+            elif child_id == 0x86:
+                codec_id = data[child_start:child_end].decode('ascii', 'replace').rstrip('\0')
+            elif child_id in (0xe0, 0xe1):
+                for sub_id, sub_start, sub_end in _iter_ebml(data, child_start, child_end):
+                    if sub_id == 0xb0:
+                        track['width'] = _ebml_uint(data, sub_start, sub_end)
+                    elif sub_id == 0xba:
+                        track['height'] = _ebml_uint(data, sub_start, sub_end)
+                    elif sub_id == 0xb5:
+                        track['sample_rate'] = round(_ebml_float(data, sub_start, sub_end))
+                    elif sub_id == 0x9f:
+                        track['channels'] = _ebml_uint(data, sub_start, sub_end)
+        codec = MATROSKA_CODECS.get(codec_id) or codec_id[2:].split('/')[0].lower()
+        if track_type == 1 and 'video' not in info:
+            info['video'] = codec
+            info.update((key, track[key]) for key in ('width', 'height') if key in track)
+        elif track_type == 2 and 'audio' not in info:
+            info['audio'] = codec
+            info.update((key, track[key]) for key in ('sample_rate', 'channels') if key in track)
+
+
+def _probe_asf(f, size):
+    """WMA and WMV: the file and stream properties objects of the ASF header."""
+    head = _read_at(f, 0, 30)
+    header_size = struct.unpack_from('<Q', head, 16)[0]
+    if header_size > MAX_MEDIA_HEADER_SIZE:
+        return {}
+    data = _read_at(f, 0, header_size)
+    info = {}
+    offset = 30
+    while offset + 24 <= len(data):
+        guid, object_size = data[offset:offset + 16], struct.unpack_from('<Q', data, offset + 16)[0]
+        if object_size < 24:
+            break
+        if guid == ASF_FILE_PROPERTIES and offset + 104 <= len(data):
+            play_duration, _, preroll = struct.unpack_from('<QQQ', data, offset + 64)
+            if play_duration:
+                info['duration'] = max(0, play_duration / 1e7 - preroll / 1000)
+        elif guid == ASF_STREAM_PROPERTIES and offset + 78 <= len(data):
+            stream_type, specific = data[offset + 24:offset + 40], offset + 78
+            if stream_type == ASF_AUDIO_MEDIA and 'audio' not in info and specific + 8 <= len(data):
+                format_tag, channels, sample_rate = struct.unpack_from('<HHI', data, specific)
+                info.update(audio=WAVE_FORMATS.get(format_tag, 'wma'), channels=channels, sample_rate=sample_rate)
+            elif stream_type == ASF_VIDEO_MEDIA and 'video' not in info and specific + 31 <= len(data):
+                info['width'], info['height'] = struct.unpack_from('<II', data, specific)
+                # compression of the BITMAPINFOHEADER after the format data size
+                info['video'] = data[specific + 27:specific + 31].decode('latin-1').strip('\0 ').lower() or 'wmv'
+        offset += object_size
+    return info
+
+
+def probe_media(path):
+    """Duration, bitrate, codecs and dimensions of a media file, read from its headers.
+
+    Recognizes the format by its signature, then reads only the byte ranges the
+    parser needs. Returns a dict with any of duration (seconds), bitrate (bits
+    per second), video, width, height, audio, sample_rate and channels; an empty
+    dict for formats without a parser or files that can't be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            head = f.read(16)
+            if head[4:8] in (b'ftyp', b'moov', b'mdat', b'free', b'wide', b'skip'):
+                info = _probe_mp4(f, size)
+            elif head[:4] == b'fLaC':
+                info = _probe_flac(f, size)
+            elif head[:4] == b'OggS':
+                info = _probe_ogg(f, size)
+            elif head[:4] in (b'RIFF', b'RIFX'):
+                info = _probe_riff(f, size)
+            elif head[:4] == b'FORM' and head[8:12] in (b'AIFF', b'AIFC'):
+                info = _probe_aiff(f, size)
+            elif head[:4] == b'\x1a\x45\xdf\xa3':
+                info = _probe_matroska(f, size)
+            elif head == ASF_HEADER:
+                info = _probe_asf(f, size)
+            elif head[:3] == b'ID3' or _parse_mpeg_audio_header(head):
+                info = _probe_mpeg_audio(f, size)
+            else:
+                return {}
+    except (OSError, ValueError, IndexError, OverflowError, struct.error):
+        return {}
 
-        self.send_response(206)
-        self.send_header('Content-type', ctype)
+    # damaged headers can hold negative, tiny, infinite or NaN durations
+    duration = info.pop('duration', 0)
+    if 0.001 <= duration < float('inf'):
+        info['duration'] = round(duration, 3)
+        info['bitrate'] = round(size * 8 / duration)
+    return info
 
-        self.send_header("Access-Control-Allow-Origin", "*")
 
-        if last is None or last >= file_len:
-            last = file_len - 1
-        response_length = last - first + 1
+def format_duration(seconds):
+    """3:05 or 1:02:05."""
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}' if hours else f'{minutes}:{seconds:02}'
 
-        self.send_header('Content-Range',
-                         'bytes %s-%s/%s' % (first, last, file_len))
-        self.send_header('Content-Length', str(response_length))
-        self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
-        self.end_headers()
-        return f
 
-    #  START BYTE RANGE SUPPORT (https://github.com/danvk/RangeHTTPServer)
+class MetadataCache:
+    """probe_media() results kept in SQLite, keyed by path and checked against size and mtime.
 
-    def end_headers(self) -> None:
-        self.send_header('Accept-Ranges', 'bytes')
-        return SimpleHTTPRequestHandler.end_headers(self)
+    Recently used entries are also held in memory. get_many() probes the files
+    missing from the cache in parallel on a thread pool (the parsers mostly wait
+    for the disk) and stores them in one transaction, which makes it the tool
+    for listings, playlists and bulk scans of a library.
+    """
 
-    def copyfile(self, source, outputfile):
-        if not self.range:
-            return SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+    MEMORY_ENTRIES = 50000
+    # files per transaction of a bulk scan
+    SCAN_BATCH = 256
+
+    def __init__(self, db_path, workers):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.executor = ThreadPoolExecutor(max(1, workers), thread_name_prefix='metadata')
+        self.hits = 0
+        self.probes = 0
+        self.scanned = 0
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with self.connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, data TEXT) WITHOUT ROWID')
+
+    def connection(self):
+        """sqlite3 connection of the calling thread."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            import sqlite3
+
+            conn = self.local.conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get(self, path, entry):
+        return self.get_many([(path, entry)])[0]
+
+    def get_many(self, files):
+        """Metadata dicts for a list of (path, ListingEntry); the entries supply size and mtime."""
+        results = [None] * len(files)
+        missing = []
+        with self.lock:
+            for i, (path, entry) in enumerate(files):
+                cached = self.memory.get(path)
+                if cached and cached[0] == entry.size and cached[1] == entry.mtime:
+                    self.memory.move_to_end(path)
+                    results[i] = cached[2]
+                else:
+                    missing.append(i)
+            if not missing:
+                self.hits += len(files)
+                return results
+
+        conn = self.connection()
+        stored = {}
+        paths = [files[i][0] for i in missing]
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            stored.update((path, (size, mtime, data)) for path, size, mtime, data in conn.execute(
+                'SELECT path, size, mtime, data FROM metadata WHERE path IN (%s)' % ','.join('?' * len(chunk)),
+                chunk))
+
+        to_probe = []
+        for i in missing:
+            path, entry = files[i]
+            row = stored.get(path)
+            if row and row[0] == entry.size and row[1] == entry.mtime:
+                results[i] = json_loads(row[2])
+            else:
+                to_probe.append(i)
+
+        if to_probe:
+            probed = self.executor.map(probe_media, [files[i][0] for i in to_probe])
+            for i, info in zip(to_probe, probed):
+                results[i] = info
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                                 [(files[i][0], files[i][1].size, files[i][1].mtime, json_dumps(results[i]))
+                                  for i in to_probe])
+
+        with self.lock:
+            self.hits += len(files) - len(to_probe)
+            self.probes += len(to_probe)
+            for i in missing:
+                path, entry = files[i]
+                self.memory[path] = (entry.size, entry.mtime, results[i])
+            while len(self.memory) > self.MEMORY_ENTRIES:
+                self.memory.popitem(last=False)
+        return results
+
+    def scan_tree(self, root):
+        """Probe every media file below root in the background, a batch at a time."""
+        def scan():
+            started = time.perf_counter()
+            files = walk_media_files(root, recursive=True)
+            try:
+                while True:
+                    batch = list(itertools.islice(files, self.SCAN_BATCH))
+                    if not batch:
+                        break
+                    self.get_many(batch)
+                    self.scanned += len(batch)
+            except Exception as e:
+                log_event('error', 'Metadata scan failed', path=root, error=repr(e))
+            else:
+                log_event('info', 'Metadata scanned', path=root, files=self.scanned,
+                          seconds=round(time.perf_counter() - started, 1))
 
-        # SimpleHTTPRequestHandler uses shutil.copyfileobj, which doesn't let
-        # you stop the copying before the end of the file.
-        start, stop = self.range  # set in send_head()
-        self.copy_byte_range(source, outputfile, start, stop)
+        threading.Thread(target=scan, name='metadata-scan', daemon=True).start()
 
-    def copy_byte_range(self, infile, outfile, start=None, stop=None, bufsize=16 * 1024):
-        """Like shutil.copyfileobj, but only copy a range of the streams.
+    def stats(self):
+        return {'cached_in_memory': len(self.memory), 'hits': self.hits, 'probes': self.probes,
+                'scanned': self.scanned}
 
-        Both start and stop are inclusive.
-        """
-        if start is not None:
-            infile.seek(start)
-        while 1:
-            to_read = min(bufsize, stop + 1 - infile.tell() if stop else bufsize)
-            buf = infile.read(to_read)
-            if not buf:
-                break
-            outfile.write(buf)
 
-    def parse_byte_range(self, byte_range):
-        """Returns the two numbers in 'bytes=123-456' or throws ValueError.
+metadata_cache = None
 
-        The last number or both numbers may be None.
-        """
-        if byte_range.strip() == '':
-            return None, None
 
-        m = REGEX_BYTE_RANGE.match(byte_range)
-        if not m:
-            raise ValueError('Invalid byte range %s' % byte_range)
+def get_media_metadata(files):
+    """Metadata of a list of (path, ListingEntry), from the metadata cache; empty dicts without one."""
+    if metadata_cache is None:
+        return [{}] * len(files)
+    return metadata_cache.get_many(files)
 
-        first, last = [x and int(x) for x in m.groups()]
-        if last and last < first:
-            raise ValueError('Invalid byte range %s' % byte_range)
-        return first, last
 
-    # END BYTE RANGE SUPPORT
+def walk_media_files(dir_path, recursive=False, show_hidden=False, sort='name', reverse=False):
+    """Yield (path, ListingEntry) for the media files in dir_path, and below it if recursive.
 
-    def do_GET(self):
+    Folders are read with scan_directory() as the walk goes, so the first files
+    come out before the tree is explored. The files of a folder are sorted by
+    LISTING_SORT_KEYS[sort] and precede its subfolders, which follow in name
+    order. Symlinked folders are entered once; unreadable ones are skipped.
+    """
+    sort_key = LISTING_SORT_KEYS[sort]
+    seen = set()
+    stack = [dir_path]
+    while stack:
+        path = stack.pop()
+        try:
+            st = os.stat(path)
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            entries = scan_directory(path, show_hidden)
+        except OSError:
+            if path == dir_path:
+                raise
+            continue
 
-        print(self.path)
-        print(self.version_string())
-        sys.stdout.flush()
+        files = [entry for entry in entries if not entry.is_dir and REGEX_MEDIA_FILE.search(entry.name)]
+        files.sort(key=sort_key, reverse=reverse)
+        for entry in files:
+            yield os.path.join(path, entry.name), entry
 
-        path_normalized = Path(self.media_root_dir, unquote(self.path[1:]))
-        absolute_path = str(path_normalized.absolute())
+        if recursive:
+            stack.extend(os.path.join(path, entry.name) for entry in reversed(entries) if entry.is_dir)
 
-        if absolute_path.endswith(MEDIALIST_M3U):
-            data = self.generate_m3u(absolute_path)
-            self.send_response(200)
-            self.send_header("Content-type", "audio/mpegurl")
-            self.send_header("Content-length", str(len(data)))
-            self.end_headers()
-            self.wfile.write(data.encode())
-            return
 
-        if IMG_THUMBNAIL_SELECTOR in absolute_path and Image:
-            real_image_path = absolute_path.replace(IMG_THUMBNAIL_SELECTOR, '')
-            thumbnail_binary = make_thumbnail(real_image_path, (300, 200))
-            self.send_response(200)
-            self.send_header("Content-type", "image/jpeg")
-            self.send_header("Content-length", str(len(thumbnail_binary)))
-            self.end_headers()
-            self.wfile.write(thumbnail_binary)
-            return
+def walk_tree(dir_path, show_hidden=False, names=None):
+    """Yield (path, path relative to dir_path, ListingEntry) for the files and folders below dir_path.
 
-        if not path_normalized.is_dir():
-            return SimpleHTTPRequestHandler.do_GET(self)
+    Relative paths use / and end with / for folders, which come before the files
+    of their parent, like in scan_directory(). As in walk_media_files(), folders
+    are read as the walk goes and symlinked folders are entered once. names
+    limits the walk to those entries of dir_path.
+    """
+    seen = set()
+    stack = [(dir_path, '')]
+    while stack:
+        path, rel_path = stack.pop()
+        try:
+            st = os.stat(path)
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            entries = scan_directory(path, show_hidden)
+        except OSError:
+            if path == dir_path:
+                raise
+            continue
+
+        if names is not None and path == dir_path:
+            entries = [entry for entry in entries if entry.name in names]
+        folders = []
+        for entry in entries:
+            entry_path = os.path.join(path, entry.name)
+            entry_rel_path = rel_path + entry.name + ('/' if entry.is_dir else '')
+            yield entry_path, entry_rel_path, entry
+            if entry.is_dir:
+                folders.append((entry_path, entry_rel_path))
+        stack.extend(reversed(folders))
+
+
+class DirectoryListing:
+    """Scanned entries of one folder, plus the HTML rendered from them on first use.
+
+    in_archive marks the folders of a ZIP archive (see ArchiveIndex), which have no files on disk.
+    """
 
-        response_data = self.get_directory_listing()
-        self.send_response(200)
-        self.send_header("Content-type", "text/html; charset=utf-8")
-        response_data_encoded = response_data.encode("utf-8")
-        self.send_header("Content-length", str(len(response_data_encoded)))
-        self.end_headers()
-        self.wfile.write(response_data_encoded)
+    def __init__(self, dir_path, signature, entries, in_archive=False):
+        self.dir_path = dir_path
+        self.signature = signature
+        self.entries = entries
+        self.in_archive = in_archive
+        self.html = None
+        self.sorted_views = {}  # sort field -> (sort keys, entries) in ascending order
+        self._name_index = None
+
+    @property
+    def nbytes(self):
+        """Rough memory footprint, for the cache budget."""
+        size = DirectoryListingCache.ENTRY_OVERHEAD * len(self.entries)
+        size += sum(len(entry.name) for entry in self.entries)
+        # two lists of pointers plus a key tuple per entry and view
+        size += len(self.sorted_views) * len(self.entries) * 100
+        return size + (len(self.html) if self.html else 0)
+
+    def sorted_view(self, sort):
+        """Entries ordered by sort field (folders first) with their sort keys.
+
+        The keys are unique and double as pagination cursors.
+        """
+        view = self.sorted_views.get(sort)
+        if view is None:
+            key_func = LISTING_SORT_KEYS[sort]
+            keyed = sorted((key_func(entry), entry) for entry in self.entries)
+            view = ([key for key, _ in keyed], [entry for _, entry in keyed])
+            self.sorted_views[sort] = view
+        return view
+
+    def names_starting_with(self, prefix):
+        """Names of the files whose lower-cased name starts with prefix (lower-cased), in name order."""
+        if self._name_index is None:
+            self._name_index = sorted((entry.name.lower(), entry.name) for entry in self.entries if not entry.is_dir)
+        index = self._name_index
+        names = []
+        for i in range(bisect_left(index, (prefix,)), len(index)):
+            if not index[i][0].startswith(prefix):
+                break
+            names.append(index[i][1])
+        return names
 
-    def get_directory_listing(self):
 
-        translated_path = self.translate_path(self.path)
+class DirectoryListingCache:
+    """Folder listings keyed by folder path and validated by the folder's mtime and inode.
 
-        entries = self.__list_directory(translated_path)
+    Creating, deleting or renaming an entry updates the mtime of its folder and
+    invalidates the listing; a file rewritten in place keeps its old size in the
+    listing until then. Memory use is bounded by an approximate byte budget with
+    LRU eviction.
+    """
 
-        if entries:
+    # approximate size of a ListingEntry tuple with its ints and string headers
+    ENTRY_OVERHEAD = 250
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.listings = OrderedDict()  # (path, show_hidden) -> DirectoryListing
+        self.sizes = {}  # (path, show_hidden) -> accounted nbytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, dir_path, signature, show_hidden):
+        key = (dir_path, show_hidden)
+        with self.lock:
+            listing = self.listings.get(key)
+            if listing and listing.signature == signature:
+                self.listings.move_to_end(key)
+                self.hits += 1
+                return listing
+            self.misses += 1
+            return None
 
-            app_config = os.path.join(get_script_dir(), "config.js")
+    def put(self, listing, show_hidden):
+        """Add or update (e.g. after rendering its HTML) a listing."""
+        key = (listing.dir_path, show_hidden)
+        nbytes = listing.nbytes
+        with self.lock:
+            self.total_bytes += nbytes - self.sizes.pop(key, 0)
+            self.listings.pop(key, None)
+            self.listings[key] = listing
+            self.sizes[key] = nbytes
+            while self.total_bytes > self.max_bytes and len(self.listings) > 1:
+                old_key, _ = self.listings.popitem(last=False)
+                self.total_bytes -= self.sizes.pop(old_key)
 
-            if os.path.exists(app_config):
-                custom_replacements = open(app_config).read()
-            else:
-                custom_replacements = 'URL_TRANSFORMATIONS = [];\n'
 
-            return self.page_template.safe_substitute(file_list=entries, custom_url_transformations=custom_replacements)
+directory_listing_cache = None
 
-    def __list_directory(self, path):
-        """
-        ***COPIED FROM python standard lib***
-        Helper to produce a directory listing (absent index.html).
 
-        Return value is either a file object, or None (indicating an
-        error).  In either case, the headers are sent, making the
-        interface the same as for send_head().
+class ArchiveMember(namedtuple('ArchiveMember', 'archive name header_offset compress_type compress_size crc '
+                                                'st_size st_mtime')):
+    """A file inside a ZIP archive.
 
-        """
-        dir_path = Path(path)
+    Quacks like an os.stat_result for ETags, thumbnail versions and cache keys,
+    and may be passed to get_thumbnail() in place of an image path.
+    """
+    __slots__ = ()
 
-        if not os.access(dir_path, os.R_OK):
-            self.send_error(404, "No permission to list directory")
-            return None
-        else:
-            if '?show=all' not in path:
-                # by default do NOT include dot files
-                file_list_iter = filter(lambda f: not f.name.startswith('.'), dir_path.iterdir())
-            else:
-                file_list_iter = dir_path.iterdir()
-            file_list: list[Path] = sorted(file_list_iter, key=lambda f: (not f.is_dir(), f.name.lower()))
+    @property
+    def st_mtime_ns(self):
+        return int(self.st_mtime * 1e9)
 
-        result = [f'''
-    <nav>
-        <div class="inlined btn-back">
-            <a title="parent folder" href="..">{ICON_BACK}</a>
-        </div>
-        <div class="inlined m3u">
-            <a target="_blank" href="{MEDIALIST_M3U}">M3U</a>
-        </div>
-    </nav>
-    <div style="clear:both"></div>
-<ul>''']
+    @property
+    def st_ino(self):
+        return self.header_offset << 32 | self.crc
 
-        entry: Path
-        for entry in file_list:
-            fullname = entry.absolute()
-            # fullname = os.path.join(path, file_entry)
-            displayname = linkname = entry.name
-            # Append / for directories or @ for symbolic links
-            is_dir = entry.is_dir()
+    def __str__(self):
+        return f'{self.archive}/{self.name}#{self.crc:08x}'
 
-            if is_dir:
-                displayname = entry.name + "/"
-                linkname = entry.name + "/"
-            if entry.is_symlink():
-                displayname = entry.name + "@"
-                # Note: a link to a directory displays with @ and links with /
-            quoted_link = quote(linkname)
 
-            # if no extension then match name
-            extension = get_extension(entry)
-            icon = (is_dir and ICON_DIR) or ICONS_BY_TYPE.get(extension, ICON_UNKNOWN)
+class ArchiveIndex:
+    """Central directory of a ZIP/CBZ archive: its members by name and the folder tree they form.
 
-            if icon:
-                displayname = f"{icon}&nbsp;{html.escape(displayname)}"
+    Folders are keyed by their path inside the archive without slashes at either
+    end, '' being the root; folders that have no entry of their own are implied
+    by the names of their files. Encrypted members and names escaping the
+    archive (absolute, with ..) are left out.
+    """
 
-            size_info = ""
-            link_with_image_preview = ""
-            title = displayname
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.members = {}  # name -> ArchiveMember
+        self.folders = {'': {}}  # folder -> {child name: ListingEntry}
+        self.data_offsets = {}  # name -> offset of the member's data, read from its local header on first use
 
-            if not is_dir:
-                size = pretty_size(entry.stat().st_size)
+        import zipfile
 
-                title = f"{displayname} [{size}]"
+        try:
+            with zipfile.ZipFile(path) as zf:
+                infos = zf.infolist()
+        except (zipfile.BadZipFile, zipfile.LargeZipFile, ValueError, EOFError) as e:
+            raise OSError(f'{path}: {e}') from e
+
+        for info in infos:
+            name = info.filename.replace('\\', '/')
+            parts = [part for part in name.split('/') if part]
+            if not parts or '..' in parts or info.flag_bits & 0x1:
+                continue
+            try:
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+            except (OverflowError, ValueError):
+                mtime = 0
+            for depth in range(1, len(parts) if not info.is_dir() else len(parts) + 1):
+                self._add_folder('/'.join(parts[:depth - 1]), parts[depth - 1], mtime)
+            if info.is_dir():
+                continue
+            name = '/'.join(parts)
+            self.members[name] = ArchiveMember(path, name, info.header_offset, info.compress_type, info.compress_size,
+                                               info.CRC, info.file_size, mtime)
+            self.folders.setdefault('/'.join(parts[:-1]), {})[parts[-1]] = \
+                ListingEntry(parts[-1], False, False, info.file_size, mtime)
+
+    def _add_folder(self, parent, name, mtime):
+        children = self.folders.setdefault(parent, {})
+        if name not in children:
+            children[name] = ListingEntry(name, True, False, 0, mtime)
+            self.folders.setdefault(f'{parent}/{name}' if parent else name, {})
+
+    def folder_entries(self, folder, show_hidden=False):
+        """Entries of a folder of the archive sorted like scan_directory(); raises FileNotFoundError if missing.
+
+        macOS resource forks (__MACOSX) count as hidden.
+        """
+        children = self.folders.get(folder.strip('/'))
+        if children is None:
+            raise FileNotFoundError(f'{self.path}/{folder}')
+        entries = [entry for entry in children.values()
+                   if show_hidden or not (entry.name.startswith('.') or entry.name == '__MACOSX')]
+        entries.sort(key=lambda e: (not e.is_dir, e.name.lower()))
+        return entries
+
+    def is_folder(self, folder):
+        return folder.strip('/') in self.folders
+
+    def data_offset(self, f, member):
+        """Offset of member's data in the archive open as f, past its local header."""
+        offset = self.data_offsets.get(member.name)
+        if offset is None:
+            offset = get_archive_data_offset(f, member)
+            self.data_offsets[member.name] = offset
+        return offset
+
+
+def get_archive_data_offset(f, member):
+    header = _read_at(f, member.header_offset, 30)
+    if len(header) < 30 or header[:4] != b'PK\x03\x04':
+        raise OSError(f'{member.archive}: bad local header of {member.name}')
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return member.header_offset + 30 + name_length + extra_length
+
+
+def read_archive_member(member):
+    """Content of an archive member; reads only its own bytes."""
+    with open(member.archive, 'rb') as f:
+        data = _read_at(f, get_archive_data_offset(f, member), member.compress_size)
+    if member.compress_type == ZIP_DEFLATED:
+        return zlib.decompress(data, -15)
+    if member.compress_type != ZIP_STORED:
+        raise OSError(f'{member.archive}: compression method {member.compress_type} of {member.name} not supported')
+    return data
+
+
+class ArchiveMemberReader(BufferedIOBase):
+    """Inflates a deflated archive member while it is read; what send_head() returns for such members.
+
+    Can't seek, so members read through it are always sent whole.
+    """
+
+    def __init__(self, f, data_offset, member):
+        self.f = f
+        self.f.seek(data_offset)
+        self.remaining = member.compress_size
+        self.inflater = zlib.decompressobj(-15)
+        self.pending = b''
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET or pos != self.position:
+            raise UnsupportedOperation('seek')
+        return pos
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        chunks = [self.pending]
+        available = len(self.pending)
+        while (size is None or size < 0 or available < size) and (self.remaining or self.inflater.unconsumed_tail):
+            data = self.inflater.unconsumed_tail
+            if not data:
+                data = self.f.read(min(self.remaining, ARCHIVE_READ_SIZE))
+                if not data:
+                    break
+                self.remaining -= len(data)
+            chunk = self.inflater.decompress(data, ARCHIVE_READ_SIZE)
+            chunks.append(chunk)
+            available += len(chunk)
+        data = b''.join(chunks)
+        if size is not None and size >= 0:
+            data, self.pending = data[:size], data[size:]
+        else:
+            self.pending = b''
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+class ArchiveIndexCache:
+    """ArchiveIndex of the recently browsed archives, valid while the archive file is unchanged."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict()  # path -> ArchiveIndex
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """ArchiveIndex of the archive at path; raises OSError if it can't be read."""
+        st = os.stat(path)
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            index = self.indexes.get(path)
+            if index and index.signature == signature:
+                self.indexes.move_to_end(path)
+                self.hits += 1
+                return index
+            self.misses += 1
+
+        # read outside the lock; a big central directory takes a while
+        index = ArchiveIndex(path, signature)
+        with self.lock:
+            self.indexes[path] = index
+            self.indexes.move_to_end(path)
+            while len(self.indexes) > self.max_entries:
+                self.indexes.popitem(last=False)
+        return index
+
+
+
+def split_archive_path(path):
+    """(archive file, path inside it) for a path that continues below a ZIP/CBZ file, None otherwise.
+
+    The inner path is '' for the root of the archive; the archive file itself
+    (no separator after its name) is not split.
+    """
+    for match in REGEX_ARCHIVE_PATH.finditer(path):
+        archive = path[:match.end()]
+        if os.path.isfile(archive):
+            return archive, path[match.end() + 1:].replace(os.sep, '/')
+    return None
+
+
+def resolve_archive_path(archive_index_cache, path):
+    """(ArchiveIndex, path inside it) for a path leading into a readable archive, None otherwise.
+
+    archive_index_cache is the server's ArchiveIndexCache; None if archives are not browsed.
+    """
+    if not archive_index_cache:
+        return None
+    archive = split_archive_path(path)
+    if archive is None:
+        return None
+    try:
+        return archive_index_cache.get(archive[0]), archive[1]
+    except OSError:
+        return None
+
+
+def is_browsable_archive(archive_index_cache, entry):
+    """True if the listing entry is an archive that can be browsed like a folder with archive_index_cache."""
+    return archive_index_cache is not None and not entry.is_dir and REGEX_ARCHIVE_FILE.search(entry.name) is not None
+
+
+def list_directory(dir_path, show_hidden=False, archive_index_cache=None):
+    """DirectoryListing of dir_path, from the listing cache if the folder is unchanged.
+
+    With archive_index_cache, dir_path may also be a folder inside an archive.
+    Raises OSError if the folder can't be read.
+    """
+    dir_path = os.path.normpath(dir_path)
+    archive = split_archive_path(dir_path + os.sep) if archive_index_cache else None
+    if archive:
+        index = archive_index_cache.get(archive[0])
+        signature = (index.signature, archive[1])
+    else:
+        st = os.stat(dir_path)
+        signature = (st.st_mtime_ns, st.st_ino, st.st_dev)
+
+    if directory_listing_cache:
+        listing = directory_listing_cache.get(dir_path, signature, show_hidden)
+        if listing:
+            return listing
+
+    if archive:
+        listing = DirectoryListing(dir_path, signature, index.folder_entries(archive[1], show_hidden), in_archive=True)
+    else:
+        listing = DirectoryListing(dir_path, signature, scan_directory(dir_path, show_hidden))
+    if directory_listing_cache:
+        directory_listing_cache.put(listing, show_hidden)
+    return listing
+
+
+class UrlTransformation:
+    """One [/regex/flags, "replacement"] rule of URL_TRANSFORMATIONS in config.js.
+
+    The replacement behaves like String.replace() in the browser: only the first
+    match is replaced, $1, $<name>, $& and $$ are expanded.
+    """
+
+    JS_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, pattern, flags, replacement):
+        re_flags = 0
+        if 'i' in flags:
+            re_flags |= re.IGNORECASE
+        if 'm' in flags:
+            re_flags |= re.MULTILINE
+        if 's' in flags:
+            re_flags |= re.DOTALL
+        # named groups are the only syntax difference that matters here
+        self.regex = re.compile(re.sub(r'(?<!\\)\(\?<(?![=!])', '(?P<', pattern), re_flags)
+        self.replacement = re.sub(r'\\(.)', lambda m: self.JS_ESCAPES.get(m[1], m[1]), replacement)
+
+    def apply(self, name):
+        """The transformed name, or None if the rule doesn't apply."""
+        def expand(match):
+            def token(m):
+                group = m[1]
+                if group == '$':
+                    return '$'
+                if group == '&':
+                    return match[0]
+                try:
+                    return match[int(group) if group.isdigit() else group[1:-1]] or ''
+                except IndexError:
+                    return m[0]
+            return REGEX_JS_REPLACEMENT_TOKEN.sub(token, self.replacement)
+
+        transformed = self.regex.sub(expand, name, count=1)
+        return transformed if transformed != name else None
+
+
+url_transformations = (None, [])
+
+
+def get_url_transformations():
+    """Rules of URL_TRANSFORMATIONS in config.js, parsed again when the file changes."""
+    global url_transformations
+
+    app_config = os.path.join(get_script_dir(), "config.js")
+    try:
+        mtime = os.stat(app_config).st_mtime_ns
+    except OSError:
+        return []
+
+    if url_transformations[0] != mtime:
+        rules = []
+        with open(app_config, encoding='utf-8') as f:
+            for line in f:
+                match = REGEX_JS_URL_TRANSFORMATION.match(line)
+                if match:
+                    try:
+                        rules.append(UrlTransformation(match[1], match[2], match[4]))
+                    except re.error as e:
+                        log_event('warning', 'URL transformation skipped', rule=match[0].strip(), error=str(e))
+        url_transformations = (mtime, rules)
+    return url_transformations[1]
+
+
+def detect_text_encoding(head):
+    """Encoding of a text file from its first bytes.
+
+    A byte order mark decides; otherwise UTF-8 if the bytes decode as such, then
+    the guess of charset_normalizer if it is installed, else Windows-1252.
+    """
+    for bom, encoding in ((codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+                          (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+                          (codecs.BOM_UTF16_BE, 'utf-16')):
+        if head.startswith(bom):
+            return encoding
+    try:
+        # the sample may end in the middle of a character
+        codecs.getincrementaldecoder('utf-8')().decode(head)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    if HAVE_CHARSET_NORMALIZER:
+        from charset_normalizer import from_bytes as detect_charset
+
+        match = detect_charset(head).best()
+        if match:
+            return match.encoding
+    return 'cp1252'
+
+
+def convert_srt_cue(lines):
+    """WebVTT of one SRT cue given as its lines: dotted timestamps, font colors as cue classes."""
+    lines = [REGEX_SRT_TIMESTAMP.sub(lambda m: f'{m[1]}.{m[2].ljust(3, "0")}', line) if '-->' in line else line
+             for line in lines]
+    text = REGEX_SRT_FONT_COLOR.sub(
+        lambda m: '<c%s>%s</c>' % ('.' + SRT_COLOR_CLASSES[m[1].lower()] if m[1].lower() in SRT_COLOR_CLASSES else '',
+                                    m[2].replace('\n', ' ', 1).strip()),
+        '\n'.join(lines))
+    return REGEX_SRT_LINE_BREAK.sub('\n', text)
+
+
+def convert_srt_to_vtt(f):
+    """Convert the SRT file f to WebVTT while reading it; yields the UTF-8 output a few cues at a time."""
+    data = f.read(SUBTITLE_SNIFF_SIZE)
+    decoder = codecs.getincrementaldecoder(detect_text_encoding(data))('replace')
+    yield VTT_HEADER
+
+    pending, cue = '', []
+    while True:
+        text = pending + decoder.decode(data, final=not data)
+        if data and text.endswith('\r'):
+            # the \n of a \r\n may be in the next block
+            text, pending = text[:-1], '\r'
+        else:
+            pending = ''
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        if data:
+            # the last line may continue in the next block
+            pending = lines.pop() + pending
+
+        output = []
+        for line in lines:
+            if line.strip():
+                cue.append(line)
+            elif cue:
+                output.append(convert_srt_cue(cue) + '\n\n')
+                cue = []
+        if not data and cue:
+            output.append(convert_srt_cue(cue) + '\n')
+        if output:
+            yield ''.join(output).encode('utf-8')
+        if not data:
+            break
+        data = f.read(SUBTITLE_SNIFF_SIZE)
+
+
+class SubtitleCache:
+    """Converted subtitles in memory, least recently used first, valid while the source file is unchanged."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, st):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == (st.st_mtime_ns, st.st_size, st.st_ino):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, path, st, data):
+        if len(data) > SUBTITLE_CACHE_MAX_ENTRY:
+            return
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old:
+                self.total_bytes -= len(old[1])
+            self.entries[path] = ((st.st_mtime_ns, st.st_size, st.st_ino), data)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+
+subtitle_cache = None
+
+
+def find_companions(dir_path, name, archive_index_cache=None):
+    """Media, documents and subtitles in dir_path that belong to the file name.
+
+    Returns a dict of lists of paths relative to dir_path: 'media', 'content',
+    'vtt' and 'srt'. The first matching rule of URL_TRANSFORMATIONS comes
+    first if its target exists; then follow the files of the same folder whose
+    names start with the base name (case insensitive).
+    """
+    companions = {'media': [], 'content': [], 'vtt': [], 'srt': []}
+
+    def add(rel_path):
+        lower = rel_path.lower()
+        if lower.endswith('.vtt'):
+            category = 'vtt'
+        elif lower.endswith('.srt'):
+            category = 'srt'
+        elif REGEX_COMPANION_MEDIA.search(lower):
+            category = 'media'
+        elif REGEX_COMPANION_CONTENT.search(lower):
+            category = 'content'
+        else:
+            return
+        if rel_path != name and rel_path not in companions[category]:
+            companions[category].append(rel_path)
+
+    for rule in get_url_transformations():
+        if rule.regex.search(name):
+            transformed = rule.apply(name)
+            if transformed and os.path.isfile(os.path.join(dir_path, *transformed.split('/'))):
+                add(transformed)
+            break
+
+    listing = list_directory(dir_path, archive_index_cache=archive_index_cache)
+    stem = os.path.splitext(name)[0].lower()
+    content_stem = stem
+    for suffix in COMPANION_CONTENT_STRIP:
+        content_stem = content_stem.replace(suffix, '', 1)
+
+    for candidate in listing.names_starting_with(stem):
+        if not REGEX_COMPANION_CONTENT.search(candidate):
+            add(candidate)
+    for candidate in listing.names_starting_with(content_stem):
+        if REGEX_COMPANION_CONTENT.search(candidate):
+            add(candidate)
+
+    return companions
+
+
+class StaticAsset:
+    """A support file held in memory with its compressed variants and validators."""
+
+    def __init__(self, path, st, data):
+        self.path = path
+        self.mtime_ns = st.st_mtime_ns
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.data = data
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        digest = hashlib.sha1(data).hexdigest()
+        self.version = digest[:12]
+        self.etag = f'"{digest[:24]}"'
+        self.checked = time.monotonic()
+
+        # content-coding -> body, kept only where it saves something
+        self.encodings = {}
+        if REGEX_COMPRESSIBLE_ASSET.search(path):
+            compressed = {'gzip': gzip.compress(data, 9, mtime=0)}
+            if brotli:
+                compressed['br'] = brotli.compress(data, quality=11)
+            for encoding, body in compressed.items():
+                if len(body) < len(data):
+                    self.encodings[encoding] = body
+
+    def etag_for(self, encoding):
+        """Strong ETag of one representation; each content-coding needs its own."""
+        return get_encoded_etag(self.etag, encoding)
+
+    @property
+    def etags(self):
+        return [self.etag] + [self.etag_for(encoding) for encoding in self.encodings]
+
+
+class StaticAssets:
+    """Support files of the script folder, loaded once and reloaded when their mtime changes.
+
+    The files are checked at most every CHECK_INTERVAL seconds. Files larger
+    than MAX_SIZE are served from disk as usual.
+    """
+
+    MAX_SIZE = 4 << 20
+    CHECK_INTERVAL = 1
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.assets = {}  # file path -> StaticAsset
+        # (mediabro.html asset, {file path: version of linked asset}, Template, version)
+        self.page = None
+
+    def get(self, path):
+        """StaticAsset of path, None if it doesn't exist or is too big."""
+        asset = self.assets.get(path)
+        now = time.monotonic()
+        if asset and now - asset.checked < self.CHECK_INTERVAL:
+            return asset
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.assets.pop(path, None)
+            return None
+        if asset and asset.mtime_ns == st.st_mtime_ns and asset.size == st.st_size:
+            asset.checked = now
+            return asset
+        if st.st_size > self.MAX_SIZE or not os.path.isfile(path):
+            return None
+
+        with open(path, 'rb') as f:
+            asset = StaticAsset(path, st, f.read())
+        with self.lock:
+            self.assets[path] = asset
+        return asset
+
+    def get_url(self, url_path):
+        """StaticAsset of a /css, /js or /ico URL path."""
+        return self.get(os.path.join(self.root, *url_path.lstrip('/').split('/')))
+
+    def preload(self):
+        """Load and compress all support files; run in the background at startup."""
+        self.page_template()
+        for folder in ('css', 'js', 'ico'):
+            for dir_path, _, file_names in os.walk(os.path.join(self.root, folder)):
+                for file_name in file_names:
+                    url_path = '/' + posixpath.join(os.path.relpath(dir_path, self.root).replace(os.sep, '/'), file_name)
+                    if REGEX_INTERNAL_FILE.match(url_path):
+                        self.get_url(url_path)
+
+    def text(self, file_name):
+        """Contents of a file of the script folder as text, or None if it doesn't exist."""
+        asset = self.get(os.path.join(self.root, file_name))
+        return asset.data.decode('utf-8') if asset else None
+
+    def page_template(self):
+        """Template of mediabro.html, with a ?v= version on the links to support files."""
+        template_asset = self.get(os.path.join(self.root, "mediabro.html"))
+        page = self.page
+        if page and page[0] is template_asset and all(
+                getattr(self.get(path), 'version', None) == version for path, version in page[1].items()):
+            return page[2]
+
+        versions = {}
+
+        def add_version(match):
+            asset = self.get_url(match[2])
+            if not asset:
+                return match[0]
+            versions[asset.path] = asset.version
+            return f'{match[1]}{match[2]}?v={asset.version}{match[3]}'
+
+        text = REGEX_ASSET_LINK.sub(add_version, template_asset.data.decode('utf-8'))
+        self.page = (template_asset, versions, Template(text), hashlib.sha1(text.encode('utf-8')).hexdigest()[:12])
+        return self.page[2]
+
+    def page_version(self):
+        """Changes whenever page_template() does."""
+        self.page_template()
+        return self.page[3]
+
+
+static_assets = None
+
+
+class ChunkedWriter:
+    """Collects small writes into chunks of HTTP/1.1 chunked transfer encoding.
+
+    With chunked=False (HTTP/1.0 clients) the data is written as-is and the
+    response must be delimited by closing the connection.
+    """
+
+    def __init__(self, wfile, chunked=True, bufsize=64 * 1024):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.bufsize = bufsize
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        if data:
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= self.bufsize:
+                self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if self.chunked:
+            self.wfile.write(b'%x\r\n' % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b'\r\n')
+        else:
+            self.wfile.write(data)
+
+    def close(self):
+        self.flush()
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+
+class CompressingWriter:
+    """Compresses a response body on the fly into another writer, with gzip or (if installed) brotli.
+
+    level is a zlib level, 1-9; brotli uses it as its quality.
+    """
+
+    def __init__(self, out, encoding='gzip', level=6):
+        self.out = out
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=level)
+            self.compress = compressor.process
+            self.sync_flush = compressor.flush
+            self.finish = compressor.finish
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compress = compressor.compress
+            self.sync_flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = compressor.flush
+
+    def write(self, data):
+        self.out.write(self.compress(data))
+
+    def flush(self):
+        self.out.write(self.sync_flush())
+        self.out.flush()
+
+    def close(self):
+        self.out.write(self.finish())
+        self.out.close()
+
+
+class NullWriter:
+    """Swallows the body of a response to HEAD."""
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ResponseWriter:
+    """Body of a generated response, compressed if the client accepts it and the body is big enough.
+
+    Nothing is sent until min_size bytes are written, flush() included. A body
+    that stays smaller goes out as-is with a Content-Length; a bigger one is
+    streamed through a CompressingWriter with chunked transfer encoding. A HEAD
+    request gets the headers the GET would get, without the body.
+    """
+
+    def __init__(self, handler, content_type, status=200, etag=None, encoding=None, level=6, min_size=1024,
+                 vary=True, last_modified=None):
+        self.handler = handler
+        self.content_type = content_type
+        self.status = status
+        self.etag = etag
+        self.encoding = encoding
+        self.level = level
+        self.min_size = min_size
+        self.vary = vary
+        self.last_modified = last_modified
+        self.head_only = handler.command == 'HEAD'
+        self.buffer = []
+        self.buffered = 0
+        self.out = None
+
+    def _send_headers(self, encoding, content_length=None):
+        handler = self.handler
+        handler.send_response(self.status)
+        handler.send_header("Content-type", self.content_type)
+        if self.etag:
+            handler.send_validators(get_encoded_etag(self.etag, encoding), self.last_modified)
+        if self.vary:
+            handler.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            handler.send_header("Content-Encoding", encoding)
+        if content_length is not None:
+            handler.send_header("Content-length", str(content_length))
+        elif handler.request_version != 'HTTP/1.0':
+            handler.send_header("Transfer-Encoding", "chunked")
+        else:
+            handler.close_connection = True
+        handler.end_headers()
+
+    def _start(self):
+        self._send_headers(self.encoding)
+        if self.head_only:
+            self.out = NullWriter()
+            self.buffer = None
+            return
+        self.out = ChunkedWriter(self.handler.wfile, self.handler.request_version != 'HTTP/1.0')
+        if self.encoding:
+            self.out = CompressingWriter(self.out, self.encoding, self.level)
+        data = b''.join(self.buffer)
+        self.buffer = None
+        self.out.write(data)
+
+    def write(self, data):
+        if self.out is not None:
+            self.out.write(data)
+            return
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.min_size:
+            self._start()
+
+    def flush(self):
+        """Send what was written so far, once the response has started."""
+        if self.out is not None:
+            self.out.flush()
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            return
+        data = b''.join(self.buffer)
+        self._send_headers(None, len(data))
+        if not self.head_only:
+            self.handler.wfile.write(data)
+
+    def send(self, data):
+        """Send a body that is complete already, in place of write() and close()."""
+        if not self.encoding or len(data) < self.min_size:
+            self._send_headers(None, len(data))
+            if not self.head_only:
+                self.handler.wfile.write(data)
+            return
+        self._start()
+        # in slices, so that the client gets the first of a big body while the rest is compressed
+        for offset in range(0, len(data), COMPRESS_SLICE_SIZE):
+            self.out.write(data[offset:offset + COMPRESS_SLICE_SIZE])
+        self.out.close()
+
+
+class ZipStreamWriter:
+    """Writes a ZIP archive front to back into out, one file at a time and without seeking.
+
+    Each file is followed by a data descriptor, so its CRC and sizes are computed
+    while it is read and a file that shrinks meanwhile still makes a valid
+    archive. ZIP64 fields are used for the files, offsets and counts that need
+    them. Only the central directory records stay in memory until close().
+    """
+
+    def __init__(self, out, level=6, bufsize=256 * 1024):
+        self.out = out
+        self.level = level
+        self.bufsize = bufsize
+        self.offset = 0
+        self.records = []  # central directory records
+
+    def _write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+
+    @staticmethod
+    def _dos_time(mtime):
+        t = time.localtime(max(mtime, ZIP_EPOCH))
+        return (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2), ((t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday)
+
+    def add_folder(self, name, mtime):
+        """An empty folder entry; name ends with /."""
+        dos_time, dos_date = self._dos_time(mtime)
+        encoded = name.encode('utf-8', 'surrogateescape')
+        offset = self.offset
+        self._write(struct.pack('<4s5H3L2H', b'PK\x03\x04', 20, ZIP_FLAG_UTF8, ZIP_STORED,
+                                dos_time, dos_date, 0, 0, 0, len(encoded), 0) + encoded)
+        self.records.append((encoded, ZIP_FLAG_UTF8, ZIP_STORED, dos_time, dos_date, 0, 0, 0, offset,
+                             (0o40755 << 16) | 0x10))
+
+    def add_file(self, name, f, st, compress):
+        """Copy the open file f with stat result st into the archive; at most st.st_size bytes are read.
+
+        Read errors end the file early, the entry stays valid.
+        """
+        dos_time, dos_date = self._dos_time(st.st_mtime)
+        encoded = name.encode('utf-8', 'surrogateescape')
+        method = ZIP_DEFLATED if compress and self.level else ZIP_STORED
+        # deflate may grow incompressible data a little
+        zip64 = st.st_size * 1.05 >= ZIP64_LIMIT
+        flags = ZIP_FLAG_UTF8 | ZIP_FLAG_DATA_DESCRIPTOR
+        offset = self.offset
+        if zip64:
+            extra = struct.pack('<2H2Q', 0x0001, 16, 0, 0)
+            header = struct.pack('<4s5H3L2H', b'PK\x03\x04', 45, flags, method, dos_time, dos_date,
+                                 0, ZIP64_LIMIT, ZIP64_LIMIT, len(encoded), len(extra))
+            self._write(header + encoded + extra)
+        else:
+            self._write(struct.pack('<4s5H3L2H', b'PK\x03\x04', 20, flags, method, dos_time, dos_date,
+                                    0, 0, 0, len(encoded), 0) + encoded)
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15) if method == ZIP_DEFLATED else None
+        crc = size = compressed_size = 0
+        remaining = st.st_size
+        while remaining > 0:
+            try:
+                data = f.read(min(self.bufsize, remaining))
+            except OSError:
+                break
+            if not data:
+                break
+            remaining -= len(data)
+            size += len(data)
+            crc = zlib.crc32(data, crc)
+            if compressor:
+                data = compressor.compress(data)
+            compressed_size += len(data)
+            self._write(data)
+        if compressor:
+            data = compressor.flush()
+            compressed_size += len(data)
+            self._write(data)
+
+        if zip64:
+            self._write(struct.pack('<4sL2Q', b'PK\x07\x08', crc, compressed_size, size))
+        else:
+            self._write(struct.pack('<4s3L', b'PK\x07\x08', crc, compressed_size, size))
+        self.records.append((encoded, flags, method, dos_time, dos_date, crc, compressed_size, size, offset,
+                             (st.st_mode & 0xFFFF) << 16))
+
+    def close(self):
+        """Write the central directory; the archive is complete afterwards."""
+        start = self.offset
+        for encoded, flags, method, dos_time, dos_date, crc, compressed_size, size, offset, attributes \
+                in self.records:
+            # values that don't fit are moved to the ZIP64 extra field, in this order
+            wide = [value for value in (size, compressed_size, offset) if value >= ZIP64_LIMIT]
+            extra = struct.pack('<2H%dQ' % len(wide), 0x0001, 8 * len(wide), *wide) if wide else b''
+            version = 45 if wide else 20
+            self._write(struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 0x0300 | version, version, flags, method,
+                                    dos_time, dos_date, crc, min(compressed_size, ZIP64_LIMIT),
+                                    min(size, ZIP64_LIMIT), len(encoded), len(extra), 0, 0, 0, attributes,
+                                    min(offset, ZIP64_LIMIT)) + encoded + extra)
+        end = self.offset
+        count = len(self.records)
+
+        if count >= 0xFFFF or start >= ZIP64_LIMIT or end - start >= ZIP64_LIMIT:
+            self._write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, end - start, start))
+            self._write(struct.pack('<4sLQL', b'PK\x06\x07', 0, end, 1))
+        self._write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                min(end - start, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0))
+
+
+class CachedFile:
+    """An open file descriptor shared by concurrent requests, with its stat result."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            self.stat = os.fstat(self.fd)
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.checked_at = time.monotonic()
+        self.refs = 0
+        self.evicted = False
+        # platforms without pread need seek + read under a lock
+        self.lock = threading.Lock()
+
+    def is_stale(self, st):
+        return (st.st_mtime_ns, st.st_size, st.st_ino) != (self.stat.st_mtime_ns, self.stat.st_size, self.stat.st_ino)
+
+
+class CachedFileHandle:
+    """File object view of a CachedFile for one response; close() hands it back to the cache.
+
+    Reads use explicit offsets, so any number of handles can share one descriptor.
+    """
+
+    def __init__(self, cache, entry):
+        self.cache = cache
+        self.entry = entry
+        self.pos = 0
+        self.closed = False
+
+    def fileno(self):
+        return self.entry.fd
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.entry.stat.st_size
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, self.entry.stat.st_size - self.pos)
+        if hasattr(os, 'pread'):
+            data = os.pread(self.entry.fd, size, self.pos)
+        else:
+            with self.entry.lock:
+                os.lseek(self.entry.fd, self.pos, os.SEEK_SET)
+                data = os.read(self.entry.fd, size)
+        self.pos += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.cache.release(self.entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class OpenFileCache:
+    """Small LRU cache of open file descriptors and their stat results.
+
+    Scrubbing through a video produces bursts of range requests for the same
+    file; the cache saves an open() and fstat() on each of them. An entry is
+    revalidated with stat() at most once per REVALIDATE_INTERVAL seconds and is
+    replaced when the file's mtime, size or inode changed.
+    """
+
+    REVALIDATE_INTERVAL = 1.0
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # path -> CachedFile; least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, path):
+        """CachedFileHandle for path; raises OSError like open()."""
+        revalidate = False
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry:
+                self.entries.move_to_end(path)
+                entry.refs += 1
+                revalidate = time.monotonic() - entry.checked_at > self.REVALIDATE_INTERVAL
+                if not revalidate:
+                    self.hits += 1
+
+        if revalidate:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is None or entry.is_stale(st):
+                self.release(entry)
+                self._evict(entry)
+                entry = None
+            else:
+                with self.lock:
+                    entry.checked_at = time.monotonic()
+                    self.hits += 1
+
+        if entry:
+            return CachedFileHandle(self, entry)
+
+        entry = CachedFile(path)
+        entry.refs = 1
+        with self.lock:
+            self.misses += 1
+            old_entry = self.entries.pop(path, None)
+            self.entries[path] = entry
+            evicted = [old_entry] if old_entry else []
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[1])
+        for old_entry in evicted:
+            self._evict(old_entry)
+
+        return CachedFileHandle(self, entry)
+
+    def _evict(self, entry):
+        with self.lock:
+            if self.entries.get(entry.path) is entry:
+                del self.entries[entry.path]
+            entry.evicted = True
+            close_now = entry.refs == 0
+        if close_now:
+            os.close(entry.fd)
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            close_now = entry.evicted and entry.refs == 0
+        if close_now:
+            os.close(entry.fd)
+
+
+open_file_cache = None
+
+
+def get_file_type(name, is_dir=False):
+    if is_dir:
+        return 'dir'
+    if REGEX_MEDIA_FILE.search(name):
+        return 'media'
+    if REGEX_IMAGE_FILE.search(name):
+        return 'image'
+    return 'file'
+
+
+class MediaIndex:
+    """Persistent SQLite index of every file below the web root.
+
+    A background thread crawls the tree at startup and then every interval
+    seconds. Rescans are incremental: a folder whose mtime is unchanged is not
+    listed again, only its known sub folders are visited. Like the listing
+    cache this means that files rewritten in place keep their old size until
+    their folder changes. Dot files are skipped; symlinked folders are
+    recorded with type 'link' but not followed.
+
+    With crawl=False the index is only read: the thread watches the database
+    for commits of the crawler in another server process instead.
+    """
+
+    # seconds between checks for commits of another process
+    FOLLOW_INTERVAL = 30
+
+    def __init__(self, root, db_path, interval, crawl=True):
+        self.root = root
+        self.db_path = db_path
+        self.interval = interval
+        self.crawl_enabled = crawl
+        self.local = threading.local()
+        self.crawl_lock = threading.Lock()
+        self.crawls = 0
+        self.last_crawl_seconds = None
+        self.last_crawl_scanned = 0
+        self.last_crawl_skipped = 0
+        # bumped whenever the crawler changed the index; lets dependent caches refresh
+        self.version = 0
+        # objects with dir_changed(rel_dir) and tree_removed(rel_dir), called by the crawler,
+        # and index_reloaded(), called when another process changed the index
+        self.listeners = []
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with self.connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'dir TEXT, name TEXT, type TEXT, size INTEGER, mtime REAL, '
+                         'PRIMARY KEY (dir, name)) WITHOUT ROWID')
+
+    def connection(self):
+        """sqlite3 connection of the calling thread."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            import sqlite3
+
+            conn = self.local.conn = sqlite3.connect(self.db_path, timeout=30)
+        return conn
+
+    def start(self):
+        threading.Thread(target=self._run if self.crawl_enabled else self._follow, name='media-index',
+                         daemon=True).start()
+
+    def _follow(self):
+        conn = self.connection()
+        # changes whenever another connection commits
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        while True:
+            time.sleep(self.FOLLOW_INTERVAL)
+            current = conn.execute('PRAGMA data_version').fetchone()[0]
+            if current != data_version:
+                data_version = current
+                self.version += 1
+                for listener in self.listeners:
+                    listener.index_reloaded()
+
+    def _run(self):
+        while True:
+            try:
+                self.crawl()
+            except Exception as e:
+                log_event('error', 'Index crawl failed', error=repr(e))
+            time.sleep(self.interval)
+
+    def crawl(self):
+        with self.crawl_lock:
+            started = time.perf_counter()
+            scanned = skipped = 0
+            conn = self.connection()
+            stack = ['']
+
+            while stack:
+                rel_dir = stack.pop()
+                try:
+                    st = os.stat(os.path.join(self.root, rel_dir))
+                except OSError:
+                    with conn:
+                        self._delete_tree(conn, rel_dir)
+                    self.version += 1
+                    continue
+
+                row = conn.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (rel_dir,)).fetchone()
+                if row and row[0] == st.st_mtime_ns:
+                    skipped += 1
+                    sub_dirs = [name for name, in conn.execute(
+                        "SELECT name FROM files WHERE dir = ? AND type = 'dir'", (rel_dir,))]
+                else:
+                    scanned += 1
+                    sub_dirs = self._update_dir(conn, rel_dir, st.st_mtime_ns)
+
+                stack.extend(posixpath.join(rel_dir, name) for name in sub_dirs)
+
+            self.crawls += 1
+            self.last_crawl_seconds = round(time.perf_counter() - started, 3)
+            self.last_crawl_scanned = scanned
+            self.last_crawl_skipped = skipped
+            if scanned:
+                self.version += 1
+
+    def _update_dir(self, conn, rel_dir, mtime_ns):
+        try:
+            entries = scan_directory(os.path.join(self.root, rel_dir))
+        except OSError:
+            entries = []
+
+        # symlinked folders are listed but not followed, which rules out cycles
+        sub_dirs = [entry.name for entry in entries if entry.is_dir and not entry.is_symlink]
+
+        with conn:
+            old_dirs = {name for name, in conn.execute(
+                "SELECT name FROM files WHERE dir = ? AND type = 'dir'", (rel_dir,))}
+            for name in old_dirs.difference(sub_dirs):
+                self._delete_tree(conn, posixpath.join(rel_dir, name))
+
+            conn.execute('DELETE FROM files WHERE dir = ?', (rel_dir,))
+            conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', (
+                (rel_dir, entry.name, 'link' if entry.is_dir and entry.is_symlink else get_file_type(entry.name, entry.is_dir),
+                 entry.size, entry.mtime)
+                for entry in entries))
+            conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (rel_dir, mtime_ns))
+
+        for listener in self.listeners:
+            listener.dir_changed(rel_dir)
+
+        return sub_dirs
+
+    def _delete_tree(self, conn, rel_dir):
+        for listener in self.listeners:
+            listener.tree_removed(rel_dir)
+
+        if not rel_dir:
+            conn.execute('DELETE FROM files')
+            conn.execute('DELETE FROM dirs')
+            return
+        like = rel_dir.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+        conn.execute("DELETE FROM files WHERE dir = ? OR dir LIKE ? ESCAPE '\\'", (rel_dir, like))
+        conn.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'", (rel_dir, like))
+
+    def dir_entries(self, rel_dir):
+        """(name, type) of the indexed entries of one folder."""
+        return self.connection().execute('SELECT name, type FROM files WHERE dir = ? ORDER BY name',
+                                         (rel_dir,)).fetchall()
+
+    def file_info(self, path):
+        """(size, mtime) of an indexed entry or None."""
+        rel_dir, name = posixpath.split(path)
+        return self.connection().execute('SELECT size, mtime FROM files WHERE dir = ? AND name = ?',
+                                         (rel_dir, name)).fetchone()
+
+    def iter_files(self):
+        """Yield (path relative to the root, type, size, mtime) for every indexed entry."""
+        cursor = self.connection().execute('SELECT dir, name, type, size, mtime FROM files ORDER BY dir, name')
+        for rel_dir, name, file_type, size, mtime in cursor:
+            yield posixpath.join(rel_dir, name), file_type, size, mtime
+
+    def stats(self):
+        conn = self.connection()
+        return {
+            'files': conn.execute('SELECT COUNT(*) FROM files').fetchone()[0],
+            'dirs': conn.execute('SELECT COUNT(*) FROM dirs').fetchone()[0],
+            'crawls': self.crawls,
+            'last_crawl_seconds': self.last_crawl_seconds,
+            'last_crawl_scanned': self.last_crawl_scanned,
+            'last_crawl_skipped': self.last_crawl_skipped,
+        }
+
+
+media_index = None
+search_index = None
+
+FILE_TYPE_CODES = {'dir': 0, 'link': 1, 'media': 2, 'image': 3, 'file': 4}
+FILE_TYPE_NAMES = {code: name for name, code in FILE_TYPE_CODES.items()}
+
+
+def get_trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchData:
+    """Array-backed storage of the file names of a SearchIndex and their trigram postings.
+
+    File ids index into parallel arrays; the names live UTF-8 encoded in one
+    bytearray, their lower-cased forms in another one for matching. Ids of
+    replaced or removed entries are only marked dead, the postings keep them
+    until the data is rebuilt.
+    """
+
+    def __init__(self):
+        self.names = bytearray()
+        self.name_offsets = array('I', [0])
+        self.lower_names = bytearray()
+        self.lower_offsets = array('I', [0])
+        self.file_dirs = array('I')
+        self.file_types = bytearray()
+        self.alive = bytearray()
+        self.dead = 0
+        self.dirs = []  # dir id -> folder path relative to the root
+        self.dir_ids = {}
+        self.dir_files = {}  # dir id -> array of file ids
+        self.trigrams = {}  # trigram of a lower-cased name -> ascending array of file ids
+
+    def __len__(self):
+        return len(self.file_types) - self.dead
+
+    def name(self, file_id):
+        return self.names[self.name_offsets[file_id]:self.name_offsets[file_id + 1]].decode('utf-8', 'surrogateescape')
+
+    def lower_name(self, file_id):
+        return self.lower_names[self.lower_offsets[file_id]:self.lower_offsets[file_id + 1]].decode('utf-8', 'surrogateescape')
+
+    def path(self, file_id):
+        return posixpath.join(self.dirs[self.file_dirs[file_id]], self.name(file_id))
+
+    def dir_id(self, rel_dir):
+        dir_id = self.dir_ids.get(rel_dir)
+        if dir_id is None:
+            dir_id = self.dir_ids[rel_dir] = len(self.dirs)
+            self.dirs.append(rel_dir)
+            self.dir_files[dir_id] = array('I')
+        return dir_id
+
+    def add(self, rel_dir, name, file_type):
+        file_id = len(self.file_types)
+        dir_id = self.dir_id(rel_dir)
+
+        lower_name = name.lower()
+        self.names += name.encode('utf-8', 'surrogateescape')
+        self.name_offsets.append(len(self.names))
+        self.lower_names += lower_name.encode('utf-8', 'surrogateescape')
+        self.lower_offsets.append(len(self.lower_names))
+        self.file_dirs.append(dir_id)
+        self.file_types.append(FILE_TYPE_CODES.get(file_type, FILE_TYPE_CODES['file']))
+        self.alive.append(1)
+        self.dir_files[dir_id].append(file_id)
+
+        for trigram in get_trigrams(lower_name):
+            postings = self.trigrams.get(trigram)
+            if postings is None:
+                postings = self.trigrams[trigram] = array('I')
+            postings.append(file_id)
+
+    def remove_dir(self, rel_dir):
+        dir_id = self.dir_ids.get(rel_dir)
+        if dir_id is None:
+            return
+        for file_id in self.dir_files[dir_id]:
+            if self.alive[file_id]:
+                self.alive[file_id] = 0
+                self.dead += 1
+        self.dir_files[dir_id] = array('I')
+
+    def remove_tree(self, rel_dir):
+        prefix = rel_dir + '/' if rel_dir else ''
+        for path in [path for path in self.dir_ids if path == rel_dir or path.startswith(prefix)]:
+            self.remove_dir(path)
+
+    def candidates(self, terms):
+        """Live ids whose names may contain all terms (lower-cased, at least 3 characters long)."""
+        postings = []
+        for term in terms:
+            for trigram in get_trigrams(term):
+                posting = self.trigrams.get(trigram)
+                if posting is None:
+                    return set()
+                postings.append(posting)
+
+        postings.sort(key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            if len(result) < 64:
+                # few enough left to check the names directly
+                break
+            result.intersection_update(posting)
+        return result
+
+    def scan(self, term):
+        """Yield the ids whose lower-cased names contain term, for terms too short for trigrams."""
+        needle = term.encode('utf-8', 'surrogateescape')
+        pos = self.lower_names.find(needle)
+        while pos >= 0:
+            file_id = bisect_right(self.lower_offsets, pos) - 1
+            yield file_id
+            pos = self.lower_names.find(needle, self.lower_offsets[file_id + 1])
+
+
+class SearchIndex:
+    """In-memory trigram index over the file names of a MediaIndex.
+
+    Loaded from the index database in the background at startup and kept
+    current through the crawler's per folder change notifications. Once dead
+    ids make up a third of the data it is rebuilt in the background while
+    searches continue on the old data.
+    """
+
+    def __init__(self, media_index):
+        self.media_index = media_index
+        self.lock = threading.Lock()
+        self.data = SearchData()
+        self.ready = False
+        self.rebuilding = False
+        self.reload_pending = False
+        self.dirty_dirs = set()
+        self.dirty_trees = set()
+        media_index.listeners.append(self)
+
+    def start(self):
+        with self.lock:
+            self._start_rebuild()
+
+    def rebuild(self):
+        data = SearchData()
+        for path, file_type, _, _ in self.media_index.iter_files():
+            rel_dir, name = posixpath.split(path)
+            data.add(rel_dir, name, file_type)
+
+        with self.lock:
+            # replay the folders that changed while building
+            for rel_dir in self.dirty_trees:
+                data.remove_tree(rel_dir)
+            for rel_dir in self.dirty_dirs:
+                self._replace_dir(data, rel_dir)
+            self.dirty_dirs.clear()
+            self.dirty_trees.clear()
+            self.data = data
+            self.ready = True
+            self.rebuilding = False
+            if self.reload_pending:
+                self.reload_pending = False
+                self._start_rebuild()
+
+    def _replace_dir(self, data, rel_dir):
+        data.remove_dir(rel_dir)
+        for name, file_type in self.media_index.dir_entries(rel_dir):
+            data.add(rel_dir, name, file_type)
+
+    def dir_changed(self, rel_dir):
+        with self.lock:
+            if self.rebuilding:
+                self.dirty_dirs.add(rel_dir)
+            self._replace_dir(self.data, rel_dir)
+            self._compact_if_needed()
+
+    def tree_removed(self, rel_dir):
+        with self.lock:
+            if self.rebuilding:
+                self.dirty_trees.add(rel_dir)
+            self.data.remove_tree(rel_dir)
+            self._compact_if_needed()
+
+    def index_reloaded(self):
+        with self.lock:
+            if self.rebuilding:
+                self.reload_pending = True
+            else:
+                self._start_rebuild()
+
+    def _compact_if_needed(self):
+        if not self.rebuilding and self.data.dead > max(1000, len(self.data.file_types) // 3):
+            self._start_rebuild()
+
+    def _start_rebuild(self):
+        self.rebuilding = True
+        threading.Thread(target=self.rebuild, name='search-index', daemon=True).start()
+
+    def search(self, query, file_type=None, offset=0, limit=SEARCH_DEFAULT_LIMIT):
+        """Ranked (total number of matches, [(score, file id), ...] of the requested page, data)."""
+        terms = query.lower().split()
+        type_code = FILE_TYPE_CODES.get(file_type)
+
+        with self.lock:
+            data = self.data
+
+        if not terms:
+            return 0, [], data
+
+        long_terms = [term for term in terms if len(term) >= 3]
+        # without trigrams, scan for the longest term, the one likely found in fewest names
+        ids = data.candidates(long_terms) if long_terms else data.scan(max(terms, key=len))
+
+        matches = []
+        phrase = ' '.join(terms)
+        for file_id in ids:
+            if not data.alive[file_id] or (type_code is not None and data.file_types[file_id] != type_code):
+                continue
+            name = data.lower_name(file_id)
+            if not all(term in name for term in terms):
+                continue
+            matches.append((self.score(name, terms, phrase), file_id))
+
+        page = heapq.nlargest(offset + limit, matches, key=lambda match: (match[0], -match[1]))[offset:]
+        return len(matches), page, data
+
+    @staticmethod
+    def score(name, terms, phrase):
+        stem = os.path.splitext(name)[0]
+        score = 0.0
+        if stem == phrase:
+            score += 100
+        elif stem.startswith(phrase):
+            score += 50
+        elif phrase in name:
+            score += 25
+        for term in terms:
+            pos = name.find(term)
+            # matches at the start of a word count more
+            if pos == 0 or not name[pos - 1].isalnum():
+                score += 10
+        # prefer short names, i.e. names that are mostly the match
+        return score - len(name) / 10
+
+
+class AdmissionTicket:
+    __slots__ = ('client', 'notify', 'granted')
+
+    def __init__(self, client, notify):
+        self.client = client
+        self.notify = notify
+        self.granted = False
+
+
+class AdmissionClass:
+    """Bounded concurrency with a bounded queue for one class of work.
+
+    Free slots go to the queued request whose client has the fewest requests
+    running, so one client with many requests can't starve the others; a
+    client never gets more than max_per_client slots. Requests that find the
+    queue full or wait longer than timeout seconds are rejected.
+    """
+
+    def __init__(self, name, max_active, max_queue, timeout):
+        self.name = name
+        self.max_active = max_active
+        self.max_queue = max_queue
+        # leave a quarter of the slots to other clients
+        self.max_per_client = max(1, max_active * 3 // 4)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = 0
+        self.active_by_client = {}
+        self.waiting = []  # AdmissionTickets in arrival order
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def submit(self, client, notify):
+        """Queue a request; notify() is called once it may run, possibly right away.
+
+        Returns the ticket, or None if the queue is full.
+        """
+        ticket = AdmissionTicket(client, notify)
+        with self.lock:
+            self.waiting.append(ticket)
+            self._dispatch()
+            if not ticket.granted and len(self.waiting) > self.max_queue:
+                self.waiting.remove(ticket)
+                self.rejected += 1
+                return None
+        return ticket
+
+    def cancel(self, ticket):
+        """Give up waiting; returns False if the ticket was granted in the meantime."""
+        with self.lock:
+            if ticket.granted:
+                return False
+            self.waiting.remove(ticket)
+            self.timed_out += 1
+            return True
+
+    def acquire(self, client):
+        """Block until the request may run; returns the ticket or None if it was rejected."""
+        event = threading.Event()
+        ticket = self.submit(client, event.set)
+        if ticket and not event.wait(self.timeout) and self.cancel(ticket):
+            return None
+        return ticket
+
+    def release(self, ticket):
+        with self.lock:
+            self.active -= 1
+            count = self.active_by_client[ticket.client] - 1
+            if count:
+                self.active_by_client[ticket.client] = count
+            else:
+                del self.active_by_client[ticket.client]
+            self._dispatch()
+
+    def _dispatch(self):
+        while self.waiting and self.active < self.max_active:
+            chosen = None
+            for ticket in self.waiting:
+                running = self.active_by_client.get(ticket.client, 0)
+                if running < self.max_per_client and (chosen is None or running < chosen_running):
+                    chosen, chosen_running = ticket, running
+                    if not running:
+                        break
+            if chosen is None:
+                return
+
+            self.waiting.remove(chosen)
+            self.active += 1
+            self.active_by_client[chosen.client] = self.active_by_client.get(chosen.client, 0) + 1
+            self.admitted += 1
+            chosen.granted = True
+            chosen.notify()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'active': self.active,
+                'max_active': self.max_active,
+                'waiting': len(self.waiting),
+                'max_queue': self.max_queue,
+                'clients': len(self.active_by_client),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
+
+
+# seconds a client is asked to wait after a 503
+RETRY_AFTER_SECONDS = 2
+
+def get_admission_classes():
+    """The AdmissionClass of each class of work with a --cheap_limit or --expensive_limit, by name."""
+    admission_classes = {}
+    if args.cheap_limit > 0:
+        admission_classes['cheap'] = AdmissionClass('cheap', args.cheap_limit, args.cheap_queue, args.queue_timeout)
+    if args.expensive_limit > 0:
+        admission_classes['expensive'] = AdmissionClass('expensive', args.expensive_limit, args.expensive_queue,
+                                                        args.queue_timeout)
+    return admission_classes
+
+
+def get_admission_class(admission_classes, path):
+    """AdmissionClass of a request path: 'expensive' for rendered content, 'cheap' for files and ZIP downloads.
+
+    Looked up in admission_classes, those of the server. None for requests that are never held back.
+    """
+    if not admission_classes:
+        return None
+    url_path, query = get_url_path(path), path.partition('?')[2]
+    if SERVER_ROUTES.get(url_path) in ('stats', 'metrics'):
+        return None
+    if DOWNLOAD_ZIP_QUERY in query.split('&'):
+        # a long transfer of files rather than rendering work
+        return admission_classes.get('cheap')
+    if query.startswith('mediabro-') or url_path.endswith('/') or url_path.endswith(MEDIALIST_NAMES) \
+            or url_path in SERVER_ROUTES:
+        return admission_classes.get('expensive')
+    return admission_classes.get('cheap')
+
+
+class MyRequestHandler(SimpleHTTPRequestHandler):
+    # HTTP/1.1 for keep-alive and chunked streaming; every response sends Content-Length or is chunked
+    protocol_version = 'HTTP/1.1'
+    # seconds before an idle keep-alive connection is closed
+    timeout = 60
+    #
+    # def end_headers(self):
+    #     # Disable output buffering
+    #     self.server.wsgi_output = False
+    #     super().end_headers()
+
+    # set by AsyncHTTPServer, which admits requests before they reach a thread
+    admission_ticket = None
+    # status code of the response, for the metrics and the access log
+    status = None
+    # where the file sent by copyfile() starts and how long it is; an archive member starts past 0
+    file_offset = 0
+    file_length = None
+
+    def setup(self):
+        SimpleHTTPRequestHandler.setup(self)
+        self.wfile = SocketWriter(self.connection)
+
+    def handle(self):
+        server_metrics.connection_opened()
+        try:
+            SimpleHTTPRequestHandler.handle(self)
+        except ConnectionError:
+            # the client went away, e.g. a player seeking to another position
+            pass
+        finally:
+            server_metrics.connection_closed()
+
+    def __init__(self, request, client_address, server):
+        self.prepare()
+        SimpleHTTPRequestHandler.__init__(self, request, client_address, server)
+
+    def prepare(self):
+        self.media_root_dir = args.webroot
+
+    """Adds support for HTTP 'Range' requests to SimpleHTTPRequestHandler
+
+    The approach is to:
+    - Override send_head to look for 'Range' and respond appropriately.
+    - Override copyfile to only transmit a range when requested.
+    """
+    def send_head(self):
+        """Open a file and send the headers of a full, ranged or conditional (304/412) response.
+
+        Folders are left to SimpleHTTPRequestHandler. Range requests follow RFC 7233,
+        If-Range included; a Range header that can't be parsed is ignored.
+        """
+        self.range = None
+        self.file_offset = 0
+        self.file_length = None
+
+        # Mirroring SimpleHTTPServer.py here
+        path = self.translate_path(self.path)
+        archive = resolve_archive_path(self.server.archive_index_cache, path)
+        if archive:
+            return self.send_archive_member_head(*archive)
+        if path.endswith('/') or os.path.isdir(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+
+        ctype = self.guess_type(path)
+
+        ## override for php
+        if 'php' in path.lower():
+            ctype = 'text/plain'
+
+        try:
+            f = open_file_cache.open(path) if open_file_cache else open(path, 'rb')
+        except IOError:
+            self.send_error(404, 'File not found')
+            return None
+
+        fs = os.fstat(f.fileno())
+        return self.send_file_head(f, ctype, fs.st_size, get_file_etag(fs), fs.st_mtime)
+
+    def send_archive_member_head(self, index, name):
+        """send_head() for a path inside an archive.
+
+        Stored members are sent straight from the archive file, byte ranges
+        included; deflated members are inflated on the fly and always sent whole.
+        """
+        member = index.members.get(name)
+        if member is None:
+            if not index.is_folder(name):
+                self.send_error(404, 'File not found')
+            elif not self.path.partition('?')[0].endswith('/'):
+                # same as SimpleHTTPRequestHandler for folders
+                parts = urlsplit(self.path)
+                self.send_response(301)
+                self.send_header('Location', urlunsplit((parts[0], parts[1], parts[2] + '/', parts[3], parts[4])))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                # HEAD of an archive folder; GET is answered with the listing
+                self.send_response(200)
+                self.send_header('Content-type', 'text/html; charset=utf-8')
+                self.end_headers()
+            return None
+
+        if member.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+            self.send_error(415, 'Compression method not supported')
+            return None
+        try:
+            f = open_file_cache.open(index.path) if open_file_cache else open(index.path, 'rb')
+        except IOError:
+            self.send_error(404, 'File not found')
+            return None
+        try:
+            data_offset = index.data_offset(f, member)
+        except OSError:
+            f.close()
+            self.send_error(404, 'File not found')
+            return None
+
+        if member.compress_type == ZIP_DEFLATED:
+            f = ArchiveMemberReader(f, data_offset, member)
+        else:
+            self.file_offset = data_offset
+        return self.send_file_head(f, self.guess_type(name), member.st_size, get_file_etag(member), member.st_mtime,
+                                   ranged=member.compress_type == ZIP_STORED)
+
+    def send_file_head(self, f, ctype, file_len, etag, mtime, ranged=True):
+        """The headers of a full, ranged or conditional response for the open file f; returns f to copy from.
+
+        Returns None (with f closed) if there is nothing more to send.
+        """
+        if self.respond_if_not_modified(etag, mtime):
+            f.close()
+            return None
+
+        ranges = None
+        if ranged and 'Range' in self.headers and self.if_range_matches(etag, mtime):
+            try:
+                ranges = self.resolve_byte_ranges(self.parse_byte_range(self.headers['Range']), file_len)
+            except ValueError:
+                pass
+            else:
+                if not ranges:
+                    f.close()
+                    self.send_response(416, 'Requested Range Not Satisfiable')
+                    self.send_header('Content-Range', 'bytes */%s' % file_len)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return None
+                if len(ranges) > MAX_BYTE_RANGES:
+                    ranges = None
+
+        if not ranges:
+            self.send_response(200)
+            self.send_header('Content-type', ctype)
+            response_length = file_len
+        elif len(ranges) == 1:
+            self.send_response(206)
+            first, last = ranges[0]
+            self.send_header('Content-type', ctype)
+            self.send_header('Content-Range',
+                             'bytes %s-%s/%s' % (first, last, file_len))
+            response_length = last - first + 1
+        else:
+            self.send_response(206)
+            boundary = uuid.uuid4().hex
+            self.range_part_headers = [
+                ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %s-%s/%s\r\n\r\n'
+                 % (boundary, ctype, first, last, file_len)).encode('latin-1')
+                for first, last in ranges]
+            self.range_trailer = ('\r\n--%s--\r\n' % boundary).encode('latin-1')
+            self.send_header('Content-type', 'multipart/byteranges; boundary=%s' % boundary)
+            response_length = (sum(len(part_header) for part_header in self.range_part_headers)
+                               + sum(last - first + 1 for first, last in ranges)
+                               + len(self.range_trailer))
+
+        self.range = ranges
+        self.file_length = file_len
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header('Content-Length', str(response_length))
+        self.send_validators(etag, mtime)
+        self.end_headers()
+        return f
+
+    #  START BYTE RANGE SUPPORT (https://github.com/danvk/RangeHTTPServer)
+
+    def end_headers(self) -> None:
+        self.send_header('Accept-Ranges', 'bytes')
+        return SimpleHTTPRequestHandler.end_headers(self)
+
+    def copyfile(self, source, outputfile):
+        # SimpleHTTPRequestHandler uses shutil.copyfileobj, which doesn't let
+        # you stop the copying before the end of the file.
+        # a member of an archive starts at file_offset; set in send_head() along with range
+        offset = self.file_offset
+        if not self.range:
+            # never past the length sent in Content-Length, even if the file grew since;
+            # None for the in-memory folder listings of SimpleHTTPRequestHandler
+            self.copy_byte_range(source, outputfile, offset,
+                                 None if self.file_length is None else offset + self.file_length - 1)
+        elif len(self.range) == 1:
+            start, stop = self.range[0]
+            self.copy_byte_range(source, outputfile, offset + start, offset + stop)
+        else:
+            for (start, stop), part_header in zip(self.range, self.range_part_headers):
+                outputfile.write(part_header)
+                self.copy_byte_range(source, outputfile, offset + start, offset + stop)
+            outputfile.write(self.range_trailer)
+
+    def copy_byte_range(self, infile, outfile, start=None, stop=None, bufsize=None):
+        """Like shutil.copyfileobj, but only copy a range of the streams.
+
+        Both start and stop are inclusive; stop=None copies to the end of infile.
+        Writes to the client socket go through sendfile(2) when available, so the
+        data never passes through Python.
+        """
+        start = start or 0
+        count = None if stop is None else stop + 1 - start
+        if count == 0:
+            # socket.sendfile() and loop.sendfile() would take a count of 0 for the whole file
+            return
+
+        # inflated archive members can't be sent by the kernel
+        zero_copy = outfile is self.wfile and args.sendfile and not isinstance(infile, ArchiveMemberReader)
+        if zero_copy and isinstance(self.connection, socket.socket):
+            outfile.flush()
+            # socket.sendfile() falls back to a send() loop where os.sendfile is unavailable
+            outfile.bytes_sent += self.connection.sendfile(infile, start, count)
+            return
+        if zero_copy and isinstance(outfile, TransportWriter):
+            outfile.sendfile(infile, start, count)
+            return
+
+        bufsize = bufsize or args.copy_bufsize << 10
+        infile.seek(start)
+        while count is None or count > 0:
+            buf = infile.read(bufsize if count is None else min(bufsize, count))
+            if not buf:
+                break
+            outfile.write(buf)
+            if count is not None:
+                count -= len(buf)
+
+    def parse_byte_range(self, byte_range):
+        """Returns the ranges in 'bytes=0-99,200-,-500' as (first, last) tuples or throws ValueError.
+
+        Either number may be None: (200, None) is an open-ended range and
+        (None, 500) is a suffix range for the last 500 bytes.
+        """
+        unit, _, range_set = byte_range.partition('=')
+        if unit.strip().lower() != 'bytes':
+            raise ValueError('Invalid byte range %s' % byte_range)
+
+        ranges = []
+        for spec in range_set.split(','):
+            if not spec.strip():
+                continue
+            m = REGEX_BYTE_RANGE.match(spec)
+            if not m:
+                raise ValueError('Invalid byte range %s' % byte_range)
+
+            first, last = [int(x) if x else None for x in m.groups()]
+            if (first is None and last is None) or (first is not None and last is not None and last < first):
+                raise ValueError('Invalid byte range %s' % byte_range)
+            ranges.append((first, last))
+
+        if not ranges:
+            raise ValueError('Invalid byte range %s' % byte_range)
+        return ranges
+
+    def resolve_byte_ranges(self, ranges, file_len):
+        """Turns parsed ranges into sorted, non-overlapping absolute (first, last) pairs.
+
+        Ranges that lie beyond the end of the file are dropped; an empty result
+        means that the request can't be satisfied.
+        """
+        resolved = []
+        for first, last in ranges:
+            if first is None:
+                if last == 0:
+                    continue
+                first, last = max(0, file_len - last), file_len - 1
+            elif first >= file_len:
+                continue
+            elif last is None or last >= file_len:
+                last = file_len - 1
+            resolved.append((first, last))
+
+        merged = []
+        for first, last in sorted(resolved):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
+    # END BYTE RANGE SUPPORT
+
+    def do_GET(self):
+        self.serve_measured(self.serve_get)
+
+    def do_HEAD(self):
+        self.serve_measured(self.serve_head)
+
+    def do_POST(self):
+        self.serve_measured(self.serve_post)
+
+    def serve_measured(self, method):
+        """Serve the request with method, then record it in the metrics and the access log."""
+        started = time.perf_counter()
+        sent_before = self.wfile.bytes_sent
+        self.status = None
+        server_metrics.request_started()
+        try:
+            self.run_admitted(method)
+        finally:
+            seconds = time.perf_counter() - started
+            route = get_request_route(self.path, 'Range' in self.headers)
+            sent = self.wfile.bytes_sent - sent_before
+            server_metrics.request_done(route, self.status, seconds, sent)
+            if access_log:
+                self.log_access(route, seconds, sent)
+
+    def log_access(self, route, seconds, sent):
+        status = self.status or 0
+        level = 'error' if status >= 500 else 'warning' if status >= 400 else 'info'
+        if not access_log.enabled(level):
+            return
+        record = {
+            'client': self.client_address[0],
+            'method': self.command,
+            'path': self.path,
+            'status': status,
+            'route': route,
+            'bytes': sent,
+            'ms': round(seconds * 1000, 2),
+        }
+        if args.workers > 1:
+            record['worker'] = self.server.worker_id
+        if access_log.enabled('debug'):
+            record.update(version=self.request_version, range=self.headers.get('Range'),
+                          referer=self.headers.get('Referer'), user_agent=self.headers.get('User-Agent'))
+        access_log.log(level, record)
+
+    def log_request(self, code='-', size='-'):
+        # called by send_response(); the request is logged once it has been served
+        self.status = int(code)
+
+    def log_message(self, format, *args):
+        # errors answered with send_error() are in the access log with their request already
+        if access_log:
+            access_log.log('debug', {'client': self.client_address[0], 'message': format % args})
+
+    def serve_post(self):
+        """A POST of name=... form fields to a folder URL with ?download=zip: those entries as a ZIP archive."""
+        dir_path = self.translate_path(self.path)
+        if DOWNLOAD_ZIP_QUERY not in self.path.partition('?')[2].split('&') or not os.path.isdir(dir_path):
+            return self.send_error(404, 'Only folders can be downloaded')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return self.send_error(400, 'Invalid Content-Length')
+        if length > DOWNLOAD_ZIP_MAX_FORM:
+            self.close_connection = True
+            return self.send_error(413, 'Selection too large')
+        form = parse_qs(self.rfile.read(length).decode('latin-1') if length else '')
+        names = {name for name in form.get('name', []) if name not in ('', os.curdir, os.pardir)
+                 and '/' not in name and os.sep not in name}
+        if not names:
+            return self.send_error(400, 'No name=... fields selected')
+        return self.send_zip_download(dir_path, names)
+
+    def send_zip_download(self, dir_path, names=None):
+        """Stream dir_path, or its entries in names, as a ZIP archive built while it is sent.
+
+        Hidden entries are left out as in listings, unless show=all. Media,
+        images and other compressed files are stored, the rest is deflated.
+        With --zip_max_files or --zip_max_size the tree is walked before the
+        headers are sent, and a tree over either limit is refused with 403.
+        """
+        show_hidden = 'show=all' in self.path.partition('?')[2]
+        entries = walk_tree(dir_path, show_hidden, names)
+        try:
+            if args.zip_max_files or args.zip_max_size:
+                entries = self.walk_zip_download(entries)
+                if entries is None:
+                    return self.send_error(403, 'Folder too large to download',
+                                           'ZIP downloads are limited to %d files and %d MB'
+                                           % (args.zip_max_files, args.zip_max_size))
+                entries = iter(entries)
+            first = next(entries, None)
+        except OSError:
+            return self.send_error(404, 'No permission to list directory')
+
+        file_name = (os.path.basename(os.path.normpath(dir_path)) or 'download') + '.zip'
+        fallback = file_name.encode('ascii', 'replace').decode().replace('"', '_').replace('\\', '_')
+        self.send_response(200)
+        self.send_header('Content-type', 'application/zip')
+        self.send_header('Content-Disposition', f"attachment; filename=\"{fallback}\"; "
+                                                f"filename*=UTF-8''{quote(file_name, errors='surrogateescape')}")
+        chunked = self.request_version != 'HTTP/1.0'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+
+        bufsize = args.copy_bufsize << 10
+        # file data goes out in chunks of the copy buffer size, the small headers are collected into them
+        out = ChunkedWriter(self.wfile, chunked, bufsize)
+        archive = ZipStreamWriter(out, args.compress_level, bufsize)
+        for path, rel_path, entry in itertools.chain([first] if first else [], entries):
+            if entry.is_dir:
+                archive.add_folder(rel_path, entry.mtime)
+                continue
+            try:
+                st = os.stat(path)
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                f = open(path, 'rb')
+            except OSError:
+                continue
+            with f:
+                archive.add_file(rel_path, f, st, compress=not (
+                    REGEX_MEDIA_FILE.search(entry.name) or REGEX_IMAGE_FILE.search(entry.name)
+                    or REGEX_ARCHIVE_FILE.search(entry.name) or REGEX_COMPRESSED_FILE.search(entry.name)))
+        archive.close()
+        out.close()
+
+    @staticmethod
+    def walk_zip_download(entries):
+        """The list of the walk entries, or None as soon as they exceed --zip_max_files or --zip_max_size."""
+        walked = []
+        files = size = 0
+        for item in entries:
+            walked.append(item)
+            if item[2].is_dir:
+                continue
+            files += 1
+            size += item[2].size
+            if 0 < args.zip_max_files < files or 0 < args.zip_max_size << 20 < size:
+                return None
+        return walked
+
+    def serve_head(self):
+        url_path = get_url_path(self.path)
+        if self.is_local_support_file(url_path):
+            return self.send_static_asset(head_only=True)
+        # generated responses run the same code as GET, so that the headers match; ResponseWriter leaves out the body
+        query = parse_qs(self.path.partition('?')[2], keep_blank_values=True)
+        if url_path.endswith(MEDIALIST_NAMES):
+            return self.send_m3u(os.path.dirname(self.translate_path(self.path)), query)
+        if LIST_JSON_SELECTOR in query:
+            return self.send_directory_json(self.translate_path(self.path), query)
+        if os.path.isdir(self.translate_path(self.path)) or self.is_archive_folder():
+            return self.send_directory_listing()
+        return super().do_HEAD()
+
+    def run_admitted(self, method):
+        """Run method once the request's class of work has a free slot, or answer 503."""
+        admission = get_admission_class(self.server.admission_classes, self.path)
+        if admission is None or self.admission_ticket is not None:
+            return method()
+
+        ticket = admission.acquire(self.client_address[0])
+        if ticket is None:
+            return self.send_service_unavailable()
+        try:
+            method()
+        finally:
+            admission.release(ticket)
+
+    def parse_date_header(self, name):
+        """Timestamp of an HTTP date header, None if missing or invalid."""
+        value = self.headers.get(name)
+        if not value:
+            return None
+        try:
+            return parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return None
+
+    def evaluate_preconditions(self, etags, last_modified=None):
+        """Outcome of the request's conditional headers, in the order of RFC 7232, section 6.
+
+        etags are the entity tags of the current representation(s). Returns 412,
+        304 or None if the request is to be served.
+        """
+        def matches(header, weak):
+            tags = [tag.strip() for tag in header.split(',')]
+            if '*' in tags:
+                return True
+            if weak:
+                return any(tag.removeprefix('W/') in etags for tag in tags)
+            return any(tag in etags for tag in tags if not tag.startswith('W/'))
+
+        if_match = self.headers.get('If-Match')
+        if if_match is not None:
+            if not matches(if_match, weak=False):
+                return 412
+        elif last_modified is not None:
+            since = self.parse_date_header('If-Unmodified-Since')
+            if since is not None and int(last_modified) > since:
+                return 412
+
+        safe = self.command in ('GET', 'HEAD')
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            if matches(if_none_match, weak=True):
+                return 304 if safe else 412
+        elif safe and last_modified is not None:
+            since = self.parse_date_header('If-Modified-Since')
+            if since is not None and int(last_modified) <= since:
+                return 304
+        return None
+
+    def if_range_matches(self, etag, last_modified):
+        """Whether a Range request is to be honored: no If-Range, or one naming the current version."""
+        if_range = self.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(('"', 'W/')):
+            # strong comparison; a weak tag never matches
+            return if_range == etag
+        since = self.parse_date_header('If-Range')
+        return since is not None and int(last_modified) == since
+
+    def send_validators(self, etag, last_modified=None, cache_control='no-cache'):
+        self.send_header("ETag", etag)
+        if last_modified is not None:
+            self.send_header("Last-Modified", self.date_time_string(last_modified))
+        if cache_control:
+            self.send_header("Cache-Control", cache_control)
+
+    def respond_if_not_modified(self, etag, last_modified=None, cache_control='no-cache', etags=None, vary=None):
+        """Answer 304 or 412 if the request's conditions call for it; returns True if it did.
+
+        vary is the Vary header of the full response, which a 304 repeats.
+        """
+        status = self.evaluate_preconditions(etags or [etag], last_modified)
+        if status is None:
+            return False
+
+        self.send_response(status)
+        if status == 304:
+            self.send_validators(etag, last_modified, cache_control)
+            if vary:
+                self.send_header("Vary", vary)
+        else:
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+        return True
+
+    def get_listing_etag(self, dir_path, *variant):
+        """ETag of a rendered listing of dir_path; variant are the other inputs of the rendering.
+
+        A folder inside an archive is tagged after the archive file and its path in there.
+        """
+        try:
+            st = os.stat(dir_path)
+        except OSError:
+            archive = split_archive_path(dir_path) if self.server.archive_index_cache else None
+            if archive is None:
+                return None
+            try:
+                st = os.stat(archive[0])
+            except OSError:
+                return None
+            variant += (archive[1],)
+        raw = repr((st.st_mtime_ns, st.st_ino, st.st_dev, variant, args.suppress_size, args.virtual_list_threshold,
+                    metadata_cache is not None))
+        return '"%s"' % hashlib.sha1(raw.encode('utf-8', 'surrogateescape')).hexdigest()[:24]
+
+    def send_static_asset(self, head_only=False):
+        """Send a support file from memory, compressed if the client accepts it."""
+        url_path, _, query = self.path.partition('?')
+        asset = static_assets.get_url(unquote(url_path))
+        if asset is None:
+            # missing or too big to keep in memory
+            return super().do_HEAD() if head_only else SimpleHTTPRequestHandler.do_GET(self)
+
+        encoding = self.negotiate_encoding([encoding for encoding in ('br', 'gzip') if encoding in asset.encodings])
+        versioned = parse_qs(query).get('v', [None])[-1] == asset.version
+        # unversioned URLs are revalidated, which is cheap with the ETag
+        cache_control = IMMUTABLE_CACHE_CONTROL if versioned else 'no-cache'
+
+        if self.respond_if_not_modified(asset.etag_for(encoding), asset.mtime, cache_control, asset.etags):
+            return
+
+        body = asset.encodings[encoding] if encoding else asset.data
+        self.send_response(200)
+        self.send_validators(asset.etag_for(encoding), asset.mtime, cache_control)
+        if asset.encodings:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-type", asset.content_type)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def send_service_unavailable(self):
+        data = SERVICE_UNAVAILABLE_BODY
+        self.send_response(503)
+        self.send_header("Retry-After", str(RETRY_AFTER_SECONDS))
+        self.send_header("Content-type", "text/plain")
+        self.send_header("Content-length", str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def serve_get(self):
+        url_path = get_url_path(self.path)
+        if url_path == METRICS_PATH:
+            return self.send_body(get_server_metrics(self.server).encode(), METRICS_CONTENT_TYPE)
+
+        if url_path == STATS_PATH:
+            data = json_dumps(get_server_stats(self.server), indent=2).encode()
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        if self.is_local_support_file(url_path):
+            return self.send_static_asset()
+
+        if media_index and url_path == USER_INDEX_JSON:
+            return self.send_media_index()
+
+        if search_index and url_path == SEARCH_PATH:
+            return self.send_search_results(parse_qs(self.path.partition('?')[2]))
+
+        path_normalized = Path(self.media_root_dir, unquote(self.path[1:]))
+        query = parse_qs(self.path.partition('?')[2], keep_blank_values=True)
+
+        if self.path.partition('?')[0].endswith(MEDIALIST_NAMES):
+            return self.send_m3u(os.path.dirname(self.translate_path(self.path)), query)
+
+        if LIST_JSON_SELECTOR in query:
+            return self.send_directory_json(self.translate_path(self.path), query)
+
+        if query.get('download') == ['zip'] and os.path.isdir(self.translate_path(self.path)):
+            return self.send_zip_download(self.translate_path(self.path))
+
+        if COMPANIONS_JSON_SELECTOR in query:
+            return self.send_companions_json()
+
+        if SRT_AS_VTT_SELECTOR in query:
+            return self.send_srt_as_vtt()
+
+        if IMG_THUMBNAIL_SELECTOR[1:] in query:
+            real_image_path = self.translate_path(self.path)
+            try:
+                st = os.stat(real_image_path)
+            except OSError:
+                st = None
+            image = real_image_path
+            if st is None:
+                # an image inside an archive is rendered from the member's bytes alone
+                archive = resolve_archive_path(self.server.archive_index_cache, real_image_path)
+                image = st = archive and archive[0].members.get(archive[1])
+
+            size_class = query.get('size', [None])[-1]
+            size = THUMBNAIL_SIZES.get(size_class) if size_class else THUMBNAIL_SIZE
+            if size is None:
+                return self.send_error(400, 'Invalid thumbnail size')
+
+            # without Pillow there are no thumbnails, the original image is sent instead
+            if st and HAVE_PIL and self.send_thumbnail(image, size, st, query):
+                return
+
+        if not path_normalized.is_dir() and not self.is_archive_folder():
+            return SimpleHTTPRequestHandler.do_GET(self)
+
+        self.send_directory_listing()
+
+    def send_directory_listing(self):
+        """The HTML listing of the requested folder, or a 304 if the browser has it already."""
+        show_hidden = 'show=all' in self.path.partition('?')[2]
+        etag = self.get_listing_etag(self.translate_path(self.path), 'html', show_hidden, static_assets.page_version())
+        if etag and self.respond_if_not_modified(etag, etags=get_encoded_etags(etag)):
+            return
+
+        response_data = self.get_directory_listing()
+        if response_data is None:
+            return
+        self.send_body(response_data.encode("utf-8"), "text/html; charset=utf-8", etag=etag)
+
+    def start_response(self, content_type, status=200, etag=None, last_modified=None):
+        """Start a generated response; returns the ResponseWriter for the body, to be closed when done."""
+        encoding = self.negotiate_encoding(COMPRESSED_ENCODINGS) if args.compress_level else None
+        return ResponseWriter(self, content_type, status, etag, encoding, args.compress_level, args.compress_min_size,
+                              vary=bool(args.compress_level), last_modified=last_modified)
+
+    def send_body(self, data, content_type, status=200, etag=None, last_modified=None):
+        self.start_response(content_type, status, etag, last_modified).send(data)
+
+    def send_json_error(self, code, message):
+        data = json_dumps({'error': message}).encode()
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_srt_as_vtt(self):
+        """Send an SRT file converted to WebVTT, from the subtitle cache if it is unchanged."""
+        path = self.translate_path(self.path)
+        if not path.lower().endswith('.srt'):
+            return self.send_error(400, 'Only SRT files are converted')
+        try:
+            st = os.stat(path)
+        except OSError:
+            return self.send_error(404, 'File not found')
+
+        etag = get_file_etag(st, '-vtt')
+        if self.respond_if_not_modified(etag, st.st_mtime, etags=get_encoded_etags(etag)):
+            return
+
+        data = subtitle_cache.get(path, st) if subtitle_cache else None
+        if data is not None:
+            return self.send_body(data, "text/vtt; charset=utf-8", etag=etag, last_modified=st.st_mtime)
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return self.send_error(404, 'File not found')
+        with f:
+            out = self.start_response("text/vtt; charset=utf-8", etag=etag, last_modified=st.st_mtime)
+            converted = []
+            for data in convert_srt_to_vtt(f):
+                out.write(data)
+                converted.append(data)
+            out.close()
+        if subtitle_cache:
+            subtitle_cache.put(path, st, b''.join(converted))
+
+    def send_companions_json(self):
+        file_path = self.translate_path(self.path)
+        dir_path, name = os.path.split(file_path)
+        if not name:
+            return self.send_json_error(400, 'Companions are looked up for files only')
+        try:
+            companions = find_companions(dir_path, name, self.server.archive_index_cache)
+        except OSError:
+            return self.send_json_error(404, 'No permission to list directory')
+
+        # with '..' in a rule the target may lie outside the web root
+        root = os.path.abspath(self.media_root_dir)
+        for category, rel_paths in companions.items():
+            companions[category] = [
+                {'name': posixpath.basename(rel_path), 'href': quote(rel_path)}
+                for rel_path in rel_paths
+                if os.path.commonpath([root, os.path.abspath(os.path.join(dir_path, rel_path))]) == root]
+
+        self.send_body(json_dumps(dict(name=name, **companions)).encode(), "application/json")
+
+    def send_directory_json(self, dir_path, query):
+        """Stream one page of a folder listing as JSON.
+
+        Query parameters: limit (0 for everything), cursor (next_cursor of the
+        previous page), sort (name, size, mtime, type), order (asc, desc),
+        filter (case insensitive substring of the name) and type (dir, file,
+        image, media).
+        """
+        def param(name, default):
+            return query.get(name, [default])[-1] or default
+
+        sort = param('sort', 'name')
+        order = param('order', 'asc')
+        type_filter = param('type', 'all')
+        name_filter = param('filter', '').lower()
+        try:
+            limit = int(param('limit', LIST_JSON_DEFAULT_LIMIT))
+            cursor = param('cursor', None)
+            if cursor:
+                cursor = tuple(json_loads(urlsafe_b64decode(cursor.encode() + b'==')))
+        except (ValueError, TypeError):
+            return self.send_json_error(400, 'Invalid limit or cursor')
+
+        if sort not in LISTING_SORT_KEYS or order not in ('asc', 'desc') \
+                or (type_filter != 'all' and type_filter not in LISTING_TYPE_FILTERS):
+            return self.send_json_error(400, 'Invalid sort, order or type')
+        if limit == 0:
+            limit = None
+        elif not 0 < limit <= LIST_JSON_MAX_LIMIT:
+            limit = LIST_JSON_MAX_LIMIT
+
+        show_hidden = param('show', '') == 'all'
+        etag = self.get_listing_etag(dir_path, 'json', self.path.partition('?')[2])
+        if etag and self.respond_if_not_modified(etag, etags=get_encoded_etags(etag)):
+            return
+        try:
+            listing = list_directory(dir_path, show_hidden, self.server.archive_index_cache)
+        except OSError:
+            return self.send_json_error(404, 'No permission to list directory')
+
+        keys, entries = listing.sorted_view(sort)
+        if type_filter != 'all' or name_filter:
+            matches = LISTING_TYPE_FILTERS.get(type_filter, lambda e: True)
+            keyed = [(key, entry) for key, entry in zip(keys, entries)
+                     if matches(entry) and name_filter in entry.name.lower()]
+            keys, entries = [key for key, _ in keyed], [entry for _, entry in keyed]
+
+        # keyset pagination: a cursor is the sort key of the last entry sent, which
+        # stays valid when entries are added or removed between two pages
+        try:
+            if order == 'asc':
+                start = bisect_right(keys, cursor) if cursor else 0
+                end = len(keys) if limit is None else min(len(keys), start + limit)
+                page = range(start, end)
+                has_more = end < len(keys)
+            else:
+                end = bisect_left(keys, cursor) if cursor else len(keys)
+                start = 0 if limit is None else max(0, end - limit)
+                page = range(end - 1, start - 1, -1)
+                has_more = start > 0
+        except TypeError:
+            return self.send_json_error(400, 'Cursor does not match the sort order')
+
+        next_cursor = None
+        if has_more and page:
+            next_cursor = urlsafe_b64encode(json_dumps(keys[page[-1]]).encode()).decode().rstrip('=')
+
+        if directory_listing_cache:
+            # account for the sorted view that may have been added
+            directory_listing_cache.put(listing, show_hidden)
+
+        metadata = {}
+        if metadata_cache and not listing.in_archive:
+            media = [i for i in page if not entries[i].is_dir and REGEX_MEDIA_FILE.search(entries[i].name)]
+            metadata = dict(zip(media, get_media_metadata(
+                [(os.path.join(listing.dir_path, entries[i].name), entries[i]) for i in media])))
+
+        out = self.start_response("application/json", etag=etag)
+        out.write(json_dumps({'path': unquote(self.path.partition('?')[0]),
+                              'dir': listing.dir_path,
+                              'total': len(keys),
+                              'next_cursor': next_cursor})[:-1].encode())
+        out.write(b', "entries": [')
+
+        for n, i in enumerate(page):
+            entry = entries[i]
+            item = {'name': entry.name, 'type': 'dir' if entry.is_dir else 'file',
+                    'size': entry.size, 'mtime': entry.mtime}
+            if entry.is_symlink:
+                item['symlink'] = True
+            if is_browsable_archive(self.server.archive_index_cache, entry):
+                item['archive'] = True
+            if not entry.is_dir and REGEX_IMAGE_FILE.search(entry.name):
+                item['image'] = True
+                item['thumb'] = f'{IMG_THUMBNAIL_SELECTOR[1:]}&v={thumbnail_version(entry.mtime, entry.size)}'
+            if metadata.get(i):
+                item['meta'] = metadata[i]
+            out.write(b'%s%s' % (b',\n' if n else b'\n', json_dumps(item).encode()))
+            if n == 100:
+                # get the first entries to the browser while the rest is encoded
+                out.flush()
+
+        out.write(b'\n]}')
+        out.close()
+
+    def negotiate_encoding(self, available):
+        """The content coding of available the client prefers by Accept-Encoding, None for identity.
+
+        available is in the server's order of preference, which breaks ties. A coding
+        is used unless the client ranks identity explicitly higher.
+        """
+        header = self.headers.get('Accept-Encoding')
+        if not header:
+            return None
+
+        qualities = parse_qualities(header)
+        best, best_q = None, 0.0
+        for coding in available:
+            q = qualities.get(coding, qualities.get('*', 0.0))
+            if q > best_q:
+                best, best_q = coding, q
+        if best is not None and best_q >= qualities.get('identity', 0.0):
+            return best
+        return None
+
+    def send_thumbnail(self, image, size, st, query):
+        """The thumbnail of image in the format the client accepts, or a 304; False if it can't be rendered.
+
+        The ETag and the content type name the format actually sent: a small PNG or
+        GIF goes out as it is, whatever was negotiated, and only the thumbnail itself
+        tells. Those are rendered (or read from the cache) before the conditions are
+        checked; for all other images the negotiated format is certain up front.
+        """
+        fmt = self.negotiate_image_format(get_thumbnail_formats())
+        # the URLs in listings carry the version of the image, so the browser can keep those for good
+        versioned = query.get('v', [None])[-1] == thumbnail_version(st.st_mtime, st.st_size)
+        cache_control = IMMUTABLE_CACHE_CONTROL if versioned else 'no-cache'
+
+        thumbnail_binary = None
+        if st.st_size <= THUMBNAIL_PASSTHROUGH_SIZE:
+            thumbnail_binary = get_thumbnail(image, size, st, fmt)
+            if thumbnail_binary is None:
+                return False
+            fmt = get_thumbnail_format(thumbnail_binary)
+        etag = get_file_etag(st, '-thumb%dx%d-%s' % (*size, fmt))
+        if self.respond_if_not_modified(etag, st.st_mtime, cache_control, vary='Accept'):
+            return True
+
+        if thumbnail_binary is None:
+            thumbnail_binary = get_thumbnail(image, size, st, fmt)
+            if thumbnail_binary is None:
+                return False
+        self.send_response(200)
+        self.send_header("Content-type", 'image/' + fmt)
+        self.send_header("Content-length", str(len(thumbnail_binary)))
+        self.send_validators(etag, st.st_mtime, cache_control)
+        self.send_header("Vary", "Accept")
+        self.end_headers()
+        self.wfile.write(thumbnail_binary)
+        return True
+
+    def negotiate_image_format(self, available):
+        """The first thumbnail format of available the client takes by its Accept header, else the last one.
+
+        Only types named in the header count: browsers send */* for images they can't decode too.
+        """
+        qualities = parse_qualities(self.headers.get('Accept', ''))
+        for fmt in available:
+            if qualities.get(THUMBNAIL_FORMATS[fmt][0], 0.0) > 0:
+                return fmt
+        return available[-1]
+
+    def send_media_index(self):
+        """Stream the whole media index as (optionally compressed) JSON."""
+        out = self.start_response("application/json")
+        out.write(json_dumps({'root': media_index.root, 'fields': ['path', 'type', 'size', 'mtime']})[:-1].encode())
+        out.write(b', "files": [')
+        for n, item in enumerate(media_index.iter_files()):
+            out.write(b'%s%s' % (b',\n' if n else b'\n', json_dumps(item).encode()))
+        out.write(b'\n]}')
+        out.close()
+
+    def send_search_results(self, query):
+        if not search_index.ready:
+            data = json_dumps({'error': 'The search index is still loading'}).encode()
+            self.send_response(503)
+            self.send_header("Retry-After", "5")
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        q = query.get('q', [''])[-1]
+        file_type = query.get('type', [None])[-1]
+        try:
+            offset = max(0, int(query.get('offset', [0])[-1]))
+            limit = min(SEARCH_MAX_LIMIT, max(1, int(query.get('limit', [SEARCH_DEFAULT_LIMIT])[-1])))
+        except ValueError:
+            return self.send_json_error(400, 'Invalid offset or limit')
+        if file_type is not None and file_type not in FILE_TYPE_CODES:
+            return self.send_json_error(400, 'Invalid type')
+
+        started = time.perf_counter()
+        total, page, data = search_index.search(q, file_type, offset, limit)
+
+        results = []
+        for score, file_id in page:
+            path = data.path(file_id)
+            info = media_index.file_info(path) or (None, None)
+            results.append({'path': path,
+                            'url': '/' + quote(path) + ('/' if data.file_types[file_id] == FILE_TYPE_CODES['dir'] else ''),
+                            'type': FILE_TYPE_NAMES[data.file_types[file_id]],
+                            'size': info[0],
+                            'mtime': info[1],
+                            'score': round(score, 2)})
+
+        data = json_dumps({'query': q, 'total': total, 'offset': offset, 'results': results,
+                           'took_ms': round((time.perf_counter() - started) * 1000, 2)}).encode()
+        self.send_body(data, "application/json")
+
+    def is_archive_folder(self):
+        """True if the request is for a folder inside a ZIP archive (the archive's root included)."""
+        if not self.path.partition('?')[0].endswith('/'):
+            return False
+        archive = resolve_archive_path(self.server.archive_index_cache, self.translate_path(self.path))
+        return archive is not None and archive[0].is_folder(archive[1])
+
+    def get_directory_listing(self):
+
+        translated_path = self.translate_path(self.path)
+
+        entries = self.__list_directory(translated_path)
+
+        if entries:
+
+            custom_replacements = static_assets.text("config.js")
+            if custom_replacements is None:
+                custom_replacements = 'URL_TRANSFORMATIONS = [];\n'
+
+            return static_assets.page_template().safe_substitute(file_list=entries,
+                                                                 custom_url_transformations=custom_replacements)
+
+    def __list_directory(self, path):
+        """
+        ***COPIED FROM python standard lib***
+        Helper to produce a directory listing (absent index.html).
+
+        Return value is either a file object, or None (indicating an
+        error).  In either case, the headers are sent, making the
+        interface the same as for send_head().
+
+        """
+        show_hidden = 'show=all' in self.path.partition('?')[2]
+
+        try:
+            listing = list_directory(path, show_hidden, self.server.archive_index_cache)
+        except OSError:
+            self.send_error(404, "No permission to list directory")
+            return None
+
+        if thumbnail_prewarmer and args.prewarm_listings and not listing.in_archive:
+            thumbnail_prewarmer.warm_images([os.path.join(listing.dir_path, entry.name) for entry in listing.entries
+                                             if REGEX_IMAGE_FILE.search(entry.name)])
+
+        if listing.html is None:
+            listing.html = self.__render_file_list(listing, show_hidden)
+            if directory_listing_cache:
+                directory_listing_cache.put(listing, show_hidden)
+
+        return listing.html
+
+    def __render_file_list(self, listing, show_hidden=False):
+        # playlists and ZIP downloads are made from real folders only
+        folder_links = '' if listing.in_archive else f'''
+        <div class="inlined m3u">
+            <a target="_blank" href="{MEDIALIST_M3U8}">M3U</a>
+        </div>
+        <div class="inlined m3u">
+            <a title="download this folder as ZIP" href="?{DOWNLOAD_ZIP_QUERY}{'&show=all' if show_hidden else ''}">ZIP</a>
+        </div>'''
+        result = [f'''
+    <nav>
+        <div class="inlined btn-back">
+            <a title="parent folder" href="..">{ICON_BACK}</a>
+        </div>{folder_links}
+    </nav>
+    <div style="clear:both"></div>''']
+
+        if len(listing.entries) > args.virtual_list_threshold:
+            # too many entries for the DOM; main.js fetches them page by page and renders the visible ones
+            list_src = f'?{LIST_JSON_SELECTOR}' + ('&show=all' if show_hidden else '')
+            result.append(f'''<ul class="virtual-list" data-src="{list_src}" data-dir="{html.escape(listing.dir_path)}" '''
+                          f'''data-total="{len(listing.entries)}" data-suppress-size="{int(args.suppress_size)}"></ul>''')
+            return '\n'.join(result)
+
+        result.append('<ul>')
+
+        media = [entry for entry in listing.entries if not entry.is_dir and REGEX_MEDIA_FILE.search(entry.name)
+                 and not listing.in_archive]
+        metadata = dict(zip(media, get_media_metadata([(os.path.join(listing.dir_path, entry.name), entry)
+                                                        for entry in media])))
+
+        entry: ListingEntry
+        for entry in listing.entries:
+            fullname = html.escape(os.path.join(listing.dir_path, entry.name))
+            displayname = linkname = entry.name
+            # Append / for directories or @ for symbolic links
+            is_dir = entry.is_dir
+
+            if is_dir or is_browsable_archive(self.server.archive_index_cache, entry):
+                displayname = entry.name + "/"
+                linkname = entry.name + "/"
+            if entry.is_symlink:
+                displayname = entry.name + "@"
+                # Note: a link to a directory displays with @ and links with /
+            quoted_link = quote(linkname)
+
+            # if no extension then match name
+            extension = get_extension(entry.name)
+            icon = (is_dir and ICON_DIR) or ICONS_BY_TYPE.get(extension, ICON_UNKNOWN)
+
+            if icon:
+                displayname = f"{icon}&nbsp;{html.escape(displayname)}"
+
+            size_info = ""
+            link_with_image_preview = ""
+            title = displayname
+
+            if not is_dir:
+                size = pretty_size(entry.size)
+                duration = metadata.get(entry, {}).get('duration')
+
+                title = f"{displayname} [{size}]"
 
                 if not args.suppress_size:
                     size_info = size
 
-            file_type = 'dir' if is_dir else 'file'
+                if duration:
+                    title = f"{displayname} [{size}, {format_duration(duration)}]"
+                    size_info = f"{format_duration(duration)} &middot; {size_info}" if size_info \
+                        else format_duration(duration)
+
+            # archives open like folders
+            file_type = 'dir' if is_dir or is_browsable_archive(self.server.archive_index_cache, entry) else 'file'
 
-            if re.search(REGEX_IMAGE_FILE, entry.name):
+            if REGEX_IMAGE_FILE.search(entry.name):
+                version = thumbnail_version(entry.mtime, entry.size)
                 link_with_image_preview = f"""
-        <a class="imglnk" data-name="{entry}" data-type="{file_type}" title="{title}" href="{quoted_link}">
+        <a class="imglnk" data-name="{fullname}" data-type="{file_type}" title="{title}" href="{quoted_link}">
             <div class="preview">
-                <img src="{quoted_link}{IMG_THUMBNAIL_SELECTOR}">
+                <img src="{quoted_link}{IMG_THUMBNAIL_SELECTOR}&v={version}"
+                     srcset="{thumbnail_srcset(quoted_link, version)}" sizes="{THUMBNAIL_SIZES_ATTR}">
             </div>
         </a>"""
 
             result.append(
 f"""    <li>{link_with_image_preview}
-        <a class="fileinfo" data-name="{entry}" data-type="{file_type}" title="{title}" href="{quoted_link}">
+        <a class="fileinfo" data-name="{fullname}" data-type="{file_type}" title="{title}" href="{quoted_link}">
             <span class="fname">{displayname}</span>
             <span class="size">{size_info}</span>
         </a>
@@ -541,36 +5016,6 @@ f"""    <li>{link_with_image_preview}
         return '\n'.join(result)
 
 
-    def __list_directory_bare(self, path):
-        try:
-            list = os.listdir(path)
-        except os.error:
-            self.send_error(404, "No permission to list directory")
-            return None
-
-        # sort file list with folders first
-        list.sort(key=lambda a: (not os.path.isdir(os.path.join(path, a)), a.lower()))
-        result = []
-
-        domain = args.domain
-
-        # for M3U playlists use the LAN IP
-        if domain.startswith(('0.', '127.')):
-            domain = get_ip_address()
-
-        m3u_webroot = self.media_root_dir
-
-        for file_entry in list:
-            fullname = os.path.join(path, file_entry)
-            if m3u_webroot == '/':
-                path_relative_to_webroot = fullname
-            else:
-                path_relative_to_webroot = fullname.replace(m3u_webroot, "")
-
-            result.append((html.escape(file_entry), "http://{}:{}{}".format(domain, args.port, quote(path_relative_to_webroot))))
-
-        return result
-
     @staticmethod
     def is_local_support_file(peth):
         return REGEX_INTERNAL_FILE.match(peth) is not None
@@ -607,39 +5052,455 @@ f"""    <li>{link_with_image_preview}
             path += '/'
         return path
 
-    def generate_m3u(self, path):
+    def send_m3u(self, dir_path, query):
+        """Stream the media files of a folder as an extended M3U playlist in UTF-8.
+
+        Query parameters: recursive (include subfolders), sort (name, size, mtime,
+        type; applied within each folder), order (asc, desc) and show=all.
+        """
+        def param(name, default):
+            return query.get(name, [default])[-1] or default
+
+        recursive = query.get('recursive', ['0'])[-1].lower() not in ('0', 'false', 'no')
+        sort = param('sort', 'name')
+        order = param('order', 'asc')
+        show_hidden = param('show', '') == 'all'
+        if sort not in LISTING_SORT_KEYS or order not in ('asc', 'desc'):
+            return self.send_error(400, 'Invalid sort or order')
 
-        path = path.replace(MEDIALIST_M3U, "")
+        domain = args.domain
+        # for M3U playlists use the LAN IP
+        if not domain or domain.startswith(('0.', '127.')):
+            domain = get_ip_address()
+        base_url = "http://{}:{}/".format(domain, args.port)
+        root = os.path.abspath(self.media_root_dir)
 
-        entries = self.__list_directory_bare(path)
+        # a recursive playlist depends on every folder below, too many to stat for a validator
+        etag = None if recursive else self.get_listing_etag(dir_path, 'm3u', base_url, sort, order, show_hidden)
+        if etag and self.respond_if_not_modified(etag, etags=get_encoded_etags(etag)):
+            return
 
-        if not entries:
-            return ""
+        files = walk_media_files(dir_path, recursive, show_hidden, sort, order == 'desc')
+        try:
+            first = next(files, None)
+        except OSError:
+            return self.send_error(404, "No permission to list directory")
+
+        out = self.start_response("audio/mpegurl; charset=utf-8", etag=etag)
+        out.write(b'#EXTM3U\n')
+        files = itertools.chain([first], files) if first is not None else iter(())
+        while True:
+            batch = list(itertools.islice(files, PLAYLIST_BATCH))
+            if not batch:
+                break
+            for (path, entry), meta in zip(batch, get_media_metadata(batch)):
+                duration = meta.get('duration')
+                title = os.path.splitext(entry.name)[0].replace('\n', ' ').replace('\r', ' ')
+                url = base_url + quote(os.path.relpath(path, root).replace(os.sep, '/'))
+                line = '#EXTINF:%s,%s\n%s\n' % (-1 if duration is None else round(duration), title, url)
+                out.write(line.encode('utf-8', 'surrogateescape'))
+            # get the first tracks to the player while the tree is walked
+            out.flush()
+        out.close()
 
-        entries = [(k, v) for k, v in entries if REGEX_MEDIA_FILE.search(k)]
 
-        return """#EXTM3U
+class ServerState:
+    """What the requests to one server process share; create_server() sets it up from the command line."""
 
-#EXTINF:1.0,""" + """#EXTINF:1.0,""".join((k + "\n" + v + "\n" for k, v in entries))
+    # which of the --workers processes this is
+    worker_id = 0
+    # AdmissionClass by name
+    admission_classes = {}
+    # ArchiveIndexCache of the ZIP/CBZ archives browsed like folders; None with --no_archives
+    archive_index_cache = None
 
 
-class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+class ThreadedHTTPServer(ServerState, socketserver.ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
 
     def __str__(self):
         return "http://%s:%s" % threaded_server.server_address
 
 
+class SocketWriter(BufferedIOBase):
+    """wfile of a threaded MyRequestHandler: unbuffered writes to the socket that count the bytes sent."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes_sent = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sock.sendall(data)
+        with memoryview(data) as view:
+            self.bytes_sent += view.nbytes
+            return view.nbytes
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class TransportWriter:
+    """wfile of an AsyncRequestHandler: hands the writes of the worker thread to the event loop.
+
+    Every write waits until the transport's buffer is below its high-water mark,
+    so a slow client holds up its own worker thread instead of filling memory.
+    """
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.bytes_sent = 0
+
+    def _run(self, coro):
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        if data:
+            self._run(self._write(bytes(data)))
+            self.bytes_sent += len(data)
+        return len(data)
+
+    def sendfile(self, infile, offset, count):
+        self.bytes_sent += self._run(self.loop.sendfile(self.writer.transport, infile, offset, count))
+
+    def flush(self):
+        pass
+
+
+class AsyncRequestHandler(MyRequestHandler):
+    """MyRequestHandler for one request already read by AsyncHTTPServer, run on an executor thread."""
+
+    def __init__(self, request_data, wfile, client_address, server):
+        # what BaseRequestHandler.__init__ and StreamRequestHandler.setup() would do, without a socket
+        self.request = self.connection = None
+        self.client_address = client_address
+        self.server = server
+        self.rfile = BytesIO(request_data)
+        self.wfile = wfile
+        self.prepare()
+
+    def handle_request(self):
+        """Respond to the request; returns True if the connection must be closed."""
+        from concurrent.futures import CancelledError
+
+        try:
+            self.handle_one_request()
+        except (ConnectionError, CancelledError):
+            return True
+        except Exception as e:
+            log_event('error', 'Exception while serving', client=self.client_address[0], path=self.path,
+                      error=repr(e), traceback=traceback.format_exc())
+            return True
+        return self.close_connection
+
+
+class AsyncHTTPServer(ServerState):
+    """HTTP/1.1 server on an asyncio event loop, an alternative to ThreadedHTTPServer.
+
+    Connections are read by the event loop, so idle keep-alive connections cost
+    no thread. Complete requests run through AsyncRequestHandler on a bounded
+    thread pool, where file reads and waiting for thumbnails may block.
+    Pipelined requests are answered in order.
+    """
+
+    def __init__(self, sock, max_threads):
+        self.socket = sock
+        self.server_address = sock.getsockname()[:2]
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.executor = ThreadPoolExecutor(max_threads, thread_name_prefix='http')
+        self.max_threads = max_threads
+        self.connections = 0
+        self.requests = 0
+        self.active_requests = 0
+
+    def __str__(self):
+        return "http://%s:%s" % self.server_address
+
+    def serve_forever(self):
+        import asyncio
+
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _serve(self):
+        import asyncio
+
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket)
+        async with server:
+            await server.serve_forever()
+
+    def server_close(self):
+        self.socket.close()
+
+    async def handle_connection(self, reader, writer):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info('peername')
+        wfile = TransportWriter(loop, writer)
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), MyRequestHandler.timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                    break
+
+                # the body, if any, is handed to the handler along with the header
+                head = head.lstrip(b'\r\n')
+                match = REGEX_CONTENT_LENGTH.search(head)
+                if REGEX_CHUNKED_REQUEST.search(head):
+                    # chunked request bodies are not supported; no way to find the next request
+                    length, close = 0, True
+                else:
+                    length, close = int(match[1]) if match else 0, False
+                try:
+                    body = await reader.readexactly(length) if length else b''
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                # admitted here rather than in the handler, so that waiting requests don't hold threads
+                received = time.perf_counter()
+                request_line = head.split(b'\r\n', 1)[0].split()
+                admission = get_admission_class(self.admission_classes,
+                                                request_line[1].decode('latin-1') if len(request_line) > 1 else '')
+                ticket = admission and await self.admit(admission, client_address[0])
+                if admission and not ticket:
+                    response = SERVICE_UNAVAILABLE_HEAD if request_line[0] == b'HEAD' else \
+                        SERVICE_UNAVAILABLE_HEAD + SERVICE_UNAVAILABLE_BODY
+                    writer.write(response)
+                    server_metrics.request_done(get_request_route(request_line[1].decode('latin-1')), 503,
+                                                time.perf_counter() - received, len(response), started=False)
+                    continue
+
+                handler = AsyncRequestHandler(head + body, wfile, client_address, self)
+                handler.admission_ticket = ticket
+                self.requests += 1
+                self.active_requests += 1
+                try:
+                    close = await loop.run_in_executor(self.executor, handler.handle_request) or close
+                finally:
+                    self.active_requests -= 1
+                    if ticket:
+                        admission.release(ticket)
+                if close:
+                    break
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    @staticmethod
+    async def admit(admission, client):
+        """AdmissionClass.acquire() for the event loop."""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        ticket = admission.submit(client, notify)
+        if ticket is None:
+            return None
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), admission.timeout)
+        except asyncio.TimeoutError:
+            if admission.cancel(ticket):
+                return None
+        return ticket
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            'requests': self.requests,
+            'active_requests': self.active_requests,
+            'threads': self.max_threads,
+        }
+
+
+SERVICE_UNAVAILABLE_BODY = b'Server busy, please retry\n'
+SERVICE_UNAVAILABLE_HEAD = (b'HTTP/1.1 503 Service Unavailable\r\n'
+                            b'Retry-After: %d\r\n'
+                            b'Content-Type: text/plain\r\n'
+                            b'Content-Length: %d\r\n\r\n') % (RETRY_AFTER_SECONDS, len(SERVICE_UNAVAILABLE_BODY))
+
+
+def create_server_socket(server_address, reuse_port=False):
+    """Listening socket for a server; with reuse_port several processes can bind the same port."""
+    return socket.create_server(server_address, backlog=socket.SOMAXCONN, reuse_port=reuse_port)
+
+
+# the first file descriptor passed by systemd socket activation, after stdin, stdout and stderr
+SD_LISTEN_FDS_START = 3
+
+
+def get_inherited_socket(fd=None):
+    """The listening socket handed over by the process that started the server, or None.
+
+    fd is the descriptor given with --fd; without it, the first socket of systemd
+    socket activation (LISTEN_FDS) is used if it is meant for this process. The
+    socket stays open while the server restarts, so no connection is refused.
+    """
+    if fd is None:
+        if os.environ.get('LISTEN_PID') != str(os.getpid()) or int(os.environ.get('LISTEN_FDS', 0)) < 1:
+            return None
+        fd = SD_LISTEN_FDS_START
+        # meant for this process only, not for the ones it starts
+        for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            os.environ.pop(name, None)
+
+    sock = socket.socket(fileno=fd)
+    if not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+        sock.detach()
+        raise OSError(f'file descriptor {fd} is not a listening socket')
+    # systemd passes the socket non-blocking with NonBlocking=yes, which the threaded server can't accept from
+    sock.setblocking(True)
+    sock.set_inheritable(False)
+    return sock
+
+
+def create_server(sock, worker_id=0):
+    """The HTTP server of --engine on an already listening socket, for the worker process worker_id.
+
+    Each process admits requests (see AdmissionClass) on its own.
+    """
+    if args.engine == 'asyncio':
+        server = AsyncHTTPServer(sock, args.engine_threads)
+    else:
+        server = ThreadedHTTPServer(sock.getsockname()[:2], MyRequestHandler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()[:2]
+    server.worker_id = worker_id
+    server.admission_classes = get_admission_classes()
+    if args.archives:
+        server.archive_index_cache = ArchiveIndexCache(ARCHIVE_INDEX_CACHE_SIZE)
+    return server
+
+
+class WorkerSupervisor:
+    """Pre-forks the server processes of --workers and restarts the ones that die.
+
+    On Linux every worker listens on its own SO_REUSEPORT socket and the kernel
+    spreads the connections over them; elsewhere, and with a socket handed over
+    by a service manager, the workers accept from one inherited socket. SIGTERM or Ctrl-C stops the workers with SIGTERM, so that
+    they finish the requests in progress, and kills the rest after
+    SHUTDOWN_TIMEOUT seconds.
+    """
+
+    SHUTDOWN_TIMEOUT = 10
+    # a worker that dies sooner than this after its start is restarted with a delay
+    MIN_UPTIME = 1
+
+    def __init__(self, num_workers, server_address, sock=None):
+        self.num_workers = num_workers
+        self.server_address = server_address
+        self.reuse_port = sock is None and sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT')
+        # bound right away so that a taken port is reported before forking; with
+        # reuse_port it goes to the first worker, otherwise it's shared by all
+        self.socket = sock or create_server_socket(server_address, self.reuse_port)
+        self.workers = {}  # pid -> worker id
+        self.started = {}  # worker id -> time.monotonic() of the last start
+        self.stopping = False
+
+    def run(self):
+        """Returns (worker id, listening socket, restarted) in each worker; exits in the supervisor."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        # stderr: stdout carries the access logs of the workers
+        print(f'Supervisor {os.getpid()} starting {self.num_workers} workers', file=sys.stderr, flush=True)
+
+        for worker_id in range(self.num_workers):
+            worker = self.spawn(worker_id, restarted=False)
+            if worker:
+                return worker
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id = self.workers.pop(pid, None)
+            if worker_id is None or self.stopping:
+                continue
+
+            print(f'Worker {worker_id} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}, restarting',
+                  file=sys.stderr, flush=True)
+            if time.monotonic() - self.started[worker_id] < self.MIN_UPTIME:
+                time.sleep(self.MIN_UPTIME)
+            if not self.stopping:
+                worker = self.spawn(worker_id, restarted=True)
+                if worker:
+                    return worker
+
+        sys.exit(0)
+
+    def spawn(self, worker_id, restarted):
+        sock = self.socket
+        if self.reuse_port:
+            # a socket nobody accepts on would still get its share of the connections
+            sock, self.socket = sock or create_server_socket(self.server_address, reuse_port=True), None
+
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGTERM, signal.SIGALRM):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            return worker_id, sock, restarted
+
+        if self.reuse_port:
+            sock.close()
+        self.workers[pid] = worker_id
+        self.started[worker_id] = time.monotonic()
+        return None
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        signal.alarm(self.SHUTDOWN_TIMEOUT)
+
+    def kill(self, signum, frame):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+
 def get_file_size(path):
     try:
         return pretty_size(os.path.getsize(path))
-    except Exception as e:
-        print(e)
-        sys.stdout.flush()
+    except OSError:
         return '&#x2757;'
 
 
+@lru_cache(maxsize=None)
 def get_ip_address():
+    """The LAN address of this host; looked up when a playlist first needs it, which may block for a while.
+
+    Cached, so later playlists don't wait for it again.
+    """
     try:
         ips = [ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if ip not in (
             "127.0.0.1", "127.0.1.1", "0.0.0.0")
@@ -650,8 +5511,7 @@ def get_ip_address():
         if len(ips):
             return ips[0]
     except Exception as e:
-        print(e)
-        sys.stdout.flush()
+        log_event('warning', 'LAN address lookup failed', error=repr(e))
 
     return '0.0.0.0'
 
@@ -690,29 +5550,314 @@ if __name__ == '__main__':
                         action='store',
                         default=DEFAULT_PORT)
     parser.add_argument('--domain', '-d',
-                        help='domain to use in M3U playlists; by default the curren IP addres is used',
+                        help='address to bind to and to use in M3U playlists; by default all interfaces are bound '
+                             'and playlists use the LAN address, looked up when the first playlist is made',
                         action='store',
-                        default=get_ip_address())
+                        default=None)
+    parser.add_argument('--fd',
+                        help='serve on this already listening socket, e.g. one kept open by a process that restarts '
+                             'the server; a socket passed by systemd socket activation is used without it',
+                        metavar='N',
+                        type=int,
+                        action='store')
     parser.add_argument('--browser', '-b',
                         help="automatically open the system web browser",
                         action='store_true',
                         default=False)
+    parser.add_argument('--engine',
+                        help='threaded: one thread per connection; asyncio: event loop with keep-alive '
+                             'connections and a thread pool for the requests (default: %(default)s)',
+                        choices=('threaded', 'asyncio'),
+                        action='store',
+                        default='threaded')
+    parser.add_argument('--engine_threads',
+                        help='threads serving requests with --engine asyncio (default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=32)
+    parser.add_argument('--workers',
+                        help='number of server processes sharing the port, restarted if they crash '
+                             '(default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=1)
+    parser.add_argument('--cheap_limit',
+                        help='concurrent requests for files and byte ranges; 0 for no limit (default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=256)
+    parser.add_argument('--cheap_queue',
+                        help='file requests waiting for a slot before 503 is answered (default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=256)
+    parser.add_argument('--expensive_limit',
+                        help='concurrent thumbnail, listing, playlist and search requests; 0 for no limit '
+                             '(default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=max(4, 2 * (os.cpu_count() or 1)))
+    parser.add_argument('--expensive_queue',
+                        help='expensive requests waiting for a slot before 503 is answered (default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=128)
+    parser.add_argument('--queue_timeout',
+                        help='seconds a request may wait for a slot (default: %(default)s)',
+                        type=float,
+                        action='store',
+                        default=15)
+    parser.add_argument('--log_level',
+                        help='requests and messages below this level are not logged; info logs every request, '
+                             'warning only 4xx and 5xx responses (default: %(default)s)',
+                        choices=ACCESS_LOG_LEVELS,
+                        action='store',
+                        default='info')
+    parser.add_argument('--log_sample',
+                        help='fraction of the successful requests to log, e.g. 0.01 for 1%% (default: %(default)s)',
+                        type=float,
+                        action='store',
+                        default=1.0)
+    parser.add_argument('--access_log',
+                        help='file to append the JSON lines of the access log to; - for stdout (default: %(default)s)',
+                        metavar='FILE',
+                        action='store',
+                        default='-')
     parser.add_argument('--suppress_size', '-s',
                         help="DON'T show file size in file list",
                         action='store_true',
                         default=False)
+    parser.add_argument('--thumb_cache_dir',
+                        help='folder for the persistent thumbnail cache (default: %(default)s)',
+                        action='store',
+                        default=os.path.join(get_cache_dir(), 'thumbnails'))
+    parser.add_argument('--thumb_cache_size',
+                        help='thumbnail cache budget in MB; 0 disables the cache (default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=DEFAULT_THUMB_CACHE_SIZE)
+    parser.add_argument('--thumb_workers',
+                        help='number of processes rendering thumbnails; 0 renders on the request thread '
+                             '(default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--no_sendfile',
+                        help="copy file data through Python buffers instead of the zero-copy sendfile(2)",
+                        dest='sendfile',
+                        action='store_false',
+                        default=True)
+    parser.add_argument('--copy_bufsize',
+                        help='buffer size in KB for copying file data when sendfile is not used '
+                             '(default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=256)
+    parser.add_argument('--compress_level',
+                        help='gzip level (brotli quality) for listings, playlists and JSON, 1-9; 0 disables '
+                             'compression (default: %(default)s)',
+                        type=int,
+                        choices=range(10),
+                        action='store',
+                        default=6)
+    parser.add_argument('--compress_min_size',
+                        help='smallest response in bytes that gets compressed (default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=1024)
+    parser.add_argument('--fd_cache',
+                        help='number of open media files kept for quick seeking; 0 disables '
+                             '(default: %(default)s)',
+                        type=int,
+                        action='store',
+                        # open files can't be deleted or renamed on windows
+                        default=0 if os.name == 'nt' else 64)
+    parser.add_argument('--listing_cache_size',
+                        help='memory budget in MB for cached folder listings; 0 disables the cache '
+                             '(default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=64)
+    parser.add_argument('--virtual_list_threshold',
+                        help='folders with more entries are loaded incrementally by the browser '
+                             '(default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=DEFAULT_VIRTUAL_LIST_THRESHOLD)
+    parser.add_argument('--zip_max_files',
+                        help='most files in a ZIP download of a folder; 0 for no limit (default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=DEFAULT_ZIP_MAX_FILES)
+    parser.add_argument('--zip_max_size',
+                        help='largest total size in MB of the files in a ZIP download of a folder; 0 for no limit '
+                             '(default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=DEFAULT_ZIP_MAX_SIZE)
+    parser.add_argument('--no_archives',
+                        help="list ZIP and CBZ archives as plain files instead of browsing them like folders",
+                        dest='archives',
+                        action='store_false',
+                        default=True)
+    parser.add_argument('--index',
+                        help='keep a persistent index of all files below the web root, served as /index.json',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--index_db',
+                        help='SQLite file of the index (default: in the cache folder, one per web root)',
+                        action='store',
+                        default=None)
+    parser.add_argument('--index_interval',
+                        help='seconds between incremental rescans of the index (default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=DEFAULT_INDEX_INTERVAL)
+    parser.add_argument('--metadata',
+                        help='read duration, codecs and dimensions of media files for listings and playlists',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--metadata_db',
+                        help='SQLite file of the metadata cache (default: in the cache folder)',
+                        action='store',
+                        default=None)
+    parser.add_argument('--metadata_workers',
+                        help='number of threads reading media headers (default: %(default)s)',
+                        type=int,
+                        action='store',
+                        default=8)
+    parser.add_argument('--metadata_scan',
+                        help='read the metadata of all media files below this folder in the background; '
+                             'implies --metadata, may be given multiple times',
+                        metavar='FOLDER',
+                        action='append',
+                        default=[])
+    parser.add_argument('--thumb_formats',
+                        help='comma separated thumbnail formats by preference, out of %s; each browser gets the '
+                             'first one it accepts that Pillow can write, and JPEG is always the fallback '
+                             '(default: %%(default)s)' % ', '.join(THUMBNAIL_FORMATS),
+                        action='store',
+                        default=','.join(THUMBNAIL_FORMATS))
+    parser.add_argument('--prewarm',
+                        help='render thumbnails for all images below this folder in the background; '
+                             'may be given multiple times',
+                        metavar='FOLDER',
+                        action='append',
+                        default=[])
+    parser.add_argument('--prewarm_listings',
+                        help='render thumbnails of a listed folder in the background before the browser asks',
+                        action='store_true',
+                        default=False)
 
     args = parser.parse_args(sys.argv[1:])
 
-    print("Initializing ThreadedHTTPServer...")
-    threaded_server = ThreadedHTTPServer((args.domain, args.port), MyRequestHandler)
-    print("ThreadedHTTPServer init completed.")
+    if args.workers > 1 and not hasattr(os, 'fork'):
+        parser.error('--workers needs a platform with fork()')
+    if not set(args.thumb_formats.split(',')) <= set(THUMBNAIL_FORMATS):
+        parser.error('--thumb_formats takes ' + ', '.join(THUMBNAIL_FORMATS))
+
+    try:
+        server_socket = get_inherited_socket(args.fd)
+    except (OSError, ValueError) as e:
+        parser.error(f'cannot serve on the inherited socket: {e}')
+    if server_socket:
+        # playlists have to point to the port the socket was bound to
+        args.port = server_socket.getsockname()[1]
+    # all interfaces without --domain, so that startup never waits for the LAN address lookup
+    bind_address = args.domain or ''
+
+    worker_id, restarted = 0, False
+    if args.workers > 1:
+        # everything below runs in each worker process
+        worker_id, server_socket, restarted = WorkerSupervisor(args.workers, (bind_address, args.port),
+                                                               server_socket).run()
+        print(f'Worker {worker_id} started with pid {os.getpid()}')
+
+    if args.log_level != 'off':
+        access_log = AccessLog(sys.stdout if args.access_log == '-' else open(args.access_log, 'a', encoding='utf-8'),
+                               args.log_level, args.log_sample)
+
+    if args.thumb_cache_size > 0:
+        try:
+            thumbnail_cache = ThumbnailCache(args.thumb_cache_dir, args.thumb_cache_size << 20,
+                                             shared=args.workers > 1)
+        except OSError as e:
+            print(f'Thumbnail cache disabled: {e}')
+
+    # the rendering processes are split between the workers
+    thumbnail_renderer = ThumbnailRenderer(-(-args.thumb_workers // args.workers) if HAVE_PIL else 0)
+
+    static_assets = StaticAssets(get_script_dir())
+    threading.Thread(target=static_assets.preload, name='static-assets', daemon=True).start()
+
+    if args.fd_cache > 0:
+        open_file_cache = OpenFileCache(args.fd_cache)
+
+    subtitle_cache = SubtitleCache(SUBTITLE_CACHE_SIZE)
+
+    if args.listing_cache_size > 0:
+        directory_listing_cache = DirectoryListingCache(args.listing_cache_size << 20)
+
+    if args.index:
+        webroot = os.path.abspath(args.webroot)
+        index_db = args.index_db or os.path.join(
+            get_cache_dir(), 'index-%s.sqlite' % hashlib.sha1(webroot.encode('utf-8', 'surrogateescape')).hexdigest()[:12])
+        # one worker crawls, the others follow its changes
+        media_index = MediaIndex(webroot, index_db, args.index_interval, crawl=worker_id == 0)
+        search_index = SearchIndex(media_index)
+        search_index.start()
+        media_index.start()
+
+    if args.metadata or args.metadata_scan:
+        metadata_cache = MetadataCache(args.metadata_db or os.path.join(get_cache_dir(), 'metadata.sqlite'),
+                                       args.metadata_workers)
+        for folder in args.metadata_scan if worker_id == 0 else ():
+            metadata_cache.scan_tree(os.path.abspath(folder))
+
+    if HAVE_PIL and thumbnail_cache and (args.prewarm or args.prewarm_listings):
+        # leave at least half of the workers to interactive requests
+        # the default size class in the preferred format
+        thumbnail_prewarmer = ThumbnailPrewarmer(THUMBNAIL_SIZE, get_thumbnail_formats()[0],
+                                                 max(1, thumbnail_renderer.max_workers // 2))
+        for folder in args.prewarm if worker_id == 0 else ():
+            thumbnail_prewarmer.warm_tree(os.path.abspath(folder))
+
+    if server_socket is None:
+        server_socket = create_server_socket((bind_address, args.port))
+
+    if args.engine == 'asyncio':
+        print("Initializing AsyncHTTPServer...")
+        threaded_server = create_server(server_socket, worker_id)
+        print("AsyncHTTPServer init completed.")
+    else:
+        print("Initializing ThreadedHTTPServer...")
+        threaded_server = create_server(server_socket, worker_id)
+        print("ThreadedHTTPServer init completed.")
     print(threaded_server)
-    url = "http://{}:{}".format(args.domain, args.port)
-    print("Serving on {}".format(url))
+    host = server_socket.getsockname()[0]
+    wildcard = host in ('0.0.0.0', '::')
+    print("Serving on http://{}:{}{}".format(f'[{host}]' if ':' in host else host, args.port,
+                                             ' (all interfaces)' if wildcard else ''))
     sys.stdout.flush()
+    # a browser can't open the wildcard address everywhere
+    url = "http://{}:{}".format('localhost' if wildcard else f'[{host}]' if ':' in host else host, args.port)
+
+    if args.browser and worker_id == 0 and not restarted and not platform.machine() in ('arm', 'aarch64', 'armv7l'):
+        import webbrowser
 
-    if args.browser and not platform.machine() in ('arm', 'aarch64', 'armv7l'):
         webbrowser.open_new_tab(url)
 
-    threaded_server.serve_forever()
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    try:
+        threaded_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        threaded_server.server_close()
+        thumbnail_renderer.shutdown()
+        if access_log:
+            access_log.close()
@@ -0,0 +1,86 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'mediabrowser.py')
+sys.path.insert(0, ROOT)
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=15):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('mediabrowser.py did not start')
+            time.sleep(0.1)
+
+
+class ServerProcess:
+    """A running mediabrowser.py; url is its base URL and output() what it printed so far."""
+
+    def __init__(self, process, url, log_path, cache):
+        self.process = process
+        self.url = url
+        self.log_path = log_path
+        self.cache = cache
+
+    def output(self):
+        with open(self.log_path, encoding='utf-8', errors='replace') as f:
+            return f.read()
+
+
+@contextmanager
+def run_server(webroot, *args, port=None, domain='127.0.0.1', prelude=None, wait=True, **popen_args):
+    """Run mediabrowser.py on webroot with the extra command line args.
+
+    The cache folder is a fresh temporary one. prelude is Python code run in the
+    server process before the script, e.g. to patch a function.
+    """
+    with tempfile.TemporaryDirectory() as cache:
+        port = port or get_free_port()
+        command = [str(webroot), '-p', str(port), *(('-d', domain) if domain else ()), *args]
+        if prelude:
+            command = ['-c', prelude + '\nimport runpy, sys\nsys.argv = sys.argv[1:]\n'
+                             'runpy.run_path(sys.argv[0], run_name="__main__")', SCRIPT, *command]
+        else:
+            command = [SCRIPT, *command]
+        log_path = os.path.join(cache, 'server.log')
+        env = dict(os.environ, XDG_CACHE_HOME=cache, PYTHONUNBUFFERED='1')
+        with open(log_path, 'wb') as log:
+            process = subprocess.Popen([sys.executable, *command], env=env, stdout=log, stderr=subprocess.STDOUT,
+                                       **popen_args)
+        try:
+            if wait:
+                wait_for_port(port, process)
+            yield ServerProcess(process, f'http://127.0.0.1:{port}', log_path, cache)
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    """A mediabrowser.py process serving a fresh folder; yields (base URL, folder)."""
+    webroot = tmp_path_factory.mktemp('webroot')
+    with run_server(webroot) as process:
+        yield process.url, webroot
@@ -0,0 +1,63 @@
+import json
+import time
+import urllib.request
+
+import pytest
+
+from conftest import run_server
+
+
+def log_records(server, timeout=5):
+    """The JSON lines the server wrote so far; waits for the background writer to catch up."""
+    deadline = time.monotonic() + timeout
+    while True:
+        records = [json.loads(line) for line in server.output().splitlines() if line.startswith('{')]
+        if records or time.monotonic() > deadline:
+            return records
+        time.sleep(0.05)
+
+
+def wait_for_record(server, predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for record in log_records(server):
+            if predicate(record):
+                return record
+        time.sleep(0.05)
+    raise AssertionError('no matching log record in:\n' + server.output())
+
+
+def get(url):
+    with urllib.request.urlopen(url) as response:
+        return response.read()
+
+
+def test_requests_are_json_lines(tmp_path):
+    (tmp_path / 'a.txt').write_text('a')
+    with run_server(tmp_path) as server:
+        get(server.url + '/a.txt')
+        record = wait_for_record(server, lambda r: r.get('path') == '/a.txt')
+        assert record['level'] == 'info'
+        assert record['status'] == 200
+        assert record['method'] == 'GET'
+        assert record['bytes'] > 0
+
+
+def test_errors_are_logged_as_messages(tmp_path):
+    pytest.importorskip('PIL')
+    (tmp_path / 'broken.jpg').write_bytes(b'\xff\xd8\xff\xe0 not really a JPEG')
+    with run_server(tmp_path, '--log_level', 'warning') as server:
+        assert get(server.url + '/broken.jpg?mediabro-thumb.jpg').startswith(b'\xff\xd8')
+        record = wait_for_record(server, lambda r: r.get('message') == 'No thumbnail')
+        assert record['level'] == 'warning'
+        assert record['path'].endswith('broken.jpg')
+        # nothing but the startup lines and JSON
+        assert all(line.startswith('{') for line in server.output().split('Serving on', 1)[1].splitlines()[1:])
+
+
+def test_log_off(tmp_path):
+    (tmp_path / 'a.txt').write_text('a')
+    with run_server(tmp_path, '--log_level', 'off') as server:
+        get(server.url + '/a.txt')
+        time.sleep(0.3)
+        assert log_records(server, timeout=0) == []
@@ -0,0 +1,122 @@
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from conftest import run_server
+from mediabrowser import AdmissionClass, get_admission_class
+
+
+def submit(admission, client):
+    return admission.submit(client, lambda: None)
+
+
+def test_slots_and_queue():
+    admission = AdmissionClass('test', 2, 1, 1)
+    first, second = submit(admission, 'a'), submit(admission, 'b')
+    assert first.granted and second.granted
+    waiting = submit(admission, 'c')
+    assert not waiting.granted
+    # the queue is full
+    assert submit(admission, 'd') is None
+
+    admission.release(first)
+    assert waiting.granted
+    assert admission.stats() == {'active': 2, 'max_active': 2, 'waiting': 0, 'max_queue': 1, 'clients': 2,
+                                 'admitted': 3, 'rejected': 1, 'timed_out': 0}
+
+
+def test_fair_share_between_clients():
+    admission = AdmissionClass('test', 4, 10, 1)
+    busy = [submit(admission, 'busy') for _ in range(5)]
+    # one client gets at most three of the four slots
+    assert [ticket.granted for ticket in busy] == [True, True, True, False, False]
+    other = submit(admission, 'other')
+    assert other.granted
+
+    # a free slot goes to the client with the fewest requests running, not the first in line
+    late = submit(admission, 'late')
+    admission.release(other)
+    assert late.granted and not busy[3].granted
+    admission.release(busy[0])
+    assert busy[3].granted
+
+
+def test_timeout():
+    admission = AdmissionClass('test', 1, 1, 0.1)
+    running = admission.acquire('a')
+    started = time.monotonic()
+    assert admission.acquire('b') is None
+    assert time.monotonic() - started >= 0.1
+    assert admission.stats()['timed_out'] == 1
+    assert admission.stats()['waiting'] == 0
+
+    # granted while giving up: the request runs after all
+    waiting = admission.submit('c', lambda: None)
+    admission.release(running)
+    assert not admission.cancel(waiting)
+
+
+def test_blocking_acquire():
+    admission = AdmissionClass('test', 1, 1, 5)
+    running = admission.acquire('a')
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(admission.acquire('b')))
+    waiter.start()
+    time.sleep(0.1)
+    assert not acquired
+    admission.release(running)
+    waiter.join(5)
+    assert acquired[0].granted
+
+
+@pytest.mark.parametrize('path, name', [
+    ('/music/a.mp3', 'cheap'),
+    ('/music/?download=zip', 'cheap'),
+    ('/music/', 'expensive'),
+    ('/music/a.jpg?mediabro-thumb.jpg', 'expensive'),
+    ('/music/medialist.m3u8', 'expensive'),
+    ('/search?q=a', 'expensive'),
+    ('/__stats', None),
+    ('/__metrics?x', None),
+])
+def test_classes(path, name):
+    classes = {'cheap': object(), 'expensive': object()}
+    assert get_admission_class(classes, path) is classes.get(name)
+    assert get_admission_class({}, path) is None
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'asyncio'])
+def test_busy_server_answers_503(tmp_path, engine):
+    (tmp_path / 'big.mp3').write_bytes(bytes(32 << 20))
+    (tmp_path / 'small.txt').write_bytes(b'small')
+    with run_server(tmp_path, '--engine', engine, '--cheap_limit', '1', '--cheap_queue', '0') as server:
+        # a client that doesn't read holds the only slot for files
+        with socket.create_connection(('127.0.0.1', int(server.url.rpartition(':')[2]))) as slow:
+            slow.sendall(b'GET /big.mp3 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            time.sleep(0.5)
+
+            status, headers, body = get(server.url + '/small.txt')
+            assert status == 503
+            assert headers['Retry-After'] == '2'
+            assert body == b'Server busy, please retry\n'
+            # other classes of work and the stats still get through
+            assert get(server.url + '/')[0] == 200
+            assert get(server.url + '/__stats')[0] == 200
+
+        # the slot is freed once the server notices that the client went away
+        deadline = time.monotonic() + 10
+        while (status := get(server.url + '/small.txt')[0]) == 503 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert status == 200
@@ -0,0 +1,146 @@
+import io
+import urllib.error
+import urllib.request
+import zipfile
+
+import pytest
+from PIL import Image
+
+from conftest import run_server
+from mediabrowser import ArchiveIndex
+
+TEXT = b'chapter one\n' * 1000
+DATA = bytes(range(256)) * 64
+
+
+def make_archive(path):
+    image = io.BytesIO()
+    Image.new('RGB', (640, 480), 'red').save(image, 'PNG')
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('pages/p1.png', image.getvalue(), zipfile.ZIP_STORED)
+        zf.writestr('data.bin', DATA, zipfile.ZIP_STORED)
+        zf.writestr('notes/story.txt', TEXT, zipfile.ZIP_DEFLATED)
+        zf.writestr('__MACOSX/._data.bin', b'', zipfile.ZIP_STORED)
+        zf.writestr('../escape.txt', b'', zipfile.ZIP_STORED)
+        zf.writestr('secret.txt', b'not really encrypted', zipfile.ZIP_STORED)
+    mark_encrypted(path, 'secret.txt')
+
+
+def mark_encrypted(path, name):
+    """Set the encryption flag of a member in its local header and central directory entry.
+
+    zipfile can't write encrypted members and resets flag_bits when writing.
+    """
+    data = bytearray(path.read_bytes())
+    with zipfile.ZipFile(path) as zf:
+        data[zf.getinfo(name).header_offset + 6] |= 0x1
+    central = 0
+    while True:
+        central = data.index(b'PK\x01\x02', central)
+        name_length = int.from_bytes(data[central + 28:central + 30], 'little')
+        if data[central + 46:central + 46 + name_length] == name.encode():
+            data[central + 8] |= 0x1
+            break
+        central += 4
+    path.write_bytes(bytes(data))
+
+
+@pytest.fixture(scope='module')
+def comics(tmp_path_factory):
+    webroot = tmp_path_factory.mktemp('webroot')
+    make_archive(webroot / 'issue1.cbz')
+    with run_server(webroot) as server:
+        yield server.url
+
+
+def get(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def test_index_skips_encrypted_and_escaping_names(tmp_path):
+    make_archive(tmp_path / 'issue1.cbz')
+    index = ArchiveIndex(str(tmp_path / 'issue1.cbz'), None)
+    assert sorted(index.members) == ['__MACOSX/._data.bin', 'data.bin', 'notes/story.txt', 'pages/p1.png']
+    assert [entry.name for entry in index.folder_entries('')] == ['notes', 'pages', 'data.bin']
+    assert [entry.name for entry in index.folder_entries('/', show_hidden=True)] == \
+        ['__MACOSX', 'notes', 'pages', 'data.bin']
+    assert index.is_folder('notes/') and not index.is_folder('data.bin')
+    with pytest.raises(FileNotFoundError):
+        index.folder_entries('missing')
+
+
+def test_archive_is_listed_as_folder(comics):
+    status, _, body = get(comics + '/')
+    assert status == 200
+    assert b'href="issue1.cbz/"' in body
+
+
+def test_archive_listing(comics):
+    status, _, body = get(comics + '/issue1.cbz/')
+    assert status == 200
+    for name in (b'pages/', b'notes/', b'data.bin'):
+        assert name in body
+    assert b'secret.txt' not in body and b'escape.txt' not in body and b'__MACOSX' not in body
+    # no playlist or ZIP download of a folder that isn't on disk
+    assert b'medialist.m3u8' not in body and b'download=zip' not in body
+
+    status, _, body = get(comics + '/issue1.cbz/pages/')
+    assert status == 200 and b'p1.png' in body
+
+
+def test_archive_folder_redirect_and_missing_member(comics):
+    request = urllib.request.Request(comics + '/issue1.cbz/pages', method='HEAD')
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args):
+            return None
+
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.build_opener(NoRedirect).open(request)
+    assert e.value.code == 301 and e.value.headers['Location'] == '/issue1.cbz/pages/'
+    assert get(comics + '/issue1.cbz/missing.png')[0] == 404
+    assert get(comics + '/issue1.cbz/secret.txt')[0] == 404
+
+
+def test_stored_member(comics):
+    status, headers, body = get(comics + '/issue1.cbz/data.bin')
+    assert status == 200 and body == DATA
+    assert headers['Content-Length'] == str(len(DATA))
+    assert headers['ETag']
+
+    status, headers, body = get(comics + '/issue1.cbz/data.bin', {'Range': 'bytes=1000-1999'})
+    assert status == 206 and body == DATA[1000:2000]
+    assert headers['Content-Range'] == f'bytes 1000-1999/{len(DATA)}'
+
+    status, _, body = get(comics + '/issue1.cbz/data.bin', {'Range': 'bytes=-10'})
+    assert status == 206 and body == DATA[-10:]
+
+
+def test_deflated_member(comics):
+    status, headers, body = get(comics + '/issue1.cbz/notes/story.txt')
+    assert status == 200 and body == TEXT
+    assert headers['Content-Length'] == str(len(TEXT))
+
+    # inflated on the fly, so always sent whole
+    status, _, body = get(comics + '/issue1.cbz/notes/story.txt', {'Range': 'bytes=0-9'})
+    assert status == 200 and body == TEXT
+
+
+def test_member_thumbnail(comics):
+    status, headers, body = get(comics + '/issue1.cbz/pages/p1.png?mediabro-thumb.jpg', {'Accept': 'image/jpeg'})
+    assert status == 200
+    assert headers['Content-Type'] == 'image/jpeg'
+    thumbnail = Image.open(io.BytesIO(body))
+    assert thumbnail.width < 640 and thumbnail.height < 480
+
+
+def test_no_archives(tmp_path):
+    make_archive(tmp_path / 'issue1.cbz')
+    with run_server(tmp_path, '--no_archives') as server:
+        assert b'href="issue1.cbz"' in get(server.url + '/')[2]
+        assert get(server.url + '/issue1.cbz/data.bin')[0] == 404
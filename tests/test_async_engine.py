@@ -0,0 +1,109 @@
+import json
+import socket
+import urllib.request
+
+import pytest
+
+from conftest import run_server
+
+
+@pytest.fixture(scope='module')
+def async_server(tmp_path_factory):
+    webroot = tmp_path_factory.mktemp('webroot')
+    for i in range(5):
+        (webroot / f'{i}.txt').write_bytes(b'file %d' % i)
+    (webroot / 'folder').mkdir()
+    with run_server(webroot, '--engine', 'asyncio', '--engine_threads', '2') as server:
+        yield server
+
+
+def connect(server):
+    sock = socket.create_connection(('127.0.0.1', int(server.url.rpartition(':')[2])), timeout=10)
+    return sock, sock.makefile('rb')
+
+
+def read_response(rfile, head=False):
+    """(status, headers, body) of the next response on a connection."""
+    status = int(rfile.readline().split()[1])
+    headers = {}
+    while True:
+        line = rfile.readline().decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.lower()] = value.strip()
+    return status, headers, b'' if head else rfile.read(int(headers.get('content-length', 0)))
+
+
+def request(path, method='GET', extra=''):
+    return f'{method} {path} HTTP/1.1\r\nHost: localhost\r\n{extra}\r\n'.encode()
+
+
+def test_pipelined_requests_are_answered_in_order(async_server):
+    sock, rfile = connect(async_server)
+    with sock, rfile:
+        sock.sendall(b''.join(request(f'/{i}.txt') for i in (3, 0, 4, 1)) + request('/2.txt', 'HEAD'))
+        for i in (3, 0, 4, 1):
+            status, headers, body = read_response(rfile)
+            assert (status, body) == (200, b'file %d' % i)
+        status, headers, _ = read_response(rfile, head=True)
+        assert status == 200 and headers['content-length'] == '6'
+        sock.sendall(request('/2.txt'))
+        assert read_response(rfile)[2] == b'file 2'
+
+
+def test_keep_alive_with_request_bodies(async_server):
+    sock, rfile = connect(async_server)
+    with sock, rfile:
+        form = b'name=0.txt'
+        sock.sendall(request('/?download=zip', 'POST', f'Content-Length: {len(form)}\r\n'
+                                                       'Content-Type: application/x-www-form-urlencoded\r\n')
+                     + form + request('/1.txt'))
+        status, headers, _ = read_response(rfile)
+        assert status == 200 and headers['transfer-encoding'] == 'chunked'
+        # skip the chunked ZIP to the next response
+        while True:
+            size = int(rfile.readline(), 16)
+            rfile.read(size + 2)
+            if not size:
+                break
+        assert read_response(rfile)[2] == b'file 1'
+
+
+def test_chunked_request_body_closes_the_connection(async_server):
+    sock, rfile = connect(async_server)
+    with sock, rfile:
+        sock.sendall(request('/0.txt', 'GET', 'Transfer-Encoding: chunked\r\n') + b'0\r\n\r\n' + request('/1.txt'))
+        assert read_response(rfile)[2] == b'file 0'
+        assert rfile.read() == b''
+
+
+def test_http10_closes_the_connection(async_server):
+    sock, rfile = connect(async_server)
+    with sock, rfile:
+        sock.sendall(b'GET /0.txt HTTP/1.0\r\n\r\n')
+        assert read_response(rfile)[2] == b'file 0'
+        assert rfile.read() == b''
+
+
+def test_idle_connections_hold_no_thread(async_server):
+    # far more open connections than the two request threads
+    idle = [connect(async_server) for _ in range(20)]
+    try:
+        sock, rfile = idle[-1]
+        sock.sendall(request('/4.txt'))
+        assert read_response(rfile)[2] == b'file 4'
+
+        with urllib.request.urlopen(async_server.url + '/__stats') as response:
+            stats = json.load(response)['async_server']
+        assert stats['connections'] >= 21
+        assert stats['threads'] == 2
+
+        with urllib.request.urlopen(async_server.url + '/__metrics') as response:
+            metrics = response.read().decode()
+        connections, = [line for line in metrics.splitlines() if line.startswith('mediabro_active_connections{')]
+        assert int(connections.rpartition(' ')[2]) >= 21
+    finally:
+        for sock, rfile in idle:
+            rfile.close()
+            sock.close()
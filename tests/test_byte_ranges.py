@@ -0,0 +1,139 @@
+import http.client
+import urllib.parse
+
+import pytest
+
+from mediabrowser import MAX_BYTE_RANGES, MyRequestHandler
+
+DATA = bytes(range(256)) * 4
+
+
+def parse(byte_range):
+    return MyRequestHandler.parse_byte_range(None, byte_range)
+
+
+def resolve(ranges, file_len):
+    return MyRequestHandler.resolve_byte_ranges(None, ranges, file_len)
+
+
+@pytest.mark.parametrize('byte_range, expected', [
+    ('bytes=0-99', [(0, 99)]),
+    ('bytes=100-', [(100, None)]),
+    ('bytes=-500', [(None, 500)]),
+    ('bytes = 0-0 , 10-20', [(0, 0), (10, 20)]),
+    ('Bytes=5-5,', [(5, 5)]),
+])
+def test_parse(byte_range, expected):
+    assert parse(byte_range) == expected
+
+
+@pytest.mark.parametrize('byte_range', ['items=0-1', 'bytes=', 'bytes=-', 'bytes=5-1', 'bytes=a-b', 'bytes=1-2-3', '0-1'])
+def test_parse_invalid(byte_range):
+    with pytest.raises(ValueError):
+        parse(byte_range)
+
+
+@pytest.mark.parametrize('ranges, expected', [
+    ([(0, 99)], [(0, 99)]),
+    ([(900, None)], [(900, 999)]),
+    ([(900, 5000)], [(900, 999)]),
+    ([(None, 100)], [(900, 999)]),
+    ([(None, 5000)], [(0, 999)]),
+    ([(None, 0)], []),
+    ([(1000, None)], []),
+    ([(1000, 1100), (0, 0)], [(0, 0)]),
+    # overlapping and adjacent ranges are merged, in order
+    ([(50, 60), (0, 10), (5, 20), (21, 30)], [(0, 30), (50, 60)]),
+])
+def test_resolve(ranges, expected):
+    assert resolve(ranges, 1000) == expected
+
+
+def request(url, headers):
+    parts = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=10)
+    try:
+        connection.request('GET', parts.path, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        connection.close()
+
+
+@pytest.fixture(scope='module')
+def data_url(server):
+    url, webroot = server
+    (webroot / 'data.bin').write_bytes(DATA)
+    return url + '/data.bin'
+
+
+def test_single_range(data_url):
+    status, headers, body = request(data_url, {'Range': 'bytes=10-19'})
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 10-19/1024'
+    assert headers['Content-Length'] == '10'
+    assert body == DATA[10:20]
+
+
+def test_suffix_range(data_url):
+    status, headers, body = request(data_url, {'Range': 'bytes=-24'})
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 1000-1023/1024'
+    assert body == DATA[-24:]
+
+
+def test_open_range_past_the_end(data_url):
+    status, headers, body = request(data_url, {'Range': 'bytes=1000-5000'})
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 1000-1023/1024'
+    assert body == DATA[1000:]
+
+
+def test_multiple_ranges(data_url):
+    status, headers, body = request(data_url, {'Range': 'bytes=0-3,100-103'})
+    assert status == 206
+    content_type = headers['Content-Type']
+    assert content_type.startswith('multipart/byteranges; boundary=')
+    assert int(headers['Content-Length']) == len(body)
+    boundary = content_type.split('boundary=')[1].encode()
+    parts = body.split(b'--' + boundary)
+    assert parts[-1] == b'--\r\n'
+    assert b'Content-Range: bytes 0-3/1024\r\n\r\n' + DATA[0:4] + b'\r\n' in parts[1]
+    assert b'Content-Range: bytes 100-103/1024\r\n\r\n' + DATA[100:104] + b'\r\n' in parts[2]
+
+
+def test_unsatisfiable_range(data_url):
+    status, headers, body = request(data_url, {'Range': 'bytes=2000-3000'})
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */1024'
+    assert body == b''
+
+
+def test_unsatisfiable_suffix_range(data_url):
+    status, headers, _ = request(data_url, {'Range': 'bytes=-0'})
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */1024'
+
+
+def test_invalid_range_is_ignored(data_url):
+    status, headers, body = request(data_url, {'Range': 'bytes=5-1'})
+    assert status == 200
+    assert body == DATA
+
+
+def test_stale_if_range_sends_the_whole_file(data_url):
+    status, headers, body = request(data_url, {'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert status == 200
+    assert body == DATA
+
+    etag = request(data_url, {})[1]['ETag']
+    status, _, body = request(data_url, {'Range': 'bytes=0-9', 'If-Range': etag})
+    assert status == 206
+    assert body == DATA[:10]
+
+
+def test_too_many_ranges_send_the_whole_file(data_url):
+    byte_range = 'bytes=' + ','.join('%d-%d' % (i * 10, i * 10) for i in range(MAX_BYTE_RANGES + 1))
+    status, _, body = request(data_url, {'Range': byte_range})
+    assert status == 200
+    assert body == DATA
@@ -0,0 +1,94 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import mediabrowser
+from mediabrowser import REGEX_JS_URL_TRANSFORMATION, UrlTransformation, find_companions
+
+
+def rule(line):
+    match = REGEX_JS_URL_TRANSFORMATION.match(line)
+    return UrlTransformation(match[1], match[2], match[4])
+
+
+@pytest.mark.parametrize('line, name, expected', [
+    (r'[/clo_(\d{3}).*\.mp3/i, "../PDF/CLO_$1_Vocab.pdf"],', 'CLO_012 lesson.mp3', '../PDF/CLO_012_Vocab.pdf'),
+    (r'[/(?<stem>.*)\.mp3/, "$<stem>.pdf"]', 'a.mp3', 'a.pdf'),
+    (r'[/\.mp3/, "[$&] $$1"]', 'a.mp3', 'a[.mp3] $1'),
+    # only the first match, like String.replace() without the g flag
+    (r'[/a/, "b"]', 'aaa.mp3', 'baa.mp3'),
+    (r'[/A/i, "b"]', 'a.mp3', 'b.mp3'),
+    (r"[/x(y)?/, 'z$1\n']", 'x.mp3', 'z\n.mp3'),
+    (r'[/\.pdf/, "x"]', 'a.mp3', None),
+])
+def test_url_transformation(line, name, expected):
+    assert rule(line).apply(name) == expected
+
+
+def test_config_js_rules():
+    rules = mediabrowser.get_url_transformations()
+    assert len(rules) == 5
+    assert rules[0].apply('clo_123 chinese.mp3') == '../PDF/CLO_123_Vocab.pdf'
+
+
+@pytest.fixture
+def lesson(tmp_path, monkeypatch):
+    monkeypatch.setattr(mediabrowser, 'get_url_transformations', lambda: [rule(r'[/(\d+)\.mp3/, "../pdf/$1.pdf"]')])
+    folder = tmp_path / 'lessons'
+    folder.mkdir()
+    (tmp_path / 'pdf').mkdir()
+    (tmp_path / 'pdf' / '01.pdf').write_bytes(b'')
+    for name in ('01.mp3', '01.mp4', '01_video.txt', '01 notes.PDF', '01.en.vtt', '01.srt', '01.bin', '02.mp3',
+                 '01_review.html'):
+        (folder / name).write_bytes(b'')
+    return folder
+
+
+def test_find_companions(lesson):
+    companions = find_companions(str(lesson), '01.mp3')
+    assert companions == {
+        'media': ['01.mp4'],
+        # the rule's target first
+        'content': ['../pdf/01.pdf', '01 notes.PDF', '01_review.html', '01_video.txt'],
+        'vtt': ['01.en.vtt'],
+        'srt': ['01.srt'],
+    }
+
+
+def test_content_names_without_suffix(lesson):
+    # 01_video.mp4 goes with the documents of 01
+    assert find_companions(str(lesson), '01_video.mp4')['content'][:2] == ['01 notes.PDF', '01_review.html']
+
+
+def test_missing_rule_target(lesson):
+    (lesson.parent / 'pdf' / '01.pdf').unlink()
+    assert '../pdf/01.pdf' not in find_companions(str(lesson), '01.mp3')['content']
+
+
+def get_json(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_endpoint(server):
+    url, webroot = server
+    (webroot / 'companions').mkdir()
+    for name in ('Lesson 1.mp3', 'Lesson 1.pdf', 'lesson 1.vtt', 'Lesson 10.mp3'):
+        (webroot / 'companions' / name).write_bytes(b'')
+
+    status, body = get_json(url + '/companions/Lesson%201.mp3?mediabro-companions.json')
+    assert status == 200
+    assert body == {'name': 'Lesson 1.mp3',
+                    # names starting with the base name, which Lesson 10 does too
+                    'media': [{'name': 'Lesson 10.mp3', 'href': 'Lesson%2010.mp3'}],
+                    'content': [{'name': 'Lesson 1.pdf', 'href': 'Lesson%201.pdf'}],
+                    'vtt': [{'name': 'lesson 1.vtt', 'href': 'lesson%201.vtt'}],
+                    'srt': []}
+
+    assert get_json(url + '/companions/?mediabro-companions.json')[0] == 400
+    assert get_json(url + '/missing/a.mp3?mediabro-companions.json')[0] == 404
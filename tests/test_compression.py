@@ -0,0 +1,128 @@
+import email.message
+import gzip
+import io
+import urllib.error
+import urllib.request
+import zlib
+
+import pytest
+
+import mediabrowser
+from conftest import run_server
+from mediabrowser import CompressingWriter, MyRequestHandler
+
+
+def negotiate(accept_encoding, available=('br', 'gzip')):
+    handler = MyRequestHandler.__new__(MyRequestHandler)
+    handler.headers = email.message.Message()
+    if accept_encoding is not None:
+        handler.headers['Accept-Encoding'] = accept_encoding
+    return handler.negotiate_encoding(available)
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    (None, None),
+    ('', None),
+    ('gzip', 'gzip'),
+    ('gzip, deflate, br', 'br'),
+    ('GZIP', 'gzip'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('gzip;q=0', None),
+    ('*', 'br'),
+    ('*, br;q=0', 'gzip'),
+    ('identity;q=1, gzip;q=0.5', None),
+    ('identity;q=0.5, gzip;q=0.5', 'gzip'),
+    ('deflate', None),
+])
+def test_negotiate_encoding(accept_encoding, expected):
+    assert negotiate(accept_encoding) == expected
+
+
+def test_negotiate_without_brotli():
+    assert negotiate('br, gzip', ('gzip',)) == 'gzip'
+    assert negotiate('br', ('gzip',)) is None
+
+
+class Collect(io.BytesIO):
+    def close(self):
+        pass
+
+
+def test_gzip_writer_flushes_whole_blocks():
+    out = Collect()
+    writer = CompressingWriter(out, 'gzip', 6)
+    writer.write(b'first part ' * 100)
+    writer.flush()
+    # whatever was flushed decompresses without the rest of the stream
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(out.getvalue()) == b'first part ' * 100
+    writer.write(b'second part')
+    writer.close()
+    assert gzip.decompress(out.getvalue()) == b'first part ' * 100 + b'second part'
+
+
+def get(url, headers=None, method='GET'):
+    request = urllib.request.Request(url, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+@pytest.fixture(scope='module')
+def folder(server):
+    url, webroot = server
+    (webroot / 'many').mkdir()
+    for i in range(200):
+        (webroot / 'many' / f'song {i:03d}.mp3').write_bytes(b'')
+    (webroot / 'one').mkdir()
+    (webroot / 'one' / 'song.mp3').write_bytes(b'')
+    return url
+
+
+@pytest.mark.parametrize('path', ['/many/', '/many/?mediabro-list.json', '/many/medialist.m3u8'])
+def test_compressed_responses(folder, path):
+    plain_status, plain_headers, plain = get(folder + path)
+    assert plain_headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Encoding' not in plain_headers
+
+    status, headers, body = get(folder + path, {'Accept-Encoding': 'gzip'})
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Transfer-Encoding'] == 'chunked'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert headers['ETag'] == plain_headers['ETag'][:-1] + '-gzip"'
+    assert gzip.decompress(body) == plain
+    assert len(body) < len(plain)
+
+    # HEAD gets the headers of the GET
+    status, head_headers, body = get(folder + path, {'Accept-Encoding': 'gzip'}, method='HEAD')
+    assert body == b''
+    assert head_headers['Content-Encoding'] == 'gzip'
+    assert head_headers['ETag'] == headers['ETag']
+
+
+def test_small_responses_are_not_compressed(folder):
+    status, headers, body = get(folder + '/one/medialist.m3u8', {'Accept-Encoding': 'gzip'})
+    assert status == 200
+    assert 'Content-Encoding' not in headers
+    assert int(headers['Content-Length']) == len(body)
+    assert b'song.mp3' in body
+
+
+@pytest.mark.skipif(not mediabrowser.brotli, reason='brotli is not installed')
+def test_brotli(folder):
+    status, headers, body = get(folder + '/many/', {'Accept-Encoding': 'gzip, br'})
+    assert headers['Content-Encoding'] == 'br'
+    assert mediabrowser.brotli.decompress(body) == get(folder + '/many/')[2]
+
+
+def test_compression_disabled(tmp_path):
+    for i in range(200):
+        (tmp_path / f'song {i:03d}.mp3').write_bytes(b'')
+    with run_server(tmp_path, '--compress_level', '0') as server:
+        status, headers, body = get(server.url + '/?mediabro-list.json', {'Accept-Encoding': 'gzip'})
+        assert status == 200
+        assert 'Content-Encoding' not in headers and 'Vary' not in headers
+        assert b'song 199.mp3' in body
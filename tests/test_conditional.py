@@ -0,0 +1,127 @@
+import email.message
+import email.utils
+import os
+import urllib.error
+import urllib.request
+
+import pytest
+
+from mediabrowser import MyRequestHandler
+
+ETAG = '"abc"'
+MTIME = 1700000000
+
+
+def http_date(timestamp):
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+def evaluate(headers, command='GET'):
+    handler = MyRequestHandler.__new__(MyRequestHandler)
+    handler.command = command
+    handler.headers = email.message.Message()
+    for name, value in headers.items():
+        handler.headers[name] = value
+    return handler.evaluate_preconditions([ETAG, '"abc-gzip"'], MTIME)
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({}, None),
+    ({'If-None-Match': ETAG}, 304),
+    ({'If-None-Match': '"abc-gzip"'}, 304),
+    ({'If-None-Match': '"old", W/"abc"'}, 304),
+    ({'If-None-Match': '*'}, 304),
+    ({'If-None-Match': '"old"'}, None),
+    ({'If-Modified-Since': http_date(MTIME)}, 304),
+    ({'If-Modified-Since': http_date(MTIME - 1)}, None),
+    ({'If-Modified-Since': 'yesterday'}, None),
+    # If-None-Match wins over If-Modified-Since
+    ({'If-None-Match': '"old"', 'If-Modified-Since': http_date(MTIME)}, None),
+    ({'If-Match': ETAG}, None),
+    ({'If-Match': '"old"'}, 412),
+    # If-Match compares strongly
+    ({'If-Match': 'W/"abc"'}, 412),
+    ({'If-Match': '*'}, None),
+    ({'If-Unmodified-Since': http_date(MTIME - 1)}, 412),
+    ({'If-Unmodified-Since': http_date(MTIME)}, None),
+    ({'If-Match': ETAG, 'If-Unmodified-Since': http_date(MTIME - 1)}, None),
+    # preconditions that fail come before the ones that save a transfer
+    ({'If-Match': '"old"', 'If-None-Match': ETAG}, 412),
+])
+def test_preconditions(headers, expected):
+    assert evaluate(headers) == expected
+
+
+def test_unsafe_methods():
+    assert evaluate({'If-None-Match': ETAG}, 'POST') == 412
+    assert evaluate({'If-Modified-Since': http_date(MTIME)}, 'POST') is None
+
+
+def get(url, headers=None, method='GET'):
+    request = urllib.request.Request(url, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+@pytest.fixture(scope='module')
+def files(server):
+    url, webroot = server
+    (webroot / 'cond').mkdir()
+    (webroot / 'cond' / 'song.mp3').write_bytes(bytes(range(256)) * 4)
+    os.utime(webroot / 'cond' / 'song.mp3', (MTIME, MTIME))
+    return url + '/cond/', webroot / 'cond'
+
+
+def test_file_validators(files):
+    url, folder = files
+    status, headers, body = get(url + 'song.mp3')
+    st = (folder / 'song.mp3').stat()
+    assert headers['ETag'] == f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+    assert headers['Last-Modified'] == http_date(MTIME)
+    assert headers['Cache-Control'] == 'no-cache'
+
+    assert get(url + 'song.mp3', {'If-None-Match': headers['ETag']})[0] == 304
+    assert get(url + 'song.mp3', {'If-Modified-Since': headers['Last-Modified']})[0] == 304
+    assert get(url + 'song.mp3', {'If-Match': '"other"'})[0] == 412
+    assert get(url + 'song.mp3', {'If-Unmodified-Since': http_date(MTIME - 60)})[0] == 412
+    status, headers304, body = get(url + 'song.mp3', {'If-None-Match': headers['ETag']}, method='HEAD')
+    assert status == 304 and headers304['ETag'] == headers['ETag']
+
+
+def test_if_range(files):
+    url, _ = files
+    etag = get(url + 'song.mp3')[1]['ETag']
+    status, headers, body = get(url + 'song.mp3', {'Range': 'bytes=0-9', 'If-Range': etag})
+    assert (status, len(body)) == (206, 10)
+    # another version: the whole file instead of a range of the wrong one
+    status, headers, body = get(url + 'song.mp3', {'Range': 'bytes=0-9', 'If-Range': '"old"'})
+    assert (status, len(body)) == (200, 1024)
+    assert get(url + 'song.mp3', {'Range': 'bytes=0-9', 'If-Range': 'W/' + etag})[0] == 200
+    assert get(url + 'song.mp3', {'Range': 'bytes=0-9', 'If-Range': http_date(MTIME)})[0] == 206
+    assert get(url + 'song.mp3', {'Range': 'bytes=0-9', 'If-Range': http_date(MTIME + 1)})[0] == 200
+
+
+@pytest.mark.parametrize('path', ['', '?mediabro-list.json', 'medialist.m3u8'])
+def test_generated_responses(files, path):
+    url, folder = files
+    status, headers, _ = get(url + path)
+    etag = headers['ETag']
+    assert status == 200 and etag
+    assert get(url + path, {'If-None-Match': etag})[0] == 304
+
+    # a new file changes the folder and with it the tag
+    (folder / 'new.mp3').write_bytes(b'')
+    try:
+        status, headers, _ = get(url + path, {'If-None-Match': etag})
+        assert status == 200 and headers['ETag'] != etag
+    finally:
+        (folder / 'new.mp3').unlink()
+
+
+def test_listing_tag_depends_on_options(files):
+    url, _ = files
+    assert get(url)[1]['ETag'] != get(url + '?show=all')[1]['ETag']
+    assert get(url + '?mediabro-list.json&sort=size')[1]['ETag'] != get(url + '?mediabro-list.json')[1]['ETag']
@@ -0,0 +1,121 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
+import pytest
+
+from mediabrowser import LIST_JSON_DEFAULT_LIMIT
+
+FILES = 1200
+
+
+@pytest.fixture(scope='module')
+def big_folder(server):
+    url, webroot = server
+    folder = webroot / 'big'
+    folder.mkdir()
+    for i in range(FILES):
+        path = folder / f'track {i:04d}.{"jpg" if i % 10 == 0 else "mp3"}'
+        path.write_bytes(bytes(i % 7))
+        os.utime(path, (1700000000 + i, 1700000000 + (i * 7919) % FILES))
+    (folder / 'sub').mkdir()
+    (folder / '.hidden').write_bytes(b'')
+    return url + '/big/?mediabro-list.json'
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, response.headers, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, json.load(e)
+
+
+def walk(url):
+    """All entries of a listing, page by page, and the number of pages."""
+    names, pages, cursor = [], 0, None
+    while True:
+        status, headers, body = get(url + (f'&cursor={cursor}' if cursor else ''))
+        assert status == 200
+        names += [entry['name'] for entry in body['entries']]
+        pages += 1
+        cursor = body['next_cursor']
+        if not cursor:
+            return names, pages
+
+
+def test_first_page(big_folder):
+    status, headers, body = get(big_folder)
+    assert headers['Content-Type'] == 'application/json'
+    assert headers['Transfer-Encoding'] == 'chunked'
+    assert body['path'] == '/big/'
+    assert body['total'] == FILES + 1
+    assert len(body['entries']) == LIST_JSON_DEFAULT_LIMIT
+    assert body['entries'][0] == {'name': 'sub', 'type': 'dir', 'size': 0, 'mtime': body['entries'][0]['mtime']}
+    image = body['entries'][1]
+    assert image['name'] == 'track 0000.jpg' and image['image']
+    assert image['thumb'].startswith('mediabro-thumb.jpg&v=')
+
+
+def test_all_at_once(big_folder):
+    body = get(big_folder + '&limit=0')[2]
+    assert len(body['entries']) == FILES + 1
+    assert body['next_cursor'] is None
+    assert '.hidden' in [entry['name'] for entry in get(big_folder + '&limit=0&show=all')[2]['entries']]
+
+
+@pytest.mark.parametrize('sort', ['name', 'size', 'mtime', 'type'])
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_pages_add_up(big_folder, sort, order):
+    everything = [entry['name'] for entry in get(big_folder + f'&limit=0&sort={sort}&order={order}')[2]['entries']]
+    names, pages = walk(big_folder + f'&limit=100&sort={sort}&order={order}')
+    assert names == everything
+    assert pages == 13
+    # folders first in either order
+    assert everything[0 if order == 'asc' else -1] == 'sub'
+
+
+def test_sort_orders(big_folder):
+    entries = get(big_folder + '&limit=0&sort=mtime')[2]['entries'][1:]
+    assert [entry['mtime'] for entry in entries] == sorted(entry['mtime'] for entry in entries)
+    entries = get(big_folder + '&limit=0&sort=size&order=desc')[2]['entries'][:-1]
+    assert [entry['size'] for entry in entries] == sorted((entry['size'] for entry in entries), reverse=True)
+
+
+def test_filters(big_folder):
+    body = get(big_folder + '&limit=0&type=image')[2]
+    assert body['total'] == FILES // 10
+    assert all(entry['name'].endswith('.jpg') for entry in body['entries'])
+    body = get(big_folder + '&limit=0&filter=TRACK%20011')[2]
+    assert [entry['name'] for entry in body['entries']] == ['track 0110.jpg'] + [f'track 011{i}.mp3' for i in range(1, 10)]
+    assert get(big_folder + '&type=dir')[2]['total'] == 1
+
+
+def test_cursor_survives_changes(server, big_folder):
+    _, webroot = server
+    first = get(big_folder + '&limit=10')[2]
+    (webroot / 'big' / 'track 0005a.mp3').write_bytes(b'')
+    (webroot / 'big' / 'track 0011.mp3').unlink()
+    try:
+        second = get(big_folder + f'&limit=10&cursor={first["next_cursor"]}')[2]
+        # continues after the last entry sent (sub and tracks 0 to 8), whatever changed before it
+        assert [entry['name'] for entry in second['entries']][:3] == ['track 0009.mp3', 'track 0010.jpg',
+                                                                      'track 0012.mp3']
+    finally:
+        (webroot / 'big' / 'track 0005a.mp3').unlink()
+        (webroot / 'big' / 'track 0011.mp3').write_bytes(bytes(11 % 7))
+
+
+@pytest.mark.parametrize('query', ['&limit=x', '&cursor=%%%', '&sort=color', '&order=up', '&type=song',
+                                   # a cursor of another sort order
+                                   '&sort=size&cursor=WyJzdWIiXQ'])
+def test_invalid_parameters(big_folder, query):
+    status, headers, body = get(big_folder + query)
+    assert status == 400
+    assert body['error']
+
+
+def test_limit_is_capped(big_folder):
+    assert len(get(big_folder + '&limit=100000')[2]['entries']) == FILES + 1
+    assert len(get(big_folder + '&limit=-5')[2]['entries']) == FILES + 1
@@ -0,0 +1,120 @@
+import json
+import os
+import urllib.request
+
+import pytest
+
+import mediabrowser
+from conftest import run_server
+from mediabrowser import DirectoryListing, DirectoryListingCache, ListingEntry, list_directory, scan_directory
+
+
+def entry(name, is_dir=False):
+    return ListingEntry(name, is_dir, False, 0, 0)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = DirectoryListingCache(1 << 20)
+    monkeypatch.setattr(mediabrowser, 'directory_listing_cache', cache)
+    return cache
+
+
+def test_scan_directory(tmp_path):
+    (tmp_path / 'b.txt').write_bytes(b'12345')
+    (tmp_path / 'A.mp3').write_bytes(b'')
+    (tmp_path / 'zfolder').mkdir()
+    (tmp_path / '.hidden').write_bytes(b'')
+    os.symlink(tmp_path / 'missing', tmp_path / 'dangling')
+
+    entries = scan_directory(str(tmp_path))
+    # folders first, then case-insensitive name order
+    assert [e.name for e in entries] == ['zfolder', 'A.mp3', 'b.txt', 'dangling']
+    assert entries[0].is_dir and entries[0].size == 0
+    assert entries[2].size == 5
+    assert entries[3].is_symlink and not entries[3].is_dir
+    assert '.hidden' in [e.name for e in scan_directory(str(tmp_path), show_hidden=True)]
+
+
+def test_cache_validates_signature():
+    cache = DirectoryListingCache(1 << 20)
+    listing = DirectoryListing('/music', (1, 2, 3), [entry('a.mp3')])
+    cache.put(listing, False)
+    assert cache.get('/music', (1, 2, 3), False) is listing
+    assert cache.get('/music', (1, 2, 3), True) is None
+    assert cache.get('/music', (9, 2, 3), False) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_cache_budget():
+    size = DirectoryListing('/a', None, [entry('a.mp3')]).nbytes
+    cache = DirectoryListingCache(2 * size)
+    for path in ('/a', '/b', '/c'):
+        cache.put(DirectoryListing(path, None, [entry('a.mp3')]), False)
+    assert [path for path, _ in cache.listings] == ['/b', '/c']
+    assert cache.total_bytes == 2 * size
+
+    # updating a listing, e.g. with its rendered HTML, is accounted once; the LRU one makes room
+    listing = cache.listings[('/c', False)]
+    listing.html = 'x' * 10
+    cache.put(listing, False)
+    assert [path for path, _ in cache.listings] == ['/c']
+    assert cache.total_bytes == size + 10
+
+    # a single listing over budget is still kept
+    cache.put(DirectoryListing('/big', None, [entry('a.mp3')] * 100), False)
+    assert [path for path, _ in cache.listings] == ['/big']
+
+
+def test_sorted_views_and_prefixes():
+    listing = DirectoryListing('/a', None, [entry('sub', True), entry('b.mp3'), entry('A.mp3'), entry('a.srt')])
+    keys, entries = listing.sorted_view('name')
+    assert [e.name for e in entries] == ['sub', 'A.mp3', 'a.srt', 'b.mp3']
+    assert keys == sorted(keys)
+    assert listing.names_starting_with('a') == ['A.mp3', 'a.srt']
+    assert listing.names_starting_with('sub') == []
+
+
+def test_list_directory_invalidation(tmp_path, cache):
+    (tmp_path / 'one.mp3').write_bytes(b'')
+    listing = list_directory(str(tmp_path))
+    assert list_directory(str(tmp_path)) is listing
+    assert cache.hits == 1
+
+    # a new entry changes the folder's mtime
+    (tmp_path / 'two.mp3').write_bytes(b'')
+    os.utime(tmp_path, ns=(0, listing.signature[0] + 1))
+    changed = list_directory(str(tmp_path))
+    assert changed is not listing
+    assert [e.name for e in changed.entries] == ['one.mp3', 'two.mp3']
+
+    # hidden entries are listed separately
+    (tmp_path / '.hidden').write_bytes(b'')
+    assert '.hidden' in [e.name for e in list_directory(str(tmp_path), show_hidden=True).entries]
+
+
+def test_listing_page_follows_changes(tmp_path):
+    (tmp_path / 'one.mp3').write_bytes(b'')
+    with run_server(tmp_path) as server:
+        for _ in range(2):
+            with urllib.request.urlopen(server.url + '/') as response:
+                page = response.read().decode()
+        assert 'one.mp3' in page and 'two.mp3' not in page
+
+        (tmp_path / 'two.mp3').write_bytes(b'')
+        with urllib.request.urlopen(server.url + '/') as response:
+            assert 'two.mp3' in response.read().decode()
+
+        with urllib.request.urlopen(server.url + '/__stats') as response:
+            stats = json.load(response)['directory_listing_cache']
+        assert stats['hits'] >= 1
+        assert stats['listings'] == 1
+
+
+def test_listing_cache_disabled(tmp_path):
+    (tmp_path / 'one.mp3').write_bytes(b'')
+    with run_server(tmp_path, '--listing_cache_size', '0') as server:
+        with urllib.request.urlopen(server.url + '/') as response:
+            assert 'one.mp3' in response.read().decode()
+        with urllib.request.urlopen(server.url + '/__stats') as response:
+            assert 'directory_listing_cache' not in json.load(response)
@@ -0,0 +1,154 @@
+import gzip
+import json
+import os
+import time
+import urllib.request
+
+import pytest
+
+from conftest import run_server
+from mediabrowser import MediaIndex
+
+
+class Listener:
+    def __init__(self):
+        self.events = []
+
+    def dir_changed(self, rel_dir):
+        self.events.append(('changed', rel_dir))
+
+    def tree_removed(self, rel_dir):
+        self.events.append(('removed', rel_dir))
+
+
+def make_tree(root):
+    (root / 'music' / 'live').mkdir(parents=True)
+    (root / 'music' / 'a.mp3').write_bytes(b'x' * 10)
+    (root / 'music' / 'live' / 'b.mp3').write_bytes(b'')
+    (root / 'music' / 'cover.jpg').write_bytes(b'')
+    (root / 'notes.txt').write_bytes(b'')
+    (root / '.hidden').mkdir()
+    (root / '.hidden' / 'secret.mp3').write_bytes(b'')
+
+
+@pytest.fixture
+def index(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    make_tree(root)
+    return MediaIndex(str(root), str(tmp_path / 'index.db'), 600)
+
+
+def files(index):
+    return {path: file_type for path, file_type, _, _ in index.iter_files()}
+
+
+def touch_dir(path):
+    # mtimes of folders changed within one timer tick may look the same
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+
+
+def test_crawl(index):
+    index.crawl()
+    assert files(index) == {'music': 'dir', 'notes.txt': 'file', 'music/a.mp3': 'media', 'music/cover.jpg': 'image',
+                            'music/live': 'dir', 'music/live/b.mp3': 'media'}
+    assert index.file_info('music/a.mp3')[0] == 10
+    assert index.file_info('music/missing.mp3') is None
+    assert index.dir_entries('music') == [('a.mp3', 'media'), ('cover.jpg', 'image'), ('live', 'dir')]
+    assert index.stats()['files'] == 6
+    assert index.stats()['dirs'] == 3
+
+
+def test_rescans_are_incremental(index):
+    listener = Listener()
+    index.listeners.append(listener)
+    index.crawl()
+    assert sorted(listener.events) == [('changed', ''), ('changed', 'music'), ('changed', 'music/live')]
+    version = index.version
+
+    listener.events.clear()
+    index.crawl()
+    assert (index.last_crawl_scanned, index.last_crawl_skipped) == (0, 3)
+    assert listener.events == []
+    assert index.version == version
+
+    open(os.path.join(index.root, 'music', 'live', 'c.mp3'), 'wb').close()
+    touch_dir(os.path.join(index.root, 'music', 'live'))
+    index.crawl()
+    assert (index.last_crawl_scanned, index.last_crawl_skipped) == (1, 2)
+    assert listener.events == [('changed', 'music/live')]
+    assert 'music/live/c.mp3' in files(index)
+    assert index.version > version
+
+
+def test_removed_folders(index):
+    listener = Listener()
+    index.crawl()
+    index.listeners.append(listener)
+
+    live = os.path.join(index.root, 'music', 'live')
+    os.unlink(os.path.join(live, 'b.mp3'))
+    os.rmdir(live)
+    touch_dir(os.path.join(index.root, 'music'))
+    index.crawl()
+    assert ('removed', 'music/live') in listener.events
+    assert not [path for path in files(index) if path.startswith('music/live')]
+    assert index.stats()['dirs'] == 2
+
+
+def test_wildcards_in_removed_names(tmp_path):
+    root = tmp_path / 'root'
+    for name in ('a_b', 'axb', '50%', '500'):
+        (root / name).mkdir(parents=True)
+        (root / name / 'x.mp3').write_bytes(b'')
+    index = MediaIndex(str(root), str(tmp_path / 'index.db'), 600)
+    index.crawl()
+
+    for name in ('a_b', '50%'):
+        os.unlink(root / name / 'x.mp3')
+        os.rmdir(root / name)
+    touch_dir(root)
+    index.crawl()
+    # LIKE patterns don't take the other folders along
+    assert sorted(files(index)) == ['500', '500/x.mp3', 'axb', 'axb/x.mp3']
+
+
+def test_symlinked_folders_are_not_followed(index):
+    os.symlink(index.root, os.path.join(index.root, 'loop'))
+    index.crawl()
+    assert files(index)['loop'] == 'link'
+    assert not [path for path in files(index) if path.startswith('loop/')]
+
+
+def test_persistent(index):
+    index.crawl()
+    reopened = MediaIndex(index.root, index.db_path, 600)
+    assert files(reopened) == files(index)
+    reopened.crawl()
+    # nothing changed since the last run
+    assert reopened.last_crawl_scanned == 0
+
+
+def test_index_json(tmp_path):
+    make_tree(tmp_path)
+    db_path = tmp_path / '.index.db'
+    with run_server(tmp_path, '--index', '--index_db', str(db_path), '--compress_min_size', '0') as server:
+        deadline = time.monotonic() + 15
+        while True:
+            request = urllib.request.Request(server.url + '/index.json', headers={'Accept-Encoding': 'gzip'})
+            with urllib.request.urlopen(request) as response:
+                assert response.headers['Content-Type'] == 'application/json'
+                assert response.headers['Content-Encoding'] == 'gzip'
+                body = json.loads(gzip.decompress(response.read()))
+            if len(body['files']) == 6 or time.monotonic() > deadline:
+                break
+            time.sleep(0.1)
+
+        assert body['root'] == str(tmp_path)
+        assert body['fields'] == ['path', 'type', 'size', 'mtime']
+        assert ['music/a.mp3', 'media', 10] in [item[:3] for item in body['files']]
+        assert db_path.exists()
+
+        with urllib.request.urlopen(server.url + '/__stats') as response:
+            assert json.load(response)['media_index']['crawls'] >= 1
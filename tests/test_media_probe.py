@@ -0,0 +1,161 @@
+import io
+import random
+import struct
+import wave
+
+import pytest
+
+from mediabrowser import probe_media
+
+
+def mp4_box(kind, *payload):
+    data = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(data), kind) + data
+
+
+def make_mp4():
+    mvhd = mp4_box(b'mvhd', bytes(12), struct.pack('>II', 1000, 5000), bytes(80))
+    # sample description: size, type, 6 reserved bytes, data reference index, then the visual sample entry
+    avc1 = struct.pack('>I4s6xH16xHH', 86, b'avc1', 1, 640, 480) + bytes(50)
+    stsd = mp4_box(b'stsd', struct.pack('>II', 0, 1), avc1)
+    hdlr = mp4_box(b'hdlr', bytes(8), b'vide', bytes(12))
+    trak = mp4_box(b'trak', mp4_box(b'mdia', hdlr, mp4_box(b'minf', mp4_box(b'stbl', stsd))))
+    return mp4_box(b'ftyp', b'isom', bytes(4)) + mp4_box(b'moov', mvhd, trak) + mp4_box(b'mdat', bytes(1000))
+
+
+# MPEG-1 layer III, 128 kbps, 44100 Hz, stereo: 417 byte frames of 1152 samples
+MP3_FRAME_HEADER = b'\xff\xfb\x90\x00'
+
+
+def make_mp3(frames=10, xing_frames=None):
+    frame = MP3_FRAME_HEADER + bytes(413)
+    first = frame
+    if xing_frames:
+        # after the 32 bytes of side information
+        first = MP3_FRAME_HEADER + bytes(32) + b'Xing' + struct.pack('>II', 1, xing_frames) + bytes(369)
+    return b'ID3\x03\x00\x00\x00\x00\x00\x0a' + bytes(10) + first + frame * (frames - 1)
+
+
+def make_flac():
+    # 44100 Hz, 2 channels, 16 bits, 3 seconds
+    packed = 44100 << 44 | 1 << 41 | 15 << 36 | 3 * 44100
+    streaminfo = bytes(10) + packed.to_bytes(8, 'big') + bytes(16)
+    return b'fLaC' + b'\x80\x00\x00\x22' + streaminfo + bytes(100)
+
+
+def make_wav():
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(8000)
+        w.writeframes(bytes(2 * 2000))
+    return out.getvalue()
+
+
+def make_aiff():
+    # 22050 Hz as an 80 bit float: exponent 16383 + 14, mantissa 22050 << 49
+    comm = struct.pack('>hIh', 2, 22050, 16) + struct.pack('>HQ', 16383 + 14, 22050 << 49)
+    # the duration comes from the frame count, the samples themselves are left out
+    ssnd = bytes(8)
+    chunks = b'COMM' + struct.pack('>I', len(comm)) + comm + b'SSND' + struct.pack('>I', len(ssnd)) + ssnd
+    return b'FORM' + struct.pack('>I', 4 + len(chunks)) + b'AIFF' + chunks
+
+
+def ogg_page(header_type, granule, serial, packet):
+    return (struct.pack('<4sBBqIII', b'OggS', 0, header_type, granule, serial, 0, 0)
+            + bytes([1, len(packet)]) + packet)
+
+
+def make_ogg_opus():
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 2, 312, 48000, 0, 0)
+    return ogg_page(2, 0, 7, head) + ogg_page(0, 0, 7, b'OpusTags' + bytes(8)) + ogg_page(4, 3 * 48000 + 312, 7, b'x')
+
+
+def ebml(element_id, *payload):
+    data = b''.join(payload)
+    return element_id + b'\x01' + len(data).to_bytes(7, 'big') + data
+
+
+def make_matroska():
+    header = ebml(b'\x1a\x45\xdf\xa3', ebml(b'\x42\x82', b'webm'))
+    info = ebml(b'\x15\x49\xa9\x66', ebml(b'\x2a\xd7\xb1', (1000000).to_bytes(3, 'big')),
+                ebml(b'\x44\x89', struct.pack('>d', 2500.0)))
+    video = ebml(b'\xe0', ebml(b'\xb0', (320).to_bytes(2, 'big')), ebml(b'\xba', (240).to_bytes(2, 'big')))
+    tracks = ebml(b'\x16\x54\xae\x6b', ebml(b'\xae', ebml(b'\x83', b'\x01'), ebml(b'\x86', b'V_VP9'), video))
+    cluster = ebml(b'\x1f\x43\xb6\x75', bytes(100))
+    return header + ebml(b'\x18\x53\x80\x67', info, tracks, cluster)
+
+
+SAMPLES = {
+    'video.mp4': (make_mp4, {'duration': 5.0, 'video': 'h264', 'width': 640, 'height': 480}),
+    'cbr.mp3': (make_mp3, {'duration': 0.261, 'audio': 'mp3', 'sample_rate': 44100, 'channels': 2}),
+    'vbr.mp3': (lambda: make_mp3(xing_frames=100), {'duration': 2.612, 'audio': 'mp3'}),
+    'audio.flac': (make_flac, {'duration': 3.0, 'audio': 'flac', 'sample_rate': 44100, 'channels': 2}),
+    'audio.wav': (make_wav, {'duration': 0.25, 'audio': 'pcm', 'sample_rate': 8000, 'channels': 1}),
+    'audio.aiff': (make_aiff, {'duration': 1.0, 'audio': 'pcm', 'sample_rate': 22050, 'channels': 2}),
+    'audio.opus': (make_ogg_opus, {'duration': 3.0, 'audio': 'opus', 'sample_rate': 48000, 'channels': 2}),
+    'video.webm': (make_matroska, {'duration': 2.5, 'video': 'vp9', 'width': 320, 'height': 240}),
+}
+
+
+@pytest.fixture(params=list(SAMPLES))
+def sample(request, tmp_path):
+    make, expected = SAMPLES[request.param]
+    return tmp_path / request.param, make(), expected
+
+
+def test_probe(sample):
+    path, data, expected = sample
+    path.write_bytes(data)
+    info = probe_media(path)
+    assert info == {**info, **expected}
+    assert info['bitrate'] == pytest.approx(len(data) * 8 / info['duration'], rel=1e-2)
+
+
+def assert_valid(info):
+    assert isinstance(info, dict)
+    if 'duration' in info:
+        assert 0 < info['duration'] < float('inf')
+        assert info['bitrate'] >= 0
+
+
+def test_probe_truncated(sample):
+    path, data, _ = sample
+    for length in range(len(data)):
+        path.write_bytes(data[:length])
+        assert_valid(probe_media(path))
+
+
+def test_probe_corrupt(sample):
+    path, data, _ = sample
+    rng = random.Random(path.name)
+    for _ in range(300):
+        corrupt = bytearray(data)
+        # keep the signature, so that the parser of the format sees the damage
+        for position in rng.sample(range(8, len(data)), 4):
+            corrupt[position] = rng.randrange(256)
+        path.write_bytes(corrupt)
+        assert_valid(probe_media(path))
+
+
+@pytest.mark.parametrize('duration', [float('nan'), float('inf'), -1.0, 1e-300])
+def test_probe_invalid_duration(tmp_path, duration):
+    path = tmp_path / 'video.webm'
+    path.write_bytes(make_matroska().replace(struct.pack('>d', 2500.0), struct.pack('>d', duration)))
+    info = probe_media(path)
+    assert 'duration' not in info and 'bitrate' not in info
+    assert info['video'] == 'vp9'
+
+
+@pytest.mark.parametrize('data', [b'', b'not media at all', b'\xff' * 1000, b'OggS' + bytes(100),
+                                  b'RIFF\xff\xff\xff\xffWAVEfmt ', b'\x1a\x45\xdf\xa3\xff', b'\x1a\x45\xdf\xa3\x01' + b'\xff' * 7,
+                                  b'\x00\x00\x00\x01ftyp' + bytes(8)])
+def test_probe_garbage(tmp_path, data):
+    path = tmp_path / 'garbage'
+    path.write_bytes(data)
+    assert isinstance(probe_media(path), dict)
+
+
+def test_probe_missing_file(tmp_path):
+    assert probe_media(tmp_path / 'missing.mp4') == {}
@@ -0,0 +1,113 @@
+import json
+import re
+import time
+import urllib.request
+
+import pytest
+
+from mediabrowser import get_request_route
+
+# name{labels} value
+REGEX_SAMPLE = re.compile(r'^([a-z_]+)(?:\{((?:[a-z_]+="[^"]*",?)*)\})? (-?[0-9.e+]+|\+Inf|NaN)$')
+
+
+def get(url):
+    with urllib.request.urlopen(url) as response:
+        return response.status, response.headers, response.read()
+
+
+def parse_metrics(text):
+    """{(name, labels): value} of the Prometheus text format; checks that each metric is declared first."""
+    declared, samples = {}, {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            declared[name] = kind
+        elif line and not line.startswith('#'):
+            match = REGEX_SAMPLE.match(line)
+            assert match, line
+            name, labels, value = match.groups()
+            base = re.sub(r'_(bucket|sum|count|total)$', '', name)
+            assert name in declared or base in declared or base + '_total' in declared, line
+            samples[name, labels or ''] = float(value)
+    return samples
+
+
+def get_metrics(url, *routes):
+    """Status, headers and parsed samples of url once the routes have a response counted.
+
+    A request is counted after its last byte is sent, when the client may have read it already.
+    """
+    deadline = time.monotonic() + 5
+    while True:
+        status, headers, body = get(url)
+        samples = parse_metrics(body.decode())
+        if time.monotonic() > deadline or all(
+                any(name == 'mediabro_responses_total' and f'route="{route}"' in labels for name, labels in samples)
+                for route in routes):
+            return status, headers, samples
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize('path, route', [
+    ('/__metrics', 'metrics'),
+    ('/__metrics?format=text', 'metrics'),
+    ('/%5F%5Fstats', 'stats'),
+    ('/index.json?since=1', 'index'),
+    ('/search?q=abc', 'search'),
+    ('/css/main.css', 'static'),
+    ('/music/medialist.m3u8?recursive=1', 'playlist'),
+    ('/music/?mediabro-list.json&offset=0', 'listing_json'),
+    ('/music/a.jpg?mediabro-thumb.jpg&size=s', 'thumbnail'),
+    ('/movies/a.srt?mediabro-subtitles.vtt', 'subtitles'),
+    ('/music/?download=zip', 'download'),
+    ('/music/', 'listing'),
+    ('/music/a.mp3', 'file'),
+])
+def test_request_route(path, route):
+    assert get_request_route(path) == route
+
+
+def test_ranged_request_route():
+    assert get_request_route('/music/a.mp3', ranged=True) == 'range'
+
+
+@pytest.mark.parametrize('path', ['/__metrics', '/__metrics?x=1', '/%5F%5Fmetrics'])
+def test_metrics(server, path):
+    url, webroot = server
+    (webroot / 'a.txt').write_text('a')
+    get(url + '/a.txt')
+    get(url + '/')
+
+    status, headers, samples = get_metrics(url + path, 'file', 'listing')
+    assert status == 200
+    assert headers['Content-Type'].startswith('text/plain; version=0.0.4')
+
+    file_labels = next(labels for name, labels in samples
+                       if name == 'mediabro_responses_total' and 'route="file"' in labels)
+    assert 'status="200"' in file_labels
+    assert samples['mediabro_responses_total', file_labels] >= 1
+    assert any(name == 'mediabro_sent_bytes_total' and 'route="listing"' in labels for name, labels in samples)
+
+
+def test_histograms_are_cumulative(server):
+    url, _ = server
+    get(url + '/')
+    samples = get_metrics(url + '/__metrics', 'listing')[2]
+    buckets = [(labels, value) for (name, labels), value in samples.items()
+               if name == 'mediabro_request_duration_seconds_bucket' and 'route="listing"' in labels]
+    values = [value for _, value in buckets]
+    assert values == sorted(values)
+    assert buckets[-1][0].endswith('le="+Inf"')
+    count = next(value for (name, labels), value in samples.items()
+                 if name == 'mediabro_request_duration_seconds_count' and 'route="listing"' in labels)
+    assert count == values[-1]
+
+
+@pytest.mark.parametrize('path', ['/__stats', '/__stats?pretty=1'])
+def test_stats(server, path):
+    url, _ = server
+    status, headers, body = get(url + path)
+    assert status == 200
+    assert headers['Content-Type'] == 'application/json'
+    assert isinstance(json.loads(body), dict)
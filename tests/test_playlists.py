@@ -0,0 +1,109 @@
+import os
+import urllib.error
+import urllib.request
+
+import pytest
+
+from conftest import run_server
+from mediabrowser import walk_media_files
+
+
+@pytest.fixture(scope='module')
+def music(tmp_path_factory):
+    webroot = tmp_path_factory.mktemp('webroot')
+    album = webroot / 'album'
+    (album / 'disc 2').mkdir(parents=True)
+    (album / 'cd1').mkdir()
+    for i, name in enumerate(['b.mp3', 'a.flac', 'c.ogg']):
+        path = album / name
+        path.write_bytes(bytes(10 * (3 - i)))
+        os.utime(path, (1700000000, 1700000000 + i))
+    (album / 'cover.txt').write_bytes(b'')
+    (album / '.hidden.mp3').write_bytes(b'')
+    (album / 'cd1' / 'one #1.mp3').write_bytes(b'')
+    (album / 'disc 2' / 'two.mp3').write_bytes(b'')
+    # the domain goes into the playlist URLs as is; with 127.0.0.1 the LAN address would
+    with run_server(webroot, domain='localhost') as server:
+        yield server.url.replace('127.0.0.1', 'localhost'), webroot
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, response.headers, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read().decode()
+
+
+def tracks(playlist):
+    """The URLs of an extended M3U playlist, checking that each has its #EXTINF line."""
+    lines = playlist.splitlines()
+    assert lines[0] == '#EXTM3U'
+    assert all(line.startswith('#EXTINF:') for line in lines[1::2])
+    return lines[2::2]
+
+
+def test_folder_playlist(music):
+    url, _ = music
+    status, headers, playlist = get(url + '/album/medialist.m3u8')
+    assert status == 200
+    assert headers['Content-Type'] == 'audio/mpegurl; charset=utf-8'
+    assert tracks(playlist) == [url + '/album/a.flac', url + '/album/b.mp3', url + '/album/c.ogg']
+    # no duration known for these files
+    assert '#EXTINF:-1,a\n' in playlist
+
+
+def test_recursive_playlist(music):
+    url, _ = music
+    status, _, playlist = get(url + '/album/medialist.m3u8?recursive=1')
+    assert status == 200
+    # the files of a folder come before its subfolders, which are in name order
+    assert tracks(playlist) == [url + '/album/a.flac', url + '/album/b.mp3', url + '/album/c.ogg',
+                                url + '/album/cd1/one%20%231.mp3', url + '/album/disc%202/two.mp3']
+
+
+@pytest.mark.parametrize('query, names', [
+    ('sort=size', ['c.ogg', 'a.flac', 'b.mp3']),
+    ('sort=size&order=desc', ['b.mp3', 'a.flac', 'c.ogg']),
+    ('sort=mtime&order=desc', ['c.ogg', 'a.flac', 'b.mp3']),
+    ('show=all', ['.hidden.mp3', 'a.flac', 'b.mp3', 'c.ogg']),
+])
+def test_sorted_playlist(music, query, names):
+    url, _ = music
+    status, _, playlist = get(url + '/album/medialist.m3u?' + query)
+    assert status == 200
+    assert tracks(playlist) == [url + '/album/' + name for name in names]
+
+
+def test_invalid_sort(music):
+    url, _ = music
+    assert get(url + '/album/medialist.m3u8?sort=color')[0] == 400
+    assert get(url + '/album/medialist.m3u8?order=up')[0] == 400
+
+
+def test_playlist_validator(music):
+    url, webroot = music
+    status, headers, _ = get(url + '/album/medialist.m3u8')
+    etag = headers['ETag']
+    assert etag
+    request = urllib.request.Request(url + '/album/medialist.m3u8', headers={'If-None-Match': etag})
+    assert get(request)[0] == 304
+    # a recursive playlist has none
+    assert 'ETag' not in get(url + '/album/medialist.m3u8?recursive=1')[1]
+
+    (webroot / 'album' / 'd.mp3').write_bytes(b'')
+    try:
+        status, headers, playlist = get(request)
+        assert status == 200 and headers['ETag'] != etag
+        assert url + '/album/d.mp3' in tracks(playlist)
+    finally:
+        (webroot / 'album' / 'd.mp3').unlink()
+
+
+def test_walk_media_files_enters_symlinked_folders_once(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'song.mp3').write_bytes(b'')
+    (tmp_path / 'a' / 'loop').symlink_to(tmp_path)
+    (tmp_path / 'b').symlink_to(tmp_path / 'a')
+    paths = [os.path.relpath(path, tmp_path) for path, _ in walk_media_files(str(tmp_path), recursive=True)]
+    assert paths == [os.path.join('a', 'song.mp3')]
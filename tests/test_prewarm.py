@@ -0,0 +1,80 @@
+import json
+import os
+import time
+import urllib.request
+
+import pytest
+
+from conftest import run_server
+from mediabrowser import ThumbnailPrewarmer, iter_image_files
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def make_tree(root):
+    for path in ('a/one.jpg', 'a/b/two.png', 'c/three.jpg', '.hidden/four.jpg', 'a/.five.jpg'):
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        Image.new('RGB', (800, 600), 'red').save(root / path)
+    (root / 'a' / 'notes.txt').write_text('notes')
+
+
+def get_stats(url):
+    with urllib.request.urlopen(url + '/__stats') as response:
+        return json.load(response)
+
+
+def wait_for_warmed(url, count):
+    deadline = time.monotonic() + 30
+    while True:
+        stats = get_stats(url)
+        if stats['thumbnail_prewarmer']['warmed'] >= count or time.monotonic() > deadline:
+            return stats
+        time.sleep(0.1)
+
+
+def test_iter_image_files(tmp_path):
+    make_tree(tmp_path)
+    assert [os.path.relpath(path, tmp_path) for path in iter_image_files(str(tmp_path))] == [
+        'a/one.jpg', 'a/b/two.png', 'c/three.jpg']
+
+
+def test_queue(tmp_path):
+    make_tree(tmp_path)
+    prewarmer = ThumbnailPrewarmer((300, 200), num_threads=0)
+    prewarmer.warm_tree(str(tmp_path / 'c'))
+    prewarmer.warm_images(['x.jpg', 'y.jpg', 'x.jpg'])
+    assert prewarmer.stats()['queued'] == 2
+    # images of listed folders before whole trees
+    assert [prewarmer._next_image() for _ in range(3)] == ['x.jpg', 'y.jpg', str(tmp_path / 'c' / 'three.jpg')]
+    assert prewarmer.stats()['trees_pending'] == 1
+
+
+def test_prewarm_tree(tmp_path):
+    make_tree(tmp_path)
+    with run_server(tmp_path, '--prewarm', str(tmp_path), '--thumb_formats', 'jpeg') as server:
+        stats = wait_for_warmed(server.url, 3)
+        assert stats['thumbnail_prewarmer']['warmed'] == 3
+        assert stats['thumbnail_cache']['entries'] == 3
+
+        request = urllib.request.Request(server.url + '/c/three.jpg?mediabro-thumb.jpg', headers={'Accept': 'image/jpeg'})
+        with urllib.request.urlopen(request) as response:
+            assert response.status == 200
+        stats = get_stats(server.url)
+        # served from the cache, nothing rendered on request
+        assert stats['thumbnail_cache']['hits'] == 1
+        assert stats['thumbnail_renderer']['submitted'] == 3
+
+
+def test_prewarm_listings(tmp_path):
+    make_tree(tmp_path)
+    with run_server(tmp_path, '--prewarm_listings', '--thumb_formats', 'jpeg') as server:
+        assert get_stats(server.url)['thumbnail_prewarmer']['warmed'] == 0
+        urllib.request.urlopen(server.url + '/a/').close()
+        stats = wait_for_warmed(server.url, 1)
+        assert stats['thumbnail_prewarmer']['warmed'] == 1
+        assert stats['thumbnail_cache']['entries'] == 1
+        # the folder is warmed once
+        urllib.request.urlopen(server.url + '/a/').close()
+        time.sleep(0.5)
+        stats = get_stats(server.url)['thumbnail_prewarmer']
+        assert (stats['warmed'], stats['skipped']) == (1, 1)
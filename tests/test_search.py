@@ -0,0 +1,158 @@
+import json
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from conftest import run_server
+from mediabrowser import SearchData, SearchIndex
+
+NAMES = {
+    '': [('music', 'dir'), ('lectures', 'dir'), ('readme.txt', 'file')],
+    'music': [('ab.mp3', 'media'), ('abc live.mp3', 'media'), ('xy ab.mp3', 'media'), ('cover.jpg', 'image')],
+    'lectures': [('lecture 04.mp4', 'media'), ('lecture 04 notes.pdf', 'file'), ('intro lecture.mp4', 'media'),
+                 ('lecture 05.mp4', 'media')],
+}
+
+
+class FakeMediaIndex:
+    """The part of a MediaIndex a SearchIndex reads, backed by a dict of folder -> [(name, type)]."""
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.listeners = []
+
+    def iter_files(self):
+        for rel_dir, entries in sorted(self.folders.items()):
+            for name, file_type in entries:
+                yield (rel_dir + '/' + name if rel_dir else name), file_type, 0, 0.0
+
+    def dir_entries(self, rel_dir):
+        return self.folders.get(rel_dir, [])
+
+
+@pytest.fixture
+def index():
+    media_index = FakeMediaIndex({folder: list(entries) for folder, entries in NAMES.items()})
+    search_index = SearchIndex(media_index)
+    search_index.rebuild()
+    return search_index
+
+
+def search(index, query, *args):
+    total, page, data = index.search(query, *args)
+    return total, [data.path(file_id) for _, file_id in page]
+
+
+def test_ranking(index):
+    total, paths = search(index, 'lecture 04')
+    assert total == 2
+    # the shorter name is more of a match
+    assert paths == ['lectures/lecture 04.mp4', 'lectures/lecture 04 notes.pdf']
+
+    # prefix matches before matches further in
+    assert search(index, 'lecture')[1][:3] == ['lectures', 'lectures/lecture 04.mp4', 'lectures/lecture 05.mp4']
+
+
+def test_every_term_has_to_match(index):
+    assert search(index, 'LECTURE notes')[1] == ['lectures/lecture 04 notes.pdf']
+    assert search(index, 'lecture missing') == (0, [])
+    assert search(index, '   ') == (0, [])
+
+
+def test_type_filter(index):
+    assert search(index, 'lecture', 'dir')[1] == ['lectures']
+    assert search(index, 'lecture', 'file')[1] == ['lectures/lecture 04 notes.pdf']
+
+
+def test_paging(index):
+    total, everything = search(index, 'lecture', None, 0, 10)
+    assert total == 5
+    assert search(index, 'lecture', None, 1, 2) == (5, everything[1:3])
+    assert search(index, 'lecture', None, 10, 2) == (5, [])
+
+
+def test_short_terms(index):
+    assert sorted(search(index, 'ab')[1]) == ['music/ab.mp3', 'music/abc live.mp3', 'music/xy ab.mp3']
+    # several terms too short for trigrams: all of them have to match, whichever is scanned for
+    assert search(index, 'ab xy')[1] == ['music/xy ab.mp3']
+    assert search(index, 'xy ab')[1] == ['music/xy ab.mp3']
+    # short terms next to long ones are checked against the candidates of the long ones
+    assert search(index, 'ab live')[1] == ['music/abc live.mp3']
+
+
+def test_short_terms_scan_the_longest_term(index, monkeypatch):
+    scanned = []
+    scan = SearchData.scan
+
+    def record_scan(data, term):
+        scanned.append(term)
+        return scan(data, term)
+
+    monkeypatch.setattr(SearchData, 'scan', record_scan)
+    assert search(index, 'a xy b')[1] == ['music/xy ab.mp3']
+    assert scanned == ['xy']
+
+
+def test_follows_changes(index):
+    media_index = index.media_index
+    media_index.folders['music'].append(('new ab song.mp3', 'media'))
+    index.dir_changed('music')
+    assert 'music/new ab song.mp3' in search(index, 'song')[1]
+
+    # as the crawler reports a removed folder: the tree, then its parent
+    del media_index.folders['lectures']
+    media_index.folders[''].remove(('lectures', 'dir'))
+    index.tree_removed('lectures')
+    index.dir_changed('')
+    assert search(index, 'lecture') == (0, [])
+    assert len(index.data) == 7
+
+
+def test_rebuild_replays_changes(index):
+    media_index = index.media_index
+    index.rebuilding = True
+    media_index.folders['music'].append(('during rebuild.mp3', 'media'))
+    index.dir_changed('music')
+    # a rebuild started before the change replays it
+    index.rebuild()
+    assert search(index, 'during rebuild') == (1, ['music/during rebuild.mp3'])
+    assert len(index.data) == 12
+
+
+def get_json(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_search_endpoint(tmp_path):
+    for rel_dir, entries in NAMES.items():
+        for name, file_type in entries:
+            path = tmp_path / rel_dir / name
+            if file_type == 'dir':
+                path.mkdir()
+            else:
+                path.write_bytes(b'x')
+
+    with run_server(tmp_path, '--index') as server:
+        # 503 while the search index loads; the first crawl of the fresh index may still be under way after
+        deadline = time.monotonic() + 15
+        while True:
+            status, body = get_json(server.url + '/search?q=lecture+04&type=media')
+            if (status == 200 and body['total']) or time.monotonic() > deadline:
+                break
+            time.sleep(0.1)
+        assert status == 200
+        assert body['total'] == 1
+        result, = body['results']
+        assert result['path'] == 'lectures/lecture 04.mp4'
+        assert result['url'] == '/lectures/lecture%2004.mp4'
+        assert result['size'] == 1
+
+        assert get_json(server.url + '/search?q=lecture&type=dir')[1]['results'][0]['url'] == '/lectures/'
+        assert get_json(server.url + '/search?q=x&limit=no')[0] == 400
+        assert get_json(server.url + '/search?q=x&type=song')[0] == 400
@@ -0,0 +1,89 @@
+import socket
+import subprocess
+import sys
+import urllib.request
+
+import pytest
+
+from conftest import ROOT, run_server, wait_for_port
+from mediabrowser import SD_LISTEN_FDS_START
+
+# records the LAN address lookups of the server process in its output
+COUNT_LOOKUPS = '''
+import socket
+_gethostbyname_ex = socket.gethostbyname_ex
+
+def gethostbyname_ex(name):
+    print('LAN address lookup', flush=True)
+    return _gethostbyname_ex(name)
+
+socket.gethostbyname_ex = gethostbyname_ex
+'''
+
+
+def test_heavy_modules_not_imported():
+    # each is needed by an option or a kind of request only
+    modules = ('asyncio', 'concurrent.futures', 'multiprocessing', 'sqlite3', 'webbrowser', 'zipfile')
+    code = f'import sys, mediabrowser; print(*[m for m in {modules!r} if m in sys.modules])'
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert output.split() == []
+
+
+def test_binds_all_interfaces_without_lookup(tmp_path):
+    (tmp_path / 'song.mp3').write_bytes(b'')
+    with run_server(tmp_path, domain=None, prelude=COUNT_LOOKUPS) as server:
+        assert 'Serving on http://0.0.0.0:' in server.output()
+        assert '(all interfaces)' in server.output()
+        assert 'LAN address lookup' not in server.output()
+
+        for _ in range(2):
+            with urllib.request.urlopen(server.url + '/medialist.m3u8') as response:
+                playlist = response.read().decode()
+            assert '/song.mp3' in playlist
+        # looked up for the first playlist only
+        assert server.output().count('LAN address lookup') == 1
+
+
+def test_domain_is_bound(tmp_path):
+    with run_server(tmp_path, domain='127.0.0.1') as server:
+        assert 'Serving on http://127.0.0.1:' in server.output()
+        with urllib.request.urlopen(server.url + '/') as response:
+            assert response.status == 200
+
+
+@pytest.fixture
+def listener():
+    with socket.create_server(('127.0.0.1', 0)) as sock:
+        yield sock
+
+
+def test_serves_on_inherited_socket(tmp_path, listener):
+    (tmp_path / 'song.mp3').write_bytes(b'')
+    port = listener.getsockname()[1]
+    fd = listener.fileno()
+    # a restart keeps the socket, so the second server answers on the same port
+    for _ in range(2):
+        with run_server(tmp_path, '--fd', str(fd), domain='localhost', wait=False, pass_fds=(fd,)) as server:
+            wait_for_port(port, server.process)
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/medialist.m3u8') as response:
+                # the port given with -p is ignored
+                assert f'http://localhost:{port}/song.mp3' in response.read().decode()
+
+
+def test_socket_activation(tmp_path, listener):
+    # systemd passes the socket as fd 3 and names the process it is meant for
+    prelude = ('import os\n'
+               f'os.dup2({listener.fileno()}, {SD_LISTEN_FDS_START})\n'
+               "os.environ.update(LISTEN_PID=str(os.getpid()), LISTEN_FDS='1')\n")
+    port = listener.getsockname()[1]
+    with run_server(tmp_path, domain=None, prelude=prelude, wait=False, pass_fds=(listener.fileno(),)) as server:
+        wait_for_port(port, server.process)
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/') as response:
+            assert response.status == 200
+
+
+def test_fd_must_be_listening_socket(tmp_path):
+    with socket.socket() as sock:
+        with run_server(tmp_path, '--fd', str(sock.fileno()), wait=False, pass_fds=(sock.fileno(),)) as server:
+            assert server.process.wait(10) == 2
+            assert 'is not a listening socket' in server.output()
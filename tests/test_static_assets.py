@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import os
+import re
+import urllib.error
+import urllib.request
+
+import pytest
+
+from conftest import ROOT
+from mediabrowser import StaticAssets
+
+CSS = os.path.join(ROOT, 'css', 'split-pane.css')
+
+
+def get(url, headers=None, method='GET'):
+    request = urllib.request.Request(url, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_identity(server):
+    url, _ = server
+    status, headers, body = get(url + '/css/split-pane.css', {'Accept-Encoding': 'identity'})
+    assert status == 200
+    assert body == read(CSS)
+    assert headers['Content-Type'] == 'text/css'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert headers['Cache-Control'] == 'no-cache'
+    assert headers['ETag'] == '"%s"' % hashlib.sha1(body).hexdigest()[:24]
+    assert 'Content-Encoding' not in headers
+
+
+def test_gzip(server):
+    url, _ = server
+    status, headers, body = get(url + '/css/split-pane.css', {'Accept-Encoding': 'gzip, deflate'})
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(body) == read(CSS)
+    # each coding has its own strong validator
+    assert headers['ETag'].endswith('-gzip"')
+    assert int(headers['Content-Length']) == len(body)
+
+
+def test_not_compressed_when_it_saves_nothing(server):
+    url, _ = server
+    status, headers, body = get(url + '/ico/favicon-16x16.png', {'Accept-Encoding': 'gzip'})
+    assert status == 200
+    assert 'Content-Encoding' not in headers and 'Vary' not in headers
+    assert body == read(os.path.join(ROOT, 'ico', 'favicon-16x16.png'))
+
+
+def test_not_modified(server):
+    url, _ = server
+    gzip_etag = get(url + '/css/split-pane.css', {'Accept-Encoding': 'gzip'})[1]['ETag']
+    status, headers, body = get(url + '/css/split-pane.css', {'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+    assert status == 304
+    assert body == b''
+    assert headers['ETag'] == gzip_etag
+
+    # the tag of another coding of the same file matches too
+    status, headers, _ = get(url + '/css/split-pane.css', {'If-None-Match': gzip_etag})
+    assert status == 304
+    assert get(url + '/css/split-pane.css', {'If-None-Match': '"0000"'})[0] == 200
+
+
+def test_head(server):
+    url, _ = server
+    get_headers = get(url + '/css/split-pane.css', {'Accept-Encoding': 'gzip'})[1]
+    status, headers, body = get(url + '/css/split-pane.css', {'Accept-Encoding': 'gzip'}, method='HEAD')
+    assert status == 200 and body == b''
+    assert headers['ETag'] == get_headers['ETag']
+    assert headers['Content-Length'] == get_headers['Content-Length']
+
+
+def test_versioned_links(server):
+    url, _ = server
+    page = get(url + '/')[2].decode()
+    links = re.findall(r'(?:src|href)="(/(?:css|js)/[^"]+)"', page)
+    assert links and all('?v=' in link for link in links)
+    status, headers, _ = get(url + links[0])
+    assert status == 200
+    assert 'immutable' in headers['Cache-Control']
+    # an outdated version is revalidated
+    assert get(url + links[0].split('?')[0] + '?v=0')[1]['Cache-Control'] == 'no-cache'
+
+
+def test_reload_on_change(tmp_path):
+    (tmp_path / 'css').mkdir()
+    css = tmp_path / 'css' / 'style.css'
+    css.write_text('body { color: red; }' * 100)
+    (tmp_path / 'mediabro.html').write_text('<link href="/css/style.css" rel="stylesheet">$file_list')
+    assets = StaticAssets(str(tmp_path))
+
+    asset = assets.get_url('/css/style.css')
+    template = assets.page_template()
+    assert 'gzip' in asset.encodings
+    assert f'/css/style.css?v={asset.version}' in template.template
+
+    css.write_text('body { color: blue; }' * 100)
+    os.utime(css, ns=(0, asset.mtime_ns + 1000))
+    # checked at most every CHECK_INTERVAL seconds
+    assert assets.get_url('/css/style.css') is asset
+    asset.checked -= StaticAssets.CHECK_INTERVAL
+    changed = assets.get_url('/css/style.css')
+    assert changed is not asset and changed.version != asset.version
+    # the page links the new version
+    assert f'/css/style.css?v={changed.version}' in assets.page_template().template
+
+    css.unlink()
+    changed.checked -= StaticAssets.CHECK_INTERVAL
+    assert assets.get_url('/css/style.css') is None
+
+
+def test_big_files_stay_on_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(StaticAssets, 'MAX_SIZE', 10)
+    (tmp_path / 'js').mkdir()
+    (tmp_path / 'js' / 'big.js').write_text('x' * 11)
+    assert StaticAssets(str(tmp_path)).get_url('/js/big.js') is None
@@ -0,0 +1,77 @@
+import hashlib
+import socket
+import time
+
+import pytest
+
+from conftest import run_server
+
+SIZE = 16 << 20
+
+
+def read_response(sock, buffer):
+    """Read one response from sock; returns (status line, headers, body, bytes left over)."""
+    while b'\r\n\r\n' not in buffer:
+        chunk = sock.recv(65536)
+        assert chunk, 'connection closed'
+        buffer += chunk
+    head, _, buffer = buffer.partition(b'\r\n\r\n')
+    status, *lines = head.decode('latin-1').split('\r\n')
+    assert status.startswith('HTTP/1.'), status[:100]
+    headers = {name.lower(): value.strip() for name, _, value in (line.partition(':') for line in lines)}
+    length = int(headers['content-length'])
+    while len(buffer) < length:
+        chunk = sock.recv(1 << 20)
+        assert chunk, 'connection closed'
+        buffer += chunk
+    return status, headers, buffer[:length], buffer[length:]
+
+
+def connect(server):
+    return socket.create_connection(('127.0.0.1', int(server.url.rpartition(':')[2])))
+
+
+@pytest.mark.parametrize('options', [(), ('--no_sendfile',), ('--engine', 'asyncio')],
+                         ids=['sendfile', 'buffered', 'asyncio'])
+@pytest.mark.parametrize('byte_range', [None, 'bytes=1000-'])
+def test_growing_file_keeps_framing(tmp_path, options, byte_range):
+    video = tmp_path / 'video.mp4'
+    data = bytes(range(256)) * (SIZE // 256)
+    video.write_bytes(data)
+
+    with run_server(tmp_path, *options) as server, connect(server) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+        request = b'GET /video.mp4 HTTP/1.1\r\nHost: localhost\r\n'
+        if byte_range:
+            request += b'Range: ' + byte_range.encode() + b'\r\n'
+        sock.sendall(request + b'\r\n')
+        # the server is stuck on a full socket buffer while the file grows
+        time.sleep(0.5)
+        with open(video, 'ab') as f:
+            f.write(b'appended' * 4096)
+
+        status, headers, body, rest = read_response(sock, b'')
+        first = int(byte_range[6:-1]) if byte_range else 0
+        assert status.split()[1] == ('206' if byte_range else '200')
+        assert hashlib.sha1(body).digest() == hashlib.sha1(data[first:]).digest()
+
+        # the connection is still usable: the next response starts right after the body
+        sock.sendall(b'GET /video.mp4 HTTP/1.1\r\nHost: localhost\r\nRange: bytes=0-3\r\n\r\n')
+        status, headers, body, rest = read_response(sock, rest)
+        assert status.split()[1] == '206'
+        assert body == data[:4]
+        assert rest == b''
+
+
+@pytest.mark.parametrize('options', [(), ('--no_sendfile',), ('--engine', 'asyncio')],
+                         ids=['sendfile', 'buffered', 'asyncio'])
+def test_empty_file(tmp_path, options):
+    (tmp_path / 'empty.mp3').write_bytes(b'')
+    (tmp_path / 'next.txt').write_bytes(b'next')
+    with run_server(tmp_path, *options) as server, connect(server) as sock:
+        sock.sendall(b'GET /empty.mp3 HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                     b'GET /next.txt HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        status, headers, body, rest = read_response(sock, b'')
+        assert body == b''
+        status, headers, body, rest = read_response(sock, rest)
+        assert body == b'next'
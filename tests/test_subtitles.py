@@ -0,0 +1,84 @@
+import codecs
+import io
+
+import pytest
+
+import mediabrowser
+from mediabrowser import VTT_HEADER, convert_srt_cue, convert_srt_to_vtt, detect_text_encoding
+
+SRT = """1
+00:00:01,5 --> 00:00:03,250
+Hello<br>world
+
+2
+00:01:02,000 --> 00:01:04,000
+<font color="#FFFFFF">white
+text</font> and <font color="#123456">other</font>
+
+3
+01:00:00.1 --> 01:00:02.12
+Ça va? – «Très» bien
+"""
+
+VTT = """1
+00:00:01.500 --> 00:00:03.250
+Hello
+world
+
+2
+00:01:02.000 --> 00:01:04.000
+<c.w>white text</c> and <c>other</c>
+
+3
+01:00:00.100 --> 01:00:02.120
+Ça va? – «Très» bien
+
+"""
+
+
+def convert(data):
+    return b''.join(convert_srt_to_vtt(io.BytesIO(data)))
+
+
+def test_convert_cue():
+    assert convert_srt_cue(['7', '00:00:01,000 --> 00:00:02,5', 'a<br/>b', 'c']) == \
+        '7\n00:00:01.000 --> 00:00:02.500\na\nb\nc'
+    # timestamps are only rewritten on the timing line
+    assert convert_srt_cue(['1', '00:00:01,000 --> 00:00:02,000', 'at 00:00:01,000']) == \
+        '1\n00:00:01.000 --> 00:00:02.000\nat 00:00:01,000'
+
+
+def test_convert():
+    assert convert(SRT.encode('utf-8')) == VTT_HEADER + VTT.encode('utf-8')
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'])
+@pytest.mark.parametrize('block_size', [1, 2, 3, 7, 64 * 1024])
+def test_convert_in_blocks(monkeypatch, newline, block_size):
+    # line ends and multi-byte characters split across the reads
+    monkeypatch.setattr(mediabrowser, 'SUBTITLE_SNIFF_SIZE', block_size)
+    assert convert(SRT.replace('\n', newline).encode('utf-8')) == VTT_HEADER + VTT.encode('utf-8')
+
+
+@pytest.mark.parametrize('encoded', [
+    codecs.BOM_UTF8 + SRT.encode('utf-8'),
+    SRT.encode('utf-16'),
+    SRT.encode('utf-32'),
+    SRT.replace('–', '-').encode('cp1252'),
+], ids=['utf-8-sig', 'utf-16', 'utf-32', 'cp1252'])
+def test_convert_encodings(encoded):
+    expected = VTT if '–' in encoded.decode(detect_text_encoding(encoded)) else VTT.replace('–', '-')
+    assert convert(encoded) == VTT_HEADER + expected.encode('utf-8')
+
+
+def test_detect_encoding():
+    assert detect_text_encoding(codecs.BOM_UTF8 + b'abc') == 'utf-8-sig'
+    assert detect_text_encoding(codecs.BOM_UTF16_LE + b'a\0') == 'utf-16'
+    # a UTF-8 sample may end in the middle of a character
+    assert detect_text_encoding('aé'.encode('utf-8')[:-1]) == 'utf-8'
+
+
+def test_convert_empty_and_unterminated():
+    assert convert(b'') == VTT_HEADER
+    assert convert(b'1\n00:00:01,000 --> 00:00:02,000\nlast') == \
+        VTT_HEADER + b'1\n00:00:01.000 --> 00:00:02.000\nlast\n'
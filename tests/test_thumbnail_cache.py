@@ -0,0 +1,137 @@
+import json
+import os
+import time
+import urllib.request
+
+import pytest
+
+from conftest import run_server
+from mediabrowser import ThumbnailCache
+
+
+class Stat:
+    def __init__(self, size, mtime_ns=1700000000000000000):
+        self.st_size = size
+        self.st_mtime_ns = mtime_ns
+
+
+def cached_files(cache_dir):
+    return sorted(name for _, _, names in os.walk(cache_dir) for name in names)
+
+
+def test_put_and_get(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), 1000)
+    assert cache.get('ab12') is None
+    cache.put('ab12', b'thumbnail')
+    with open(cache.get('ab12'), 'rb') as f:
+        assert f.read() == b'thumbnail'
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.total_bytes == 9
+    assert cached_files(tmp_path) == ['ab12.jpg']
+
+
+def test_keys():
+    key = ThumbnailCache.make_key('/pics/a.jpg', (300, 200), Stat(100))
+    assert key == ThumbnailCache.make_key('/pics/a.jpg', (300, 200), Stat(100))
+    # an edited source or another size, format or file misses
+    assert len({key,
+                ThumbnailCache.make_key('/pics/a.jpg', (300, 200), Stat(101)),
+                ThumbnailCache.make_key('/pics/a.jpg', (300, 200), Stat(100, 1700000000000000001)),
+                ThumbnailCache.make_key('/pics/a.jpg', (150, 100), Stat(100)),
+                ThumbnailCache.make_key('/pics/a.jpg', (300, 200), Stat(100), 'webp'),
+                ThumbnailCache.make_key('/pics/b.jpg', (300, 200), Stat(100))}) == 6
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), 300)
+    for key in ('aa01', 'bb02', 'cc03'):
+        cache.put(key, bytes(100))
+    # a hit makes aa01 the most recently used
+    assert cache.get('aa01')
+    cache.put('dd04', bytes(100))
+
+    assert cache.get('bb02') is None
+    assert [cache.contains(key) for key in ('aa01', 'cc03', 'dd04')] == [True, True, True]
+    assert cache.total_bytes == 300
+    assert cached_files(tmp_path) == ['aa01.jpg', 'cc03.jpg', 'dd04.jpg']
+
+    # an entry larger than the whole budget doesn't stay
+    cache.put('ee05', bytes(301))
+    assert cache.total_bytes == 0
+    assert cached_files(tmp_path) == []
+
+
+def test_replacing_an_entry_counts_once(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), 1000)
+    cache.put('aa01', bytes(100))
+    cache.put('aa01', bytes(50))
+    assert cache.total_bytes == 50
+    assert len(cache.entries) == 1
+
+
+def test_recency_survives_restart(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), 300)
+    for key in ('aa01', 'bb02', 'cc03'):
+        cache.put(key, bytes(100))
+        # the order is kept in the file mtimes
+        time.sleep(0.01)
+    cache.get('aa01')
+
+    restarted = ThumbnailCache(str(tmp_path), 300)
+    assert list(restarted.entries) == ['bb02', 'cc03', 'aa01']
+    assert restarted.total_bytes == 300
+
+    # a smaller budget evicts on load
+    restarted = ThumbnailCache(str(tmp_path), 150)
+    assert list(restarted.entries) == ['aa01']
+    assert cached_files(tmp_path) == ['aa01.jpg']
+
+
+def test_stale_temp_files_are_removed(tmp_path):
+    (tmp_path / 'aa').mkdir()
+    stale, fresh = tmp_path / 'aa' / 'stale.tmp', tmp_path / 'aa' / 'fresh.tmp'
+    stale.write_bytes(b'partial')
+    fresh.write_bytes(b'partial')
+    old = time.time() - ThumbnailCache.STALE_TMP_SECONDS - 10
+    os.utime(stale, (old, old))
+
+    cache = ThumbnailCache(str(tmp_path), 1000)
+    assert not stale.exists()
+    # may still be written by another process
+    assert fresh.exists()
+    assert not cache.entries
+
+
+def test_entry_removed_behind_the_cache(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), 1000)
+    cache.put('aa01', bytes(100))
+    os.unlink(cache.get('aa01'))
+    assert cache.get('aa01') is None
+    assert cache.total_bytes == 0
+
+
+def test_shared_cache_sees_other_processes(tmp_path):
+    one = ThumbnailCache(str(tmp_path), 1000, shared=True)
+    other = ThumbnailCache(str(tmp_path), 1000, shared=True)
+    one.put('aa01', bytes(100))
+    assert other.get('aa01')
+    assert other.total_bytes == 100
+
+    # without shared=True a miss doesn't look at the folder
+    assert ThumbnailCache(str(tmp_path / 'x'), 1000).get('aa01') is None
+
+
+def test_thumbnails_are_cached_on_disk(tmp_path):
+    pytest.importorskip('PIL')
+    from PIL import Image
+
+    Image.new('RGB', (1600, 1200), 'blue').save(tmp_path / 'photo.jpg')
+    with run_server(tmp_path, '--thumb_cache_size', '10') as server:
+        for _ in range(2):
+            with urllib.request.urlopen(server.url + '/photo.jpg?mediabro-thumb.jpg') as response:
+                assert response.headers['Content-Type'] == 'image/jpeg'
+        with urllib.request.urlopen(server.url + '/__stats') as response:
+            stats = json.load(response)['thumbnail_cache']
+        assert (stats['entries'], stats['hits']) == (1, 1)
+        assert stats['max_bytes'] == 10 << 20
+        assert len(cached_files(os.path.join(server.cache, 'mediabrowser', 'thumbnails'))) == 1
@@ -0,0 +1,152 @@
+import io
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import mediabrowser
+from mediabrowser import ThumbnailCache, ThumbnailRenderer, make_thumbnail, render_thumbnail
+
+Image = pytest.importorskip('PIL.Image')
+
+SIZE = (300, 200)
+
+
+@pytest.fixture(scope='module')
+def photo(tmp_path_factory):
+    path = tmp_path_factory.mktemp('pics') / 'photo.jpg'
+    Image.new('RGB', (2000, 1500), 'green').save(path, quality=90)
+    return str(path)
+
+
+@pytest.fixture(params=[0, 2], ids=['inline', 'pool'])
+def renderer(request):
+    renderer = ThumbnailRenderer(request.param)
+    yield renderer
+    renderer.shutdown()
+
+
+def open_image(data):
+    return Image.open(io.BytesIO(data))
+
+
+def test_render(renderer, photo):
+    data, is_owner = renderer.render('key', photo, SIZE)
+    assert is_owner
+    assert open_image(data).format == 'JPEG'
+    assert open_image(data).size == (267, 200)
+
+    stats = renderer.stats()
+    assert (stats['submitted'], stats['in_flight'], stats['failed']) == (1, 0, 0)
+    assert stats['latency_max'] > 0
+    assert stats['workers'] == renderer.max_workers
+
+
+def test_render_error(renderer, tmp_path):
+    broken = tmp_path / 'broken.jpg'
+    broken.write_bytes(b'\xff\xd8\xff\xe0 truncated')
+    with pytest.raises(Exception):
+        renderer.render('key', str(broken), SIZE)
+    assert renderer.stats()['failed'] == 1
+    assert not renderer.in_flight
+
+
+def test_concurrent_requests_share_one_job(photo):
+    renderer = ThumbnailRenderer(0)
+    # a job of another request that is still running
+    running = renderer.in_flight['key'] = Future()
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(renderer.render('key', photo, SIZE)))
+    waiter.start()
+    running.set_result((b'thumbnail', 0.1, 0.05))
+    waiter.join(5)
+
+    assert results == [(b'thumbnail', False)]
+    assert (renderer.submitted, renderer.shared) == (0, 1)
+
+
+def test_idle_workers():
+    renderer = ThumbnailRenderer(0)
+    assert renderer.has_idle_worker()
+    renderer.in_flight['key'] = Future()
+    # inline rendering counts as one worker
+    assert not renderer.has_idle_worker()
+    assert renderer.queue_depth == 0
+    renderer.in_flight['other'] = Future()
+    assert renderer.queue_depth == 1
+
+
+def test_failed_images_are_remembered(tmp_path, monkeypatch):
+    broken = tmp_path / 'broken.jpg'
+    broken.write_bytes(b'not an image')
+    renderer = ThumbnailRenderer(0)
+    cache = ThumbnailCache(str(tmp_path / 'cache'), 1 << 20)
+    monkeypatch.setattr(mediabrowser, 'thumbnail_renderer', renderer)
+    monkeypatch.setattr(mediabrowser, 'thumbnail_cache', cache)
+
+    st = broken.stat()
+    key = ThumbnailCache.make_key(str(broken), SIZE, st)
+    assert render_thumbnail(key, str(broken), SIZE, st) is None
+    assert renderer.has_failed(str(broken), st)
+    # not decoded again until the file changes
+    assert mediabrowser.get_thumbnail(str(broken), SIZE) is None
+    assert renderer.submitted == 1
+
+    broken.write_bytes(b'still not an image, but changed')
+    assert not renderer.has_failed(str(broken), broken.stat())
+
+
+def test_rendered_thumbnails_are_cached(photo, tmp_path, monkeypatch):
+    renderer = ThumbnailRenderer(0)
+    cache = ThumbnailCache(str(tmp_path), 1 << 20)
+    monkeypatch.setattr(mediabrowser, 'thumbnail_renderer', renderer)
+    monkeypatch.setattr(mediabrowser, 'thumbnail_cache', cache)
+
+    first = mediabrowser.get_thumbnail(photo, SIZE)
+    assert mediabrowser.get_thumbnail(photo, SIZE) == first
+    assert renderer.submitted == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_jpeg_decoded_at_reduced_size(photo, monkeypatch):
+    from PIL.JpegImagePlugin import JpegImageFile
+
+    drafts = []
+    draft = JpegImageFile.draft
+
+    def record_draft(image, mode, size):
+        drafts.append(size)
+        return draft(image, mode, size)
+
+    monkeypatch.setattr(JpegImageFile, 'draft', record_draft)
+    data, decode_seconds = make_thumbnail(photo, SIZE)
+    # the longest side for both axes, in case EXIF rotates the image
+    assert drafts[0] == (300, 300)
+    assert open_image(data).size == (267, 200)
+
+
+def test_exif_orientation(tmp_path):
+    path = tmp_path / 'rotated.jpg'
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new('RGB', (800, 400), 'red').save(path, exif=exif)
+    data, _ = make_thumbnail(str(path), SIZE)
+    width, height = open_image(data).size
+    assert height > width
+
+
+@pytest.mark.parametrize('fmt', ['webp', 'avif'])
+def test_formats(photo, fmt):
+    from PIL import features
+    if not features.check(fmt):
+        pytest.skip(f'Pillow without {fmt}')
+    data, _ = make_thumbnail(photo, SIZE, fmt)
+    assert mediabrowser.get_thumbnail_format(data) == fmt
+
+
+def test_small_png_passes_through(tmp_path):
+    path = tmp_path / 'icon.png'
+    Image.new('RGB', (40, 30), 'red').save(path)
+    data, decode_seconds = make_thumbnail(str(path), SIZE, 'webp')
+    assert data == path.read_bytes()
+    assert decode_seconds == 0.0
@@ -0,0 +1,111 @@
+import io
+import urllib.error
+import urllib.request
+
+import pytest
+
+from mediabrowser import THUMBNAIL_SIZES
+
+Image = pytest.importorskip('PIL.Image')
+features = pytest.importorskip('PIL.features')
+
+
+def get(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def save_image(path, size, fmt, **options):
+    Image.new('RGB', size, (200, 30, 30)).save(path, fmt, **options)
+
+
+@pytest.fixture(scope='module')
+def images(server):
+    url, webroot = server
+    save_image(webroot / 'photo.jpg', (1600, 1200), 'JPEG', quality=95)
+    save_image(webroot / 'icon.png', (40, 30), 'PNG')
+    save_image(webroot / 'icon.gif', (40, 30), 'GIF')
+    (webroot / 'broken.jpg').write_bytes(b'\xff\xd8\xff\xe0 truncated')
+    return url
+
+
+@pytest.mark.parametrize('accept, content_type', [
+    ('image/avif,image/webp,*/*', 'image/avif'),
+    ('image/webp,*/*', 'image/webp'),
+    ('image/jpeg', 'image/jpeg'),
+    # */* alone doesn't say that the browser decodes AVIF or WebP
+    ('*/*', 'image/jpeg'),
+    ('', 'image/jpeg'),
+])
+def test_format_negotiation(images, accept, content_type):
+    if content_type != 'image/jpeg' and not features.check(content_type[6:]):
+        pytest.skip(f'Pillow without {content_type}')
+    status, headers, body = get(images + '/photo.jpg?mediabro-thumb.jpg', {'Accept': accept})
+    assert status == 200
+    assert headers['Content-Type'] == content_type
+    assert headers['Vary'] == 'Accept'
+    assert headers['ETag'].endswith('-%s"' % content_type[6:])
+    assert Image.open(io.BytesIO(body)).format == content_type[6:].upper()
+
+
+@pytest.mark.parametrize('size_class', [None, *THUMBNAIL_SIZES])
+def test_size_classes(images, size_class):
+    query = '&size=' + size_class if size_class else ''
+    status, headers, body = get(images + '/photo.jpg?mediabro-thumb.jpg' + query, {'Accept': 'image/jpeg'})
+    assert status == 200
+    width, height = THUMBNAIL_SIZES[size_class or 'm']
+    thumbnail = Image.open(io.BytesIO(body))
+    # 4:3 into the box of the size class
+    assert thumbnail.width <= width and thumbnail.height <= height
+    assert thumbnail.width == width or thumbnail.height == height
+    assert ('x%d-' % height) in headers['ETag']
+
+
+def test_invalid_size_class(images):
+    assert get(images + '/photo.jpg?mediabro-thumb.jpg&size=xxl')[0] == 400
+
+
+@pytest.mark.parametrize('name, fmt', [('icon.png', 'png'), ('icon.gif', 'gif')])
+def test_small_images_pass_through(images, name, fmt):
+    tags = set()
+    for accept in ('image/webp', 'image/jpeg', ''):
+        status, headers, body = get(images + f'/{name}?mediabro-thumb.jpg', {'Accept': accept})
+        assert status == 200
+        # the validator and the type of what is sent, not of what was negotiated
+        assert headers['Content-Type'] == f'image/{fmt}'
+        assert headers['ETag'].endswith(f'-{fmt}"')
+        assert headers['Vary'] == 'Accept'
+        tags.add(headers['ETag'])
+    assert len(tags) == 1
+
+
+@pytest.mark.parametrize('name, accept', [('photo.jpg', 'image/webp'), ('icon.png', 'image/webp')])
+def test_not_modified(images, name, accept):
+    url = images + f'/{name}?mediabro-thumb.jpg'
+    etag = get(url, {'Accept': accept})[1]['ETag']
+    status, headers, body = get(url, {'Accept': accept, 'If-None-Match': etag})
+    assert status == 304
+    assert headers['ETag'] == etag
+    assert headers['Vary'] == 'Accept'
+    assert body == b''
+
+
+def test_versioned_urls_are_immutable(images, server):
+    _, webroot = server
+    from mediabrowser import thumbnail_version
+
+    st = (webroot / 'photo.jpg').stat()
+    url = images + '/photo.jpg?mediabro-thumb.jpg&v=' + thumbnail_version(st.st_mtime, st.st_size)
+    assert 'immutable' in get(url)[1]['Cache-Control']
+    assert get(images + '/photo.jpg?mediabro-thumb.jpg&v=old')[1]['Cache-Control'] == 'no-cache'
+
+
+def test_broken_image_falls_back_to_the_original(images):
+    for _ in range(2):
+        status, headers, body = get(images + '/broken.jpg?mediabro-thumb.jpg')
+        assert status == 200
+        assert body == b'\xff\xd8\xff\xe0 truncated'
@@ -0,0 +1,78 @@
+import json
+import os
+import signal
+import sys
+import time
+import urllib.request
+
+import pytest
+
+from conftest import run_server
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='--workers needs fork()')
+
+
+def get_stats(url):
+    # a new connection each time, so that the kernel may pick another worker
+    request = urllib.request.Request(url + '/__stats', headers={'Connection': 'close'})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def find_workers(url, count, deadline=15):
+    """{worker id: pid} of count workers, seen over many connections."""
+    workers = {}
+    deadline = time.monotonic() + deadline
+    while len(workers) < count and time.monotonic() < deadline:
+        try:
+            stats = get_stats(url)
+        except ConnectionError:
+            # queued on the socket of a worker that just died
+            continue
+        workers[stats['worker']] = stats['pid']
+    return workers
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_workers_share_the_port(tmp_path):
+    with run_server(tmp_path, '--workers', '2') as server:
+        workers = find_workers(server.url, 2)
+        assert sorted(workers) == [0, 1]
+        assert server.process.pid not in workers.values()
+        assert f'Supervisor {server.process.pid} starting 2 workers' in server.output()
+
+
+def test_dead_workers_are_restarted(tmp_path):
+    with run_server(tmp_path, '--workers', '2') as server:
+        workers = find_workers(server.url, 2)
+        os.kill(workers[1], signal.SIGKILL)
+
+        deadline = time.monotonic() + 15
+        while time.monotonic() < deadline:
+            restarted = find_workers(server.url, 2, deadline=2)
+            if restarted.get(1) not in (None, workers[1]):
+                break
+        assert restarted[0] == workers[0]
+        assert restarted[1] != workers[1]
+        assert f'Worker 1 (pid {workers[1]}) exited with code -9, restarting' in server.output()
+
+    # the supervisor took its workers along
+    time.sleep(0.5)
+    assert not any(is_running(pid) for pid in restarted.values())
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='SO_REUSEPORT sockets per worker on Linux')
+def test_supervisor_holds_no_listening_socket(tmp_path):
+    with run_server(tmp_path, '--workers', '2') as server:
+        find_workers(server.url, 2)
+        fds = os.listdir(f'/proc/{server.process.pid}/fd')
+        sockets = [fd for fd in fds if os.readlink(f'/proc/{server.process.pid}/fd/{fd}').startswith('socket:')]
+        # every worker owns its socket; one left in the supervisor would get connections nobody accepts
+        assert sockets == []
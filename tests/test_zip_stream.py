@@ -0,0 +1,213 @@
+import io
+import os
+import urllib.error
+import urllib.request
+import zipfile
+
+import pytest
+
+import mediabrowser
+from conftest import run_server
+from mediabrowser import ZipStreamWriter
+
+
+class Stat:
+    def __init__(self, size, mtime=1700000000, mode=0o100644):
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_mode = mode
+
+
+class UnseekableWriter:
+    """Output that can only be appended to, like a response body."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def write_archive(entries, level=6):
+    out = UnseekableWriter()
+    writer = ZipStreamWriter(out, level=level, bufsize=1000)
+    for name, data, compress in entries:
+        if data is None:
+            writer.add_folder(name, 1700000000)
+        else:
+            writer.add_file(name, io.BytesIO(data), Stat(len(data)), compress)
+    writer.close()
+    return out.buffer.getvalue()
+
+
+def test_round_trip():
+    text = b'mediabrowser ' * 10000
+    binary = os.urandom(5000)
+    data = write_archive([('music/', None, False), ('music/notes.txt', text, True),
+                          ('music/noise.bin', binary, False), ('empty.txt', b'', True)])
+
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['music/', 'music/notes.txt', 'music/noise.bin', 'empty.txt']
+        assert archive.getinfo('music/').is_dir()
+        assert archive.read('music/notes.txt') == text
+        assert archive.getinfo('music/notes.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert archive.getinfo('music/notes.txt').compress_size < len(text)
+        assert archive.read('music/noise.bin') == binary
+        assert archive.getinfo('music/noise.bin').compress_type == zipfile.ZIP_STORED
+        assert archive.read('empty.txt') == b''
+
+
+def test_level_zero_stores():
+    data = write_archive([('a.txt', b'aaaa' * 100, True)], level=0)
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.getinfo('a.txt').compress_type == zipfile.ZIP_STORED
+        assert archive.read('a.txt') == b'aaaa' * 100
+
+
+def test_unicode_names_and_times():
+    data = write_archive([('Mötley Crüe/Ñandú.mp3', b'x', False)])
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        info = archive.infolist()[0]
+        assert info.filename == 'Mötley Crüe/Ñandú.mp3'
+        assert info.flag_bits & mediabrowser.ZIP_FLAG_UTF8
+        assert info.date_time[0] == 2023
+
+
+def test_file_that_shrinks_while_read():
+    out = UnseekableWriter()
+    writer = ZipStreamWriter(out)
+    # stat says 1000 bytes, but only 10 are left by the time the file is read
+    writer.add_file('short.txt', io.BytesIO(b'0123456789'), Stat(1000), True)
+    writer.add_file('next.txt', io.BytesIO(b'next'), Stat(4), False)
+    writer.close()
+
+    with zipfile.ZipFile(io.BytesIO(out.buffer.getvalue())) as archive:
+        assert archive.read('short.txt') == b'0123456789'
+        assert archive.read('next.txt') == b'next'
+
+
+def test_file_that_grows_while_read():
+    out = UnseekableWriter()
+    writer = ZipStreamWriter(out)
+    writer.add_file('long.txt', io.BytesIO(b'0123456789'), Stat(4), True)
+    writer.close()
+
+    with zipfile.ZipFile(io.BytesIO(out.buffer.getvalue())) as archive:
+        assert archive.read('long.txt') == b'0123'
+
+
+def test_read_error_ends_the_file_early():
+    class FailingFile(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell():
+                raise OSError('I/O error')
+            return super().read(size)
+
+    out = UnseekableWriter()
+    writer = ZipStreamWriter(out, bufsize=4)
+    writer.add_file('broken.txt', FailingFile(b'0123456789'), Stat(10), False)
+    writer.close()
+
+    with zipfile.ZipFile(io.BytesIO(out.buffer.getvalue())) as archive:
+        assert archive.read('broken.txt') == b'0123'
+
+
+def test_zip64_entry_count():
+    out = UnseekableWriter()
+    writer = ZipStreamWriter(out)
+    for i in range(0x10000):
+        writer.add_folder(f'{i}/', 1700000000)
+    writer.close()
+    data = out.buffer.getvalue()
+
+    # the ZIP64 end of central directory record and its locator precede the classic record
+    assert data[-22:-18] == b'PK\x05\x06'
+    assert data[-42:-38] == b'PK\x06\x07'
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        names = archive.namelist()
+    assert len(names) == 0x10000
+    assert names[-1] == '65535/'
+
+
+def test_zip64_file_fields():
+    class Zeros:
+        def __init__(self, size):
+            self.remaining = size
+
+        def read(self, size):
+            size = min(size, self.remaining)
+            self.remaining -= size
+            return bytes(size)
+
+    # a few bytes only, declared as big enough for ZIP64 fields in the local header
+    out = UnseekableWriter()
+    writer = ZipStreamWriter(out)
+    zeros = Zeros(100)
+    writer.add_file('big.bin', zeros, Stat(mediabrowser.ZIP64_LIMIT), True)
+    writer.close()
+
+    with zipfile.ZipFile(io.BytesIO(out.buffer.getvalue())) as archive:
+        assert archive.read('big.bin') == bytes(100)
+
+
+@pytest.fixture(scope='module')
+def lessons(tmp_path_factory):
+    root = tmp_path_factory.mktemp('webroot')
+    (root / 'lessons' / 'audio').mkdir(parents=True)
+    (root / 'lessons' / 'audio' / 'one.mp3').write_bytes(b'\xff\xfb' * 1000)
+    (root / 'lessons' / 'notes.txt').write_bytes(b'notes ' * 1000)
+    (root / 'lessons' / '.hidden').write_bytes(b'hidden')
+    return root
+
+
+def download(url, data=None):
+    try:
+        with urllib.request.urlopen(url, data) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def test_folder_download(lessons):
+    with run_server(lessons) as server:
+        status, headers, body = download(server.url + '/lessons/?download=zip')
+        assert status == 200
+        assert headers['Content-Type'] == 'application/zip'
+        assert 'filename="lessons.zip"' in headers['Content-Disposition']
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            assert sorted(archive.namelist()) == ['audio/', 'audio/one.mp3', 'notes.txt']
+            assert archive.getinfo('audio/one.mp3').compress_type == zipfile.ZIP_STORED
+            assert archive.getinfo('notes.txt').compress_type == zipfile.ZIP_DEFLATED
+            assert archive.read('notes.txt') == b'notes ' * 1000
+
+        status, headers, body = download(server.url + '/lessons/?download=zip&show=all')
+        assert '.hidden' in zipfile.ZipFile(io.BytesIO(body)).namelist()
+
+        status, headers, body = download(server.url + '/lessons/?download=zip', b'name=notes.txt&name=missing')
+        assert zipfile.ZipFile(io.BytesIO(body)).namelist() == ['notes.txt']
+
+
+@pytest.mark.parametrize('options, allowed', [
+    (('--zip_max_files', '2'), True),
+    (('--zip_max_files', '1'), False),
+    (('--zip_max_size', '1'), True),
+    (('--zip_max_files', '0', '--zip_max_size', '0'), True),
+])
+def test_download_limits(lessons, options, allowed):
+    with run_server(lessons, *options) as server:
+        status, headers, body = download(server.url + '/lessons/?download=zip')
+        assert status == (200 if allowed else 403)
+        if allowed:
+            assert len(zipfile.ZipFile(io.BytesIO(body)).namelist()) == 3
+        # a selection within the limits
+        status, headers, body = download(server.url + '/lessons/?download=zip', b'name=notes.txt')
+        assert status == 200
+
+
+def test_download_size_limit(tmp_path):
+    (tmp_path / 'big.bin').write_bytes(bytes((1 << 20) + 1))
+    with run_server(tmp_path, '--zip_max_size', '1') as server:
+        status, headers, body = download(server.url + '/?download=zip')
+        assert status == 403
+        assert b'1 MB' in body